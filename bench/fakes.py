@@ -0,0 +1,268 @@
+import copy
+import json
+import os.path
+import queue
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+#The canned responses are shared with the unit tests
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "resources")
+
+
+def _load(path):
+    with open(f"{ RESOURCES }/{ path }", 'r') as f:
+        return f.read()
+
+
+class FakeServer:
+    """
+    Base for the fake services: a threaded HTTP server on a random local port, running in the background.
+    Subclasses implement handle(method, path, query, body) and return (status, content type, body).
+    """
+
+    def __init__(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _dispatch(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                #Always drain the body, so that uploads cost what they would against a real server
+                body = self.rfile.read(length) if length > 0 else b""
+                status, content_type, response = fake.handle(method, url.path, parse_qs(url.query), body)
+                if callable(response):
+                    #Streamed response, see FakeZoom.handle()
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    response(self)
+                    return
+                if isinstance(response, str):
+                    response = response.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                if method != 'HEAD':
+                    self.wfile.write(response)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def do_PUT(self):
+                self._dispatch('PUT')
+
+            def do_HEAD(self):
+                self._dispatch('HEAD')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{ self.server.server_address[1] }"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, query, body):
+        raise NotImplementedError()
+
+
+class FakeZoom(FakeServer):
+    """
+    Serves the OAuth token, user, contact search, recording list and recording endpoints, plus the media downloads.
+    Downloads are throttled to bandwidth bytes per second (or unthrottled if that is None).
+    """
+
+    def __init__(self, recordings=100, users=10, file_size=10 * 1024 * 1024, bandwidth=None):
+        super().__init__()
+        self.file_size = int(file_size)
+        self.bandwidth = bandwidth
+        template = json.loads(_load("zoom/get-recording.json"))
+        user_template = json.loads(_load("zoom/get-single-user.json"))
+        self.users = {}
+        for i in range(users):
+            user = copy.deepcopy(user_template)
+            user.update({'id': f"benchuser{ i:05d}", 'first_name': f"First{ i }", 'last_name': f"Last{ i }", 'email': f"user{ i }@example.org"})
+            self.users[user['id']] = user
+        user_ids = sorted(self.users.keys())
+        self.recordings = {}
+        for i in range(recordings):
+            recording = copy.deepcopy(template)
+            uuid = f"bench{ i:06d}AAAAAAAAAAA=="
+            recording.update({'uuid': uuid, 'id': 80000000000 + i, 'topic': f"Benchmark Meeting { i }",
+                              'host_id': user_ids[i % len(user_ids)], 'duration': 30 + i % 60,
+                              'start_time': f"2023-{ 1 + i % 12:02d}-{ 1 + i % 28:02d}T{ i % 24:02d}:00:00Z"})
+            for n, recording_file in enumerate(recording['recording_files']):
+                file_id = f"{ uuid[:-2] }-{ n }"
+                recording_file.update({'id': file_id, 'meeting_id': uuid, 'file_size': self.file_size,
+                                       'download_url': f"{ self.url }/download/{ file_id }"})
+            self.recordings[uuid] = recording
+
+    def webhook_event(self, uuid):
+        """
+        Returns a recording.completed webhook event for one of the fake recordings.
+        """
+        event = json.loads(_load("zoom/webhook-recording-completed.json"))
+        event['payload']['object'] = copy.deepcopy(self.recordings[uuid])
+        event['event_ts'] = int(time.time() * 1000)
+        return event
+
+    def handle(self, method, path, query, body):
+        if path == "/oauth/token":
+            return 200, "application/json", json.dumps({'access_token': "bench-token", 'token_type': "bearer", 'expires_in': 3599})
+        match = re.match(r"^/v2/meetings/(.+)/recordings$", path)
+        if match:
+            recording = self.recordings.get(match.group(1), None)
+            if not recording:
+                return 404, "application/json", json.dumps({'code': 3301, 'message': "This recording does not exist."})
+            return 200, "application/json", json.dumps(recording)
+        match = re.match(r"^/v2/users/([^/]+)/recordings$", path)
+        if match:
+            meetings = [ recording for recording in self.recordings.values() if recording['host_id'] == match.group(1) ]
+            page_size = int(query.get('page_size', [30])[0])
+            return 200, "application/json", json.dumps({'from': query.get('from', [""])[0], 'to': query.get('to', [""])[0],
+                                                        'page_count': 1, 'page_size': page_size, 'total_records': len(meetings),
+                                                        'next_page_token': "", 'meetings': meetings[:page_size]})
+        match = re.match(r"^/v2/users/([^/]+)$", path)
+        if match:
+            user = self.users.get(match.group(1), None)
+            if not user:
+                return 404, "application/json", json.dumps({'code': 1001, 'message': "User does not exist."})
+            return 200, "application/json", json.dumps(user)
+        if path == "/v2/contacts":
+            key = query.get('search_key', [""])[0].lower()
+            contacts = [ user for user in self.users.values() if key in user['first_name'].lower() or key in user['last_name'].lower() ]
+            return 200, "application/json", json.dumps({'page_size': 25, 'next_page_token': "", 'contacts': contacts[:25]})
+        if path.startswith("/download/"):
+            return 200, "application/octet-stream", self._stream
+        return 404, "text/plain", "Not found"
+
+    def _stream(self, handler):
+        handler.send_header('Content-Length', str(self.file_size))
+        handler.end_headers()
+        chunk = b"\0" * 65536
+        remaining = self.file_size
+        start = time.perf_counter()
+        while remaining > 0:
+            size = min(remaining, len(chunk))
+            handler.wfile.write(chunk[:size])
+            remaining -= size
+            if self.bandwidth:
+                #Sleep until we're back under the configured rate
+                ahead = (self.file_size - remaining) / self.bandwidth - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class FakeOpencast(FakeServer):
+    """
+    Serves the catalog endpoints (ACLs, themes, workflows, series) and the ingest endpoints, with canned responses.
+    """
+
+    def __init__(self, series=1000, acls=50, themes=20):
+        super().__init__()
+        series_template = json.loads(_load("opencast/series.json"))[0]
+        self.series = []
+        for i in range(series):
+            entry = copy.deepcopy(series_template)
+            entry.update({'identifier': f"bench-series-{ i }", 'title': f"Benchmark Series { i }", 'creator': f"Creator { i % 97 }"})
+            self.series.append(entry)
+        acl_template = json.loads(_load("opencast/acls.json"))[0]
+        self.acls = []
+        for i in range(acls):
+            entry = copy.deepcopy(acl_template)
+            entry.update({'id': 1000 + i, 'name': f"Benchmark ACL { i }"})
+            self.acls.append(entry)
+        self.themes = [ {'id': i, 'name': f"Benchmark Theme { i }"} for i in range(themes) ]
+        self.workflows = _load("opencast/workflows.json")
+        self.responses = { name: _load(f"opencast/{ name }.xml") for name in ("create-mp", "add-dc", "add-security", "add-track", "ingest") }
+
+    def handle(self, method, path, query, body):
+        if path == "/acl-manager/acl/acls.json":
+            return 200, "application/json", json.dumps(self.acls)
+        if path == "/admin-ng/themes/themes.json":
+            limit = int(query.get('limit', [100])[0])
+            offset = int(query.get('offset', [0])[0])
+            page = self.themes[offset:offset + limit]
+            return 200, "application/json", json.dumps({'total': len(self.themes), 'count': len(page), 'offset': offset, 'limit': limit, 'results': page})
+        if path == "/api/workflow-definitions":
+            return 200, "application/json", self.workflows
+        if path == "/api/series/series.json":
+            count = int(query.get('count', [100])[0])
+            offset = int(query.get('offset', [0])[0])
+            return 200, "application/json", json.dumps(self.series[offset:offset + count])
+        if path == "/ingest/createMediaPackage":
+            return 200, "text/xml", self.responses['create-mp']
+        if path == "/ingest/addDCCatalog":
+            return 200, "text/xml", self.responses['add-dc']
+        if path == "/ingest/addAttachment":
+            return 200, "text/xml", self.responses['add-security']
+        if path == "/ingest/addTrack":
+            return 200, "text/xml", self.responses['add-track']
+        if path.startswith("/ingest/ingest/") or path.startswith("/ingest/addMediaPackage"):
+            return 200, "text/xml", self.responses['ingest']
+        if method == 'HEAD':
+            return 200, "application/octet-stream", b""
+        return 404, "text/plain", "Not found"
+
+
+class FakeBroker:
+    """
+    In-process stand-in for RabbitMQ.  install() points a zingest Rabbit at it, after which published messages
+    are queued in memory until drain() hands them to a consumer callback.
+    """
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.published = 0
+
+    def install(self, rabbit):
+        rabbit._connect = lambda: _FakeConnection(self)
+        return self
+
+    def drain(self, callback):
+        consumed = 0
+        while True:
+            try:
+                body = self.messages.get_nowait()
+            except queue.Empty:
+                return consumed
+            callback(None, None, body)
+            consumed += 1
+
+
+class _FakeConnection:
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue, passive=False):
+        class Method:
+            message_count = self.broker.messages.qsize()
+        class Result:
+            method = Method
+        return Result
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.broker.published += 1
+        self.broker.messages.put(body)
+
+    def close(self):
+        pass
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the webhook, the UI pages, the Opencast catalog refreshes and the ingest pipeline itself.
+
+Everything runs against local stand-ins (see fakes.py): a fake Zoom API and download server, a fake Opencast, and an
+in-memory replacement for RabbitMQ.  The results are printed, and saved to bench/results/<commit>.json so that they
+can be compared between commits with --compare.
+
+Run this from the root of the repository, eg:
+    python bench/run.py --recordings 200 --file-size 5000000 --bandwidth 50000000
+    python bench/run.py --compare bench/results/abc1234.json
+"""
+import argparse
+import configparser
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+import os
+import os.path
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeBroker, FakeOpencast, FakeZoom
+
+WEBHOOK_SECRET = "benchmark-secret"
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Scenario:
+    """
+    Times a number of operations, optionally tracing the peak Python memory used while doing so.
+    """
+
+    def __init__(self, name, trace_memory):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.latencies = []
+        self.errors = 0
+        self.extra = {}
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+        self.peak_memory = None
+        if self.trace_memory:
+            _, self.peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    def time(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            logging.getLogger(__name__).exception(f"{ self.name } failed")
+            self.errors += 1
+            result = None
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def results(self):
+        results = {
+            'count': len(self.latencies),
+            'errors': self.errors,
+            'seconds': round(self.elapsed, 4),
+            'throughput': round(len(self.latencies) / self.elapsed, 2) if self.elapsed > 0 else None,
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 2) if self.latencies else None,
+            'p90_ms': round(percentile(self.latencies, 90) * 1000, 2) if self.latencies else None,
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 2) if self.latencies else None,
+            'max_ms': round(max(self.latencies) * 1000, 2) if self.latencies else None,
+            'peak_memory_bytes': self.peak_memory,
+        }
+        results.update(self.extra)
+        return results
+
+
+def write_settings(workdir, zoom, opencast):
+    config = configparser.ConfigParser()
+    config['Zoom'] = {'oauth_account_id': "bench", 'oauth_client_id': "bench-client", 'oauth_client_secret': "bench-secret", 'GDPR': "false"}
+    config['Webhook'] = {'Min_Duration': "0", 'default_series_id': "", 'default_acl_id': "", 'default_workflow_id': "bench-workflow", 'secret': WEBHOOK_SECRET}
+    config['Opencast'] = {'Url': opencast.url, 'User': "opencast_system_account", 'Password': "CHANGE_ME", 'workflow_filter': "", 'series_filter': ".*"}
+    config['Progress'] = {'path': os.path.join(workdir, "ingest-status")}
+    config['Email'] = {'enabled': "false"}
+    config['Rabbit'] = {'host': "localhost", 'user': "rabbit", 'password': "rabbit"}
+    config['Filter'] = {'topic_regex': ".*"}
+    config['Database'] = {'database': f"sqlite:///{ os.path.join(workdir, 'bench.db') }"}
+    config['Visibility'] = {'episode': "", 'series': "", 'series_create_enabled': "true"}
+    config['TESTING'] = {'IN_PROGRESS_ROOT': os.path.join(workdir, "in-progress"),
+                         'zoom_base_uri': f"{ zoom.url }/v2", 'zoom_oauth_uri': f"{ zoom.url }/oauth/token"}
+    os.makedirs(os.path.join(workdir, "etc", "zoom-ingest"))
+    with open(os.path.join(workdir, "etc", "zoom-ingest", "settings.ini"), 'w') as f:
+        config.write(f)
+
+
+def sign(body, timestamp):
+    message = f"v0:{ timestamp }:{ body }"
+    return "v0=" + hmac.new(key=WEBHOOK_SECRET.encode('utf-8'), msg=message.encode('utf-8'), digestmod=hashlib.sha256).hexdigest()
+
+
+def bench_catalogs(webhook, args):
+    o = webhook.o
+    results = {}
+    for catalog in ('acls', 'themes', 'workflows', 'series'):
+        refresh = getattr(o, f"get_{ catalog }")
+        with Scenario(f"catalog_refresh:{ catalog }", args.trace_memory) as scenario:
+            for _ in range(args.refreshes):
+                #Force a refresh by making the cached copy look empty
+                setattr(o, catalog, None)
+                scenario.time(refresh)
+        results[scenario.name] = scenario.results()
+    return results
+
+
+def bench_webhook(webhook, zoom, args):
+    client = webhook.app.test_client()
+    sent = []
+    with Scenario("webhook", args.trace_memory) as scenario:
+        for uuid in list(zoom.recordings.keys())[:args.webhooks]:
+            body = json.dumps(zoom.webhook_event(uuid))
+            timestamp = str(int(time.time()))
+            headers = {'X-Zm-Signature': sign(body, timestamp), 'X-Zm-Request-Timestamp': timestamp, 'Content-Type': "application/json"}
+            response = scenario.time(client.post, "/webhook", data=body, headers=headers)
+            if response is not None and response.status_code != 200:
+                scenario.errors += 1
+            sent.append((body, headers))
+    results = { scenario.name: scenario.results() }
+    #Zoom's retries of the same events, which should be dropped without any further work
+    with Scenario("webhook:duplicate", args.trace_memory) as scenario:
+        for body, headers in sent:
+            response = scenario.time(client.post, "/webhook", data=body, headers=headers)
+            if response is None or response.status_code != 200 or b"Duplicate" not in response.data:
+                scenario.errors += 1
+    results[scenario.name] = scenario.results()
+    return results
+
+
+def bench_search(webhook, args):
+    client = webhook.app.test_client()
+    queries = [ {'qt': "Benchmark"}, {'qt': "Meeting 1"}, {'qd': "2023-01-01"}, {'qu': "First1"} ]
+    with Scenario("search", args.trace_memory) as scenario:
+        for i in range(args.searches):
+            response = scenario.time(client.get, "/", query_string=queries[i % len(queries)])
+            if response is not None and response.status_code != 200:
+                scenario.errors += 1
+    return { scenario.name: scenario.results() }
+
+
+def bench_pages(webhook, zoom, args):
+    #Full renders of each UI page, ie without the ETag revalidation a browser would do, so this is the worst case
+    client = webhook.app.test_client()
+    uuid = next(iter(zoom.recordings.keys()))
+    user_id = zoom.recordings[uuid]['host_id']
+    pages = {
+        'search': ("/", {'qt': "Benchmark Meeting 1"}),
+        'user_recordings': (f"/recordings/{ user_id }", {}),
+        'recording': (f"/recording/{ urllib.parse.quote(uuid, safe='') }", {}),
+        'create_series': ("/series", {'epid': uuid}),
+    }
+    results = {}
+    for page, (path, query) in pages.items():
+        with Scenario(f"page:{ page }", args.trace_memory) as scenario:
+            for _ in range(args.pages):
+                response = scenario.time(client.get, path, query_string=query)
+                if response is None or response.status_code != 200 or b"<title>Error</title>" in response.data:
+                    scenario.errors += 1
+            if response is not None:
+                scenario.extra['bytes'] = len(response.data)
+        results[scenario.name] = scenario.results()
+    return results
+
+
+def bench_bulk(webhook, zoom, broker, args):
+    #Bulk ingests from the UI, each of args.bulk recordings
+    client = webhook.app.test_client()
+    uuids = list(zoom.recordings.keys())[:args.bulk]
+    form = { f"bulk_{ uuid }": "on" for uuid in uuids }
+    form.update({ 'workflow_id': "bench-workflow", 'acl_id': "", 'dur_check': "False" })
+    queued = broker.messages.qsize()
+    with Scenario("bulk", args.trace_memory) as scenario:
+        for _ in range(5):
+            published = broker.published
+            response = scenario.time(client.post, "/bulk", data=form)
+            if response is None or response.status_code != 302 or broker.published - published != len(uuids):
+                scenario.errors += 1
+        scenario.extra['recordings'] = len(uuids)
+    #Leave the queue as it was for the ingest benchmark
+    kept = [ broker.messages.get_nowait() for _ in range(queued) ]
+    while not broker.messages.empty():
+        broker.messages.get_nowait()
+    for message in kept:
+        broker.messages.put(message)
+    broker.published = queued
+    return { scenario.name: scenario.results() }
+
+
+def bench_process(webhook, zoom, broker, args):
+    o = webhook.o
+    with Scenario("process", args.trace_memory) as scenario:
+        scenario.time(broker.drain, o.rabbit_callback)
+    #Each message is a full ingest, so report per-ingest numbers (from the timings stored on each ingest) rather than
+    #the single drain() call.  Failed ingests are logged and left for a retry rather than raised, so count them here too.
+    dbs = webhook.db.get_session()
+    try:
+        ingests = dbs.query(webhook.db.Ingest).all()
+        scenario.latencies = [ ingest.get_timings()['process'] for ingest in ingests if 'process' in ingest.get_timings() ]
+        finished = len([ ingest for ingest in ingests if ingest.status == webhook.db.Status.FINISHED ])
+    finally:
+        dbs.close()
+    results = scenario.results()
+    results['errors'] += broker.published - finished
+    results['bytes_per_second'] = round(finished * zoom.file_size / scenario.elapsed) if scenario.elapsed > 0 else None
+    return { scenario.name: results }
+
+
+def commit_id():
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        return f"{ sha }-dirty" if dirty else sha
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current, previous_path):
+    with open(previous_path, 'r') as f:
+        previous = json.load(f)
+    print(f"\nCompared to { previous['commit'] } ({ previous['date'] }):")
+    for name, result in current['scenarios'].items():
+        if name not in previous['scenarios']:
+            continue
+        old = previous['scenarios'][name]
+        changes = []
+        for key in ('throughput', 'p50_ms', 'p99_ms', 'peak_memory_bytes'):
+            if result.get(key) and old.get(key):
+                changes.append(f"{ key } { (result[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"  { name:32} { ', '.join(changes) }")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark zoom-ingest against local fakes of Zoom, Opencast and RabbitMQ")
+    parser.add_argument("--recordings", type=int, default=100, help="Number of fake Zoom recordings")
+    parser.add_argument("--users", type=int, default=10, help="Number of fake Zoom users")
+    parser.add_argument("--series", type=int, default=1000, help="Number of fake Opencast series")
+    parser.add_argument("--acls", type=int, default=50, help="Number of fake Opencast ACLs")
+    parser.add_argument("--file-size", type=int, default=1024 * 1024, help="Size of each fake media file, in bytes")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Download bandwidth of the fake Zoom, in bytes per second")
+    parser.add_argument("--refreshes", type=int, default=10, help="Number of times to refresh each catalog")
+    parser.add_argument("--webhooks", type=int, default=None, help="Number of webhook events to send, defaults to all recordings")
+    parser.add_argument("--searches", type=int, default=100, help="Number of searches to run")
+    parser.add_argument("--pages", type=int, default=50, help="Number of times to render each UI page")
+    parser.add_argument("--bulk", type=int, default=50, help="Number of recordings in each bulk ingest")
+    parser.add_argument("--ingests", type=int, default=None, help="Number of queued ingests to process, defaults to all")
+    parser.add_argument("--no-memory", dest="trace_memory", action="store_false", help="Do not trace memory use, which slows things down")
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench", "results"), help="Directory to save the results in")
+    parser.add_argument("--compare", default=None, help="A previous results file to compare against")
+    args = parser.parse_args()
+    if args.webhooks is None:
+        args.webhooks = args.recordings
+
+    zoom = FakeZoom(recordings=args.recordings, users=args.users, file_size=args.file_size, bandwidth=args.bandwidth).start()
+    opencast = FakeOpencast(series=args.series, acls=args.acls).start()
+    workdir = tempfile.mkdtemp(prefix="zingest-bench-")
+    cwd = os.getcwd()
+    try:
+        write_settings(workdir, zoom, opencast)
+        #The webhook reads its configuration relative to the working directory when it is imported
+        os.chdir(workdir)
+        webhook = importlib.import_module("webhook")
+        logging.getLogger().setLevel(logging.WARNING)
+        broker = FakeBroker().install(webhook.r)
+
+        results = {}
+        results.update(bench_catalogs(webhook, args))
+        results.update(bench_webhook(webhook, zoom, args))
+        results.update(bench_search(webhook, args))
+        results.update(bench_pages(webhook, zoom, args))
+        results.update(bench_bulk(webhook, zoom, broker, args))
+        if args.ingests is not None:
+            #Drop everything past the requested number of ingests
+            kept = [ broker.messages.get_nowait() for _ in range(min(args.ingests, broker.messages.qsize())) ]
+            while not broker.messages.empty():
+                broker.messages.get_nowait()
+            for message in kept:
+                broker.messages.put(message)
+            broker.published = len(kept)
+        results.update(bench_process(webhook, zoom, broker, args))
+    finally:
+        os.chdir(cwd)
+        zoom.stop()
+        opencast.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': commit_id(),
+        'date': datetime.utcnow().isoformat(timespec='seconds') + "Z",
+        'python': platform.python_version(),
+        'parameters': { key: value for key, value in vars(args).items() if key not in ('output', 'compare') },
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'scenarios': results,
+    }
+    print(f"{ 'scenario':32} { 'count':>6} { 'errors':>6} { 'ops/s':>9} { 'p50 ms':>9} { 'p90 ms':>9} { 'p99 ms':>9} { 'peak mem':>11}")
+    for name, result in results.items():
+        def fmt(key):
+            return "-" if result.get(key) is None else str(result[key])
+        print(f"{ name:32} { fmt('count'):>6} { fmt('errors'):>6} { fmt('throughput'):>9} { fmt('p50_ms'):>9} { fmt('p90_ms'):>9} { fmt('p99_ms'):>9} { fmt('peak_memory_bytes'):>11}")
+
+    os.makedirs(args.output, exist_ok=True)
+    output = os.path.join(args.output, f"{ report['commit'] }.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to { output }")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Load generator for the webhook endpoint of a running zoom-ingest instance.
+
+Replays a recording.completed event (by default the one in test/resources) with a valid X-Zm-Signature, at a fixed
+concurrency, and reports the latency of each request split into the parts the webhook reports in its Server-Timing
+header: HMAC verification, payload validation, database work, Zoom API calls and publishing to RabbitMQ.
+
+eg:
+    python bench/webhook_load.py --url http://localhost:8000/webhook --secret <webhook secret> --concurrency 16 --requests 2000
+
+NB: Unless --unique is given every request carries the same recording, so only the first one creates an ingest and
+the rest exercise the duplicate detection.  With --unique each request gets a new uuid, which the instance will then
+try to look up in Zoom, so only use that against a fake Zoom (see run.py) or a test account.
+"""
+import argparse
+import copy
+import hashlib
+import hmac
+import json
+import os.path
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_PAYLOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "resources", "zoom", "webhook-recording-completed.json")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def parse_server_timing(header):
+    durations = {}
+    if not header:
+        return durations
+    for entry in header.split(","):
+        parts = [ part.strip() for part in entry.split(";") ]
+        name = parts[0]
+        for part in parts[1:]:
+            if part.startswith("dur="):
+                durations[name] = float(part[4:])
+    return durations
+
+
+def group(name):
+    #Collapse the individual Zoom API calls, eg zoom-RecordingComponentV2.get, into one bucket
+    if name.startswith("zoom-"):
+        return "zoom"
+    if name == "rabbit_publish":
+        return "publish"
+    return name
+
+
+class LoadGenerator:
+
+    def __init__(self, url, secret, payload, unique=False, timeout=30):
+        self.url = url
+        self.secret = secret
+        self.payload = payload
+        self.unique = unique
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.latencies = []
+        self.parts = defaultdict(list)
+        self.statuses = Counter()
+
+    def _session(self):
+        #One connection pool per worker thread
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _body(self):
+        #Shallow copy, since the event is shared between all of the worker threads
+        event = dict(self.payload)
+        if self.unique:
+            with self.lock:
+                self.sequence += 1
+                sequence = self.sequence
+            event = copy.deepcopy(self.payload)
+            event['payload']['object']['uuid'] = f"load{ sequence:08d}{ int(time.time()) % 100000:05d}=="
+        event['event_ts'] = int(time.time() * 1000)
+        return json.dumps(event)
+
+    def sign(self, body, timestamp):
+        message = f"v0:{ timestamp }:{ body }"
+        return "v0=" + hmac.new(key=self.secret.encode('utf-8'), msg=message.encode('utf-8'), digestmod=hashlib.sha256).hexdigest()
+
+    def send(self):
+        body = self._body()
+        timestamp = str(int(time.time()))
+        headers = {'Content-Type': "application/json", 'X-Zm-Request-Timestamp': timestamp}
+        if self.secret:
+            headers['X-Zm-Signature'] = self.sign(body, timestamp)
+        else:
+            #The instance only checks this if it has a secret configured, but the header must be present
+            headers['X-Zm-Signature'] = ""
+        start = time.perf_counter()
+        try:
+            response = self._session().post(self.url, data=body.encode('utf-8'), headers=headers, timeout=self.timeout)
+            status = response.status_code
+            server = parse_server_timing(response.headers.get('Server-Timing', None))
+        except requests.RequestException as e:
+            status = type(e).__name__
+            server = {}
+        elapsed = (time.perf_counter() - start) * 1000
+        parts = defaultdict(float)
+        for name, duration in server.items():
+            parts[group(name)] += duration
+        #Whatever the server didn't account for is framework, network and queueing time
+        parts['other'] = max(elapsed - sum(parts.values()), 0)
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.statuses[status] += 1
+            for name, duration in parts.items():
+                self.parts[name].append(duration)
+
+    def run(self, concurrency, count=None, duration=None):
+        deadline = time.perf_counter() + duration if duration else None
+        sent = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            def worker():
+                nonlocal sent
+                while True:
+                    with self.lock:
+                        if count is not None and sent >= count:
+                            return
+                        sent += 1
+                    if deadline and time.perf_counter() > deadline:
+                        return
+                    self.send()
+            for future in [ pool.submit(worker) for _ in range(concurrency) ]:
+                future.result()
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        def summary(values):
+            return {
+                'mean_ms': round(sum(values) / len(values), 3) if values else None,
+                'p50_ms': round(percentile(values, 50), 3) if values else None,
+                'p90_ms': round(percentile(values, 90), 3) if values else None,
+                'p99_ms': round(percentile(values, 99), 3) if values else None,
+                'max_ms': round(max(values), 3) if values else None,
+            }
+        return {
+            'requests': len(self.latencies),
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(self.latencies) / elapsed, 2) if elapsed > 0 else None,
+            'statuses': { str(status): count for status, count in self.statuses.items() },
+            'total': summary(self.latencies),
+            'parts': { name: summary(values) for name, values in sorted(self.parts.items()) },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay signed Zoom webhook events against a running zoom-ingest instance")
+    parser.add_argument("--url", required=True, help="The webhook URL, eg http://localhost:8000/webhook")
+    parser.add_argument("--secret", default="", help="The webhook secret configured in the instance's settings.ini")
+    parser.add_argument("--payload", default=DEFAULT_PAYLOAD, help="The webhook event to replay")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of requests in flight at once")
+    parser.add_argument("--requests", type=int, default=None, help="Total number of requests to send")
+    parser.add_argument("--duration", type=float, default=None, help="Or, send requests for this many seconds")
+    parser.add_argument("--unique", action="store_true", help="Give every request its own recording uuid")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    if args.requests is None and args.duration is None:
+        args.requests = 1000
+
+    with open(args.payload, 'r') as f:
+        payload = json.load(f)
+    generator = LoadGenerator(args.url, args.secret, payload, unique=args.unique)
+    report = generator.report(generator.run(args.concurrency, count=args.requests, duration=args.duration))
+    report['concurrency'] = args.concurrency
+
+    print(f"{ report['requests'] } requests in { report['seconds'] }s at concurrency { args.concurrency }: { report['requests_per_second'] } req/s")
+    print(f"Responses: { ', '.join([ f'{ status }: { count }' for status, count in report['statuses'].items() ]) }")
+    print(f"{ '':10} { 'mean ms':>9} { 'p50 ms':>9} { 'p90 ms':>9} { 'p99 ms':>9} { 'max ms':>9}")
+    for name, summary in [ ('total', report['total']) ] + list(report['parts'].items()):
+        print(f"{ name:10} " + " ".join([ f"{ summary[key]:>9}" for key in ('mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms') ]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,3 +25,12 @@ timeout = 200
 # Preload to run a single copy of the background tasks, rather than
 # multiple (conflicting) copies
 preload = True
+
+# Clean up the Prometheus metrics of workers which have exited.
+# This only matters if PROMETHEUS_MULTIPROC_DIR is set, which is required
+# for /metrics to aggregate across workers
+def child_exit(server, worker):
+    import os
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
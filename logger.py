@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
-import logging, logging.config
+import atexit
+import copy
+import logging, logging.config, logging.handlers
+import os
+import queue
 import sys
+import threading
+import time
+import traceback
 from os.path import isfile
 
+#(logger, the QueueHandler which replaced its handlers, those handlers, the QueueListener feeding them)
+_pipelines = []
+
 
 def init_logger():
     """
     Initialize logger, load logger configuration.
+
+    Once configured, each logger's handlers are moved behind a queue and run on a background thread (see
+    _queue_handlers()), so that logging never blocks the caller on a slow disk or mail server.
     """
+    stop_logger()
     if isfile("etc/zoom-ingest/logger.ini"):
         logging.config.fileConfig('etc/zoom-ingest/logger.ini')
     else:
@@ -16,4 +30,203 @@ def init_logger():
                             handlers=[console_handler],
                             format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
                             datefmt="%Y-%m-%d %H:%M:%S")
+    _queue_handlers()
+
+
+def stop_logger():
+    """
+    Process anything still queued, then put the real handlers back on their loggers.
+    """
+    while _pipelines:
+        logger, queue_handler, handlers, listener = _pipelines.pop()
+        listener.stop()
+        logger.removeHandler(queue_handler)
+        for handler in handlers:
+            logger.addHandler(handler)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        #Unlike the default this leaves the exception info in place, rather than formatting the traceback here: the
+        #records never leave this process, so they don't need to be pickleable, and this keeps the formatting off the
+        #calling thread too
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _queue_handlers():
+    loggers = [ logging.getLogger() ] + [ logger for logger in logging.Logger.manager.loggerDict.values() if isinstance(logger, logging.Logger) ]
+    for logger in loggers:
+        handlers = list(logger.handlers)
+        if len(handlers) == 0 or any(isinstance(handler, _QueueHandler) for handler in handlers):
+            continue
+        #Each logger gets its own queue, so that records only reach that logger's handlers (ie, only the mail logger's
+        #records are emailed)
+        queue_handler = _QueueHandler(queue.SimpleQueue())
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _pipelines.append((logger, queue_handler, handlers, listener))
+
+
+def _restart_after_fork():
+    #gunicorn imports the app before forking its workers (--preload), and threads don't survive a fork, so each worker
+    #needs its own listeners.  The queues are replaced too, since the parent's might have been locked mid-fork.
+    for index, (logger, queue_handler, handlers, listener) in enumerate(_pipelines):
+        queue_handler.queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _pipelines[index] = (logger, queue_handler, handlers, listener)
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+#NB: This runs before logging's own shutdown handler, which closes (and so flushes) the handlers
+atexit.register(stop_logger)
+
+
+class DigestSMTPHandler(logging.handlers.SMTPHandler):
+    """
+    An SMTPHandler which batches records into digests, rather than sending an email per record.
+
+    The first record is sent straight away, after which anything else is collected for interval seconds and sent as a
+    single email.  Within a digest repeats are grouped, by logger, level and the exception (or, if there isn't one, the
+    first line of the message), so an outage which fails hundreds of ingests in the same way is one entry with a count,
+    some example messages and a single traceback.  At most max_groups distinct groups are kept, anything further is
+    only counted.
+
+    Configure it in logger.ini as with SMTPHandler, with two extra (optional) arguments:
+        class=logger.DigestSMTPHandler
+        args=(mailhost, fromaddr, toaddrs, subject, credentials, secure, timeout, interval, max_groups)
+    """
+
+    EXAMPLES = 5
+
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None, secure=None, timeout=5.0, interval=300, max_groups=50):
+        super().__init__(mailhost, fromaddr, toaddrs, subject, credentials=credentials, secure=secure, timeout=timeout)
+        self.interval = float(interval)
+        self.max_groups = int(max_groups)
+        self.digest_lock = threading.Lock()
+        self.groups = {}
+        self.overflow = 0
+        self.last_sent = 0
+        self.pid = os.getpid()
+        self.wakeup = threading.Event()
+        self.flusher = None
+        self.closed = False
+
+    def _summarise(self, record):
+        lines = record.getMessage().strip().splitlines() or [ "" ]
+        if record.exc_info and record.exc_info[0]:
+            summary = traceback.format_exception_only(record.exc_info[0], record.exc_info[1])[-1].strip()
+        elif len(lines) > 1 and lines[1].startswith("Traceback"):
+            #A record which was formatted before it reached us, the exception is the last line
+            summary = lines[-1]
+        else:
+            summary = lines[0]
+        return (record.name, record.levelname, summary), lines[0]
+
+    def emit(self, record):
+        try:
+            key, example = self._summarise(record)
+            with self.digest_lock:
+                if self.pid != os.getpid():
+                    #A forked child starts with a copy of its parent's digest, which is the parent's to send
+                    self.pid = os.getpid()
+                    self.groups = {}
+                    self.overflow = 0
+                group = self.groups.get(key, None)
+                if group is None:
+                    if len(self.groups) >= self.max_groups:
+                        self.overflow += 1
+                        return
+                    group = { 'count': 0, 'first': record.created, 'examples': [], 'detail': self.format(record) }
+                    self.groups[key] = group
+                group['count'] += 1
+                group['last'] = record.created
+                if len(group['examples']) < self.EXAMPLES and example not in group['examples']:
+                    group['examples'].append(example)
+            self._start_flusher()
+            self.wakeup.set()
+        except Exception:
+            self.handleError(record)
+
+    def _start_flusher(self):
+        if self.closed or (self.flusher and self.flusher.is_alive()):
+            return
+        self.flusher = threading.Thread(target=self._flush_loop, name="log-digest", daemon=True)
+        self.flusher.start()
+
+    def _flush_loop(self):
+        while not self.closed:
+            with self.digest_lock:
+                pending = len(self.groups) > 0 or self.overflow > 0
+            delay = max(self.last_sent + self.interval - time.time(), 0) if pending else None
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+            if not self.closed and time.time() >= self.last_sent + self.interval:
+                self.flush()
+
+    def flush(self):
+        with self.digest_lock:
+            groups, overflow = self.groups, self.overflow
+            self.groups, self.overflow = {}, 0
+        if len(groups) == 0 and overflow == 0:
+            return
+        self.last_sent = time.time()
+        total = sum(group['count'] for group in groups.values()) + overflow
+        subject = self.subject if total == 1 else f"{ self.subject } ({ total } errors)"
+        try:
+            self._send(subject, self._render(groups, overflow))
+        except Exception:
+            sys.stderr.write(f"Unable to send a digest of { total } log records by email:\n{ traceback.format_exc() }")
+
+    def _render(self, groups, overflow):
+        sections = []
+        for (name, level, summary), group in sorted(groups.items(), key=lambda item: item[1]['first']):
+            first = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(group['first']))
+            last = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(group['last']))
+            lines = [ f"{ group['count'] }x { level } { name }: { summary }", f"First at { first }, last at { last }" ]
+            if group['count'] > 1:
+                lines.append("Examples:")
+                lines.extend([ f"  { example }" for example in group['examples'] ])
+            lines.extend([ "", group['detail'] ])
+            sections.append("\n".join(lines))
+        if overflow > 0:
+            sections.append(f"...and { overflow } more records which did not match any of the above")
+        return ("\n\n" + "-" * 72 + "\n\n").join(sections)
+
+    def _send(self, subject, body):
+        #As SMTPHandler.emit(), but for a digest rather than a single record
+        import smtplib
+        from email.message import EmailMessage
+        import email.utils
+
+        port = self.mailport
+        if not port:
+            port = smtplib.SMTP_PORT
+        smtp = smtplib.SMTP(self.mailhost, port, timeout=self.timeout)
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Subject'] = subject
+        msg['Date'] = email.utils.localtime()
+        msg.set_content(body)
+        if self.username:
+            if self.secure is not None:
+                smtp.ehlo()
+                smtp.starttls(*self.secure)
+                smtp.ehlo()
+            smtp.login(self.username, self.password)
+        smtp.send_message(msg)
+        smtp.quit()
 
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+        super().close()
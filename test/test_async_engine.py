@@ -0,0 +1,220 @@
+import asyncio
+import copy
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from urllib.parse import unquote
+
+import httpx
+import requests_mock
+
+import zingest.db
+from logger import init_logger
+from zingest.async_engine import AsyncIngestEngine
+from zingest.async_opencast import AsyncOpencast
+from zingest.async_zoom import AsyncZoom
+from zingest.opencast import Opencast
+from zingest.rabbit import Rabbit
+from zingest.zoom import Zoom
+
+recording_info = None
+with open('test/resources/zoom/get-recording.json', 'r') as info:
+    recording_info = json.loads(info.read())
+rabbit_msg = None
+with open('test/resources/internal/rabbit_msg.json', 'r') as rabbit:
+    rabbit_msg = rabbit.read()
+catalogs = {}
+for name in ("acls", "themes", "workflows", "series"):
+    with open(f'test/resources/opencast/{ name }.json', 'r') as catalog:
+        catalogs[name] = catalog.read()
+ingest = dict()
+for event in ("add-dc", "add-security", "add-track", "create-mp", "ingest"):
+    with open(f'test/resources/opencast/{ event }.xml', 'r') as xml:
+        ingest[event] = xml.read()
+
+init_logger()
+
+
+class TestAsyncIngestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.statusdir = tempfile.mkdtemp()
+        self.config = {"Opencast": {"Url": "http://localhost", "User": "test_user", "Password": "test_password", 'workflow_filter': None, 'series_filter': None},
+                       "Rabbit": {"host": "http://localhost", "user": "test_user", "password": "test_password" },
+                       "Zoom": {"oauth_account_id": "test_acount_id",
+                                "oauth_client_id": "test_client_id",
+                                "oauth_client_secret": "test_client_secret",
+                                "GDPR": "False" },
+                       "Progress": {"path": self.statusdir},
+                       "TESTING": {"IN_PROGRESS_ROOT": self.tempdir}}
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.zoom = Zoom(self.config)
+        with requests_mock.Mocker() as mocker:
+            mocker.get('//localhost/acl-manager/acl/acls.json', text=catalogs['acls'])
+            mocker.get('//localhost/admin-ng/themes/themes.json?limit=100', text=catalogs['themes'])
+            mocker.get(re.compile("//localhost/api/workflow-definitions"), text=catalogs['workflows'])
+            mocker.get('//localhost/api/series/series.json?count=100', text=catalogs['series'])
+            self.opencast = Opencast(self.config, Rabbit(self.config, self.zoom), self.zoom)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+        shutil.rmtree(self.tempdir)
+        shutil.rmtree(self.statusdir)
+
+    def add_recording(self, uuid):
+        recording = copy.deepcopy(recording_info)
+        recording['uuid'] = uuid
+        for recording_file in recording['recording_files']:
+            recording_file['id'] = f"{ uuid }-{ recording_file['id'] }"
+            recording_file['recording_id'] = recording_file['id']
+        self.zoom._create_recording_from_data(recording)
+        zingest.db.create_ingest(uuid, {"workflow_id": "schedule-and-upload", "acl_id": "1101"}, released=datetime.utcnow())
+        return recording
+
+    async def handler(self, request):
+        path = request.url.path
+        if path == "/oauth/token":
+            return httpx.Response(200, json={"access_token": "token", "expires_in": 3599})
+        self.requests.append(path)
+        if path.startswith("/v2/meetings/"):
+            uuid = unquote(path.split("/")[3])
+            return httpx.Response(200, json=self.recordings[uuid])
+        if path.startswith("/rec/download/"):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await asyncio.sleep(0.02)
+            finally:
+                self.in_flight -= 1
+            return httpx.Response(200, content=b"")
+        if path == "/ingest/createMediaPackage":
+            return httpx.Response(200, text=ingest['create-mp'])
+        if path == "/ingest/addDCCatalog":
+            return httpx.Response(200, text=ingest['add-dc'])
+        if path == "/ingest/addAttachment":
+            return httpx.Response(200, text=ingest['add-security'])
+        if path == "/ingest/addTrack":
+            return httpx.Response(200, text=ingest['add-track'])
+        if path.startswith("/ingest/ingest/"):
+            return httpx.Response(200, text=ingest['ingest'])
+        return httpx.Response(404)
+
+    def engine(self, concurrency=None):
+        transport = httpx.MockTransport(self.handler)
+        zoom = AsyncZoom(self.config, transport=transport)
+        transfers = AsyncOpencast(self.opencast, zoom, transport=transport)
+        return AsyncIngestEngine(self.config, self.opencast, concurrency=concurrency, zoom=zoom, transfers=transfers)
+
+    def run_engine(self, engine, coroutine_fn):
+        async def run():
+            engine.slots = asyncio.Semaphore(engine.concurrency)
+            async with engine.zoom, engine.transfers:
+                return await coroutine_fn()
+        return asyncio.run(run())
+
+    def get_ingests(self):
+        dbs = zingest.db.get_session()
+        try:
+            return dbs.query(zingest.db.Ingest).order_by(zingest.db.Ingest.ingest_id).all()
+        finally:
+            dbs.close()
+
+    def test_handleMessage(self):
+        self.recordings = { recording_info['uuid']: self.add_recording(recording_info['uuid']) }
+        engine = self.engine()
+
+        self.run_engine(engine, lambda: engine.handle_message(rabbit_msg))
+
+        self.assertEqual(1, len([ path for path in self.requests if path.startswith("/rec/download/") ]))
+        self.assertEqual(1, self.requests.count("/ingest/createMediaPackage"))
+        self.assertEqual(2, self.requests.count("/ingest/addDCCatalog"))
+        self.assertEqual(1, self.requests.count("/ingest/addTrack"))
+        self.assertEqual(1, len([ path for path in self.requests if path.startswith("/ingest/ingest/") ]))
+        record = self.get_ingests()[0]
+        self.assertEqual(zingest.db.Status.FINISHED, record.status)
+        self.assertEqual("b1d7f8d2-91fd-4710-8c63-17e3e14749a9", record.get_mediapackage_id())
+        self.assertEqual("5267", record.get_workflow_id())
+        self.assertEqual([], record.get_completed_steps())
+        for stage in ('process', 'zoom_metadata', 'download', 'oc_upload:create', 'oc_upload:presentation/source', 'oc_upload:ingest'):
+            self.assertTrue(stage in record.get_timings(), f"{ stage } missing from { record.get_timings() }")
+        self.assertEqual("finished", self.opencast.progress_store.read(record.get_id())['state'])
+        #The downloaded media is cleaned up afterwards
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_finishedIngestIsNotRepeated(self):
+        self.recordings = { recording_info['uuid']: self.add_recording(recording_info['uuid']) }
+        engine = self.engine()
+
+        self.run_engine(engine, lambda: engine.handle_message(rabbit_msg))
+        count = len(self.requests)
+        self.run_engine(engine, lambda: engine.handle_message(rabbit_msg))
+
+        self.assertEqual(count, len(self.requests))
+
+    def test_heldIngestIsNotStarted(self):
+        self.recordings = { recording_info['uuid']: self.add_recording(recording_info['uuid']) }
+        dbs = zingest.db.get_session()
+        try:
+            #ie, a duplicate message for an ingest which is waiting to be retried
+            dbs.query(zingest.db.Ingest).one().released = None
+            dbs.commit()
+        finally:
+            dbs.close()
+        engine = self.engine()
+
+        self.run_engine(engine, lambda: engine.handle_message(rabbit_msg))
+
+        self.assertEqual([], self.requests)
+        self.assertEqual(zingest.db.Status.NEW, self.get_ingests()[0].status)
+
+    def test_createFailureAbandonsDownloads(self):
+        self.recordings = { recording_info['uuid']: self.add_recording(recording_info['uuid']) }
+        handler = self.handler
+        async def failing_handler(request):
+            if request.url.path == "/ingest/createMediaPackage":
+                return httpx.Response(500, text="Internal Server Error")
+            return await handler(request)
+        self.handler = failing_handler
+        engine = self.engine()
+
+        self.run_engine(engine, lambda: engine.handle_message(rabbit_msg))
+
+        self.assertEqual(0, self.requests.count("/ingest/addTrack"))
+        record = self.get_ingests()[0]
+        self.assertEqual(zingest.db.Status.NEW, record.status)
+        self.assertEqual(1, record.attempts)
+        #Whatever was downloaded anyway has been cleaned up
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_boundedConcurrency(self):
+        self.recordings = {}
+        for i in range(6):
+            uuid = f"recording{ i }AAAAAAAAAAAA=="
+            self.recordings[uuid] = self.add_recording(uuid)
+        engine = self.engine(concurrency=2)
+
+        async def run_all():
+            await asyncio.gather(*[ engine.process(record.get_id()) for record in self.get_ingests() ])
+        self.run_engine(engine, run_all)
+
+        self.assertEqual(2, self.max_in_flight)
+        self.assertEqual([ zingest.db.Status.FINISHED ] * 6, [ record.status for record in self.get_ingests() ])
+        self.assertEqual(set(), engine.active)
+
+    def test_concurrencyFromConfig(self):
+        self.config["Uploader"] = {"concurrency": "7"}
+        engine = AsyncIngestEngine(self.config, self.opencast)
+        self.assertEqual(7, engine.concurrency)
+        del self.config["Uploader"]
+        engine = AsyncIngestEngine(self.config, self.opencast)
+        self.assertEqual(AsyncIngestEngine.DEFAULT_CONCURRENCY, engine.concurrency)
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+import httpx
+import zingest.db
+from zingest.async_zoom import AsyncZoom
+
+recording_info = None
+with open('test/resources/zoom/get-recording.json', 'r') as info:
+    recording_info = json.loads(info.read())
+user_info = None
+with open('test/resources/zoom/get-single-user.json', 'r') as info:
+    user_info = json.loads(info.read())
+
+
+class TestAsyncZoom(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {"Zoom": {"oauth_account_id": "test_acount_id",
+                                "oauth_client_id": "test_client_id",
+                                "oauth_client_secret": "test_client_secret",
+                                "GDPR": "False" }}
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.tokens = 0
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    async def handler(self, request):
+        if request.url.path == "/oauth/token":
+            self.tokens += 1
+            return httpx.Response(200, json={"access_token": f"token{ self.tokens }", "expires_in": 3599})
+        self.requests.append(request)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        if request.url.path.startswith("/v2/meetings/"):
+            return httpx.Response(200, json=dict(recording_info, topic="Zero\u200bwidth"))
+        if request.url.path.startswith("/v2/users/"):
+            return httpx.Response(200, json=user_info)
+        return httpx.Response(404, json={})
+
+    def zoom(self, handler=None, **kwargs):
+        return AsyncZoom(self.config, transport=httpx.MockTransport(handler or self.handler), **kwargs)
+
+    def test_getRecording(self):
+        async def run():
+            async with self.zoom() as zoom:
+                return await zoom.get_recording("Yaxg95jbQyiQbTYP57GqSg==")
+        recording = asyncio.run(run())
+        self.assertEqual("Zerowidth", recording["topic"])
+        self.assertEqual("Bearer token1", self.requests[0].headers["Authorization"])
+        self.assertEqual("/v2/meetings/Yaxg95jbQyiQbTYP57GqSg==/recordings", self.requests[0].url.path)
+
+    def test_doubleEncodedRecordingId(self):
+        async def run():
+            async with self.zoom() as zoom:
+                await zoom.get_recording("/abc//def")
+        asyncio.run(run())
+        self.assertEqual(b"/v2/meetings/%252Fabc%252F%252Fdef/recordings", self.requests[0].url.raw_path)
+
+    def test_boundedConcurrencyAndSharedToken(self):
+        async def run():
+            async with self.zoom(max_concurrency=3) as zoom:
+                return await zoom.get_recordings([ f"recording{ i }" for i in range(20) ])
+        recordings = asyncio.run(run())
+        self.assertEqual(20, len(recordings))
+        self.assertEqual(1, self.tokens)
+        self.assertEqual(3, self.max_in_flight)
+
+    def test_refreshOnUnauthorized(self):
+        async def handler(request):
+            if request.url.path != "/oauth/token" and request.headers["Authorization"] == "Bearer token1":
+                return httpx.Response(401, json={})
+            return await self.handler(request)
+        async def run():
+            async with self.zoom(handler) as zoom:
+                return await zoom.search_user("test")
+        with self.assertRaises(httpx.HTTPStatusError):
+            #The retry gets through, and hits our 404 for unknown paths
+            asyncio.run(run())
+        self.assertEqual(2, self.tokens)
+        self.assertEqual("Bearer token2", self.requests[0].headers["Authorization"])
+
+    def test_getUsersStoresInDb(self):
+        async def run():
+            async with self.zoom() as zoom:
+                return await zoom.get_users([ user_info["id"], user_info["id"] ])
+        users = asyncio.run(run())
+        self.assertEqual([ user_info["id"] ], list(users.keys()))
+        self.assertEqual(1, len(self.requests))
+        self.assertIsNotNone(zingest.db.find_user_by_id_or_email(user_info["id"]))
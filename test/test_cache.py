@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from zingest.cache import MediaCache
+
+
+class TestMediaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, cache, file_id, size, release=True):
+        temp = cache.temp_path(file_id, "MP4")
+        with open(temp, 'wb') as f:
+            f.write(b"x" * size)
+        path = cache.put(file_id, size, "MP4", temp)
+        if release:
+            #ie, the ingest has finished with it
+            cache.release(path)
+        return path
+
+    def test_noConfig(self):
+        self.assertIsNone(MediaCache.from_config({}))
+        self.assertIsNone(MediaCache.from_config({"Cache": {"path": ""}}))
+
+    def test_goodConfig(self):
+        cache = MediaCache.from_config({"Cache": {"path": self.cachedir, "max_bytes": "1234"}})
+        self.assertEqual(self.cachedir, cache.path)
+        self.assertEqual(1234, cache.max_bytes)
+        self.assertTrue(os.path.isdir(self.cachedir))
+
+    def test_miss(self):
+        cache = MediaCache(self.cachedir, 100)
+        self.assertIsNone(cache.get("abc", 10, "MP4"))
+
+    def test_putThenGet(self):
+        cache = MediaCache(self.cachedir, 100)
+        path = self.write(cache, "abc", 10)
+        self.assertEqual(path, cache.get("abc", 10, "mp4"))
+        #Different size, different key
+        self.assertIsNone(cache.get("abc", 11, "MP4"))
+        #No temporary files are left behind
+        self.assertEqual([ os.path.basename(path) ], os.listdir(self.cachedir))
+
+    def test_putFromOutside(self):
+        cache = MediaCache(self.cachedir, 100)
+        source = os.path.join(self.tempdir, "outside.mp4")
+        with open(source, 'wb') as f:
+            f.write(b"x" * 10)
+        path = cache.put("abc", 10, "MP4", source)
+        self.assertTrue(cache.contains(path))
+        self.assertFalse(os.path.isfile(source))
+
+    def test_lruEviction(self):
+        cache = MediaCache(self.cachedir, 25)
+        first = self.write(cache, "first", 10)
+        second = self.write(cache, "second", 10)
+        #Make sure first is older, then touch it so that second is the least recently used
+        old = time.time() - 100
+        os.utime(first, (old, old))
+        os.utime(second, (old + 1, old + 1))
+        cache.release(cache.get("first", 10, "MP4"))
+        third = self.write(cache, "third", 10)
+        self.assertTrue(os.path.isfile(first))
+        self.assertFalse(os.path.isfile(second))
+        self.assertTrue(os.path.isfile(third))
+        self.assertTrue(cache.size() <= 25)
+
+    def test_newEntryNeverEvicted(self):
+        cache = MediaCache(self.cachedir, 5)
+        path = self.write(cache, "big", 10, release=False)
+        self.assertTrue(os.path.isfile(path))
+
+    def test_leasedEntriesNotEvicted(self):
+        cache = MediaCache(self.cachedir, 15)
+        #Still being uploaded by one ingest
+        held = self.write(cache, "held", 10, release=False)
+        old = time.time() - 100
+        os.utime(held, (old, old))
+        #Another ingest's download would push it out
+        other = self.write(cache, "other", 10, release=False)
+        self.assertTrue(os.path.isfile(held))
+        cache.release(other)
+        #A cache hit is leased too
+        self.assertEqual(held, cache.get("held", 10, "MP4"))
+        cache.release(held)
+        os.utime(held, (old, old))
+        self.write(cache, "third", 10)
+        self.assertTrue(os.path.isfile(held))
+        #Once every lease is given up it's evicted like anything else
+        cache.release(held)
+        cache.evict()
+        self.assertFalse(os.path.isfile(held))
@@ -0,0 +1,75 @@
+import json
+import unittest
+
+from zingest.catalogs import CatalogIndex
+
+
+class TestCatalogIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.series = {
+            "s1": "Biology 101 (2023) (Smith)",
+            "s2": "biochemistry (2022)",
+            "s3": "Chemistry (2021)",
+            "s4": "Bio (2020)",
+            "s5": "Chemistry (2021)",
+        }
+
+    def test_prefixSearch(self):
+        index = CatalogIndex("series").update(self.series)
+        entries, total = index.search("bio")
+        self.assertEqual(3, total)
+        self.assertEqual([ "s4", "s2", "s1" ], [ key for _, key in entries ])
+        entries, total = index.search("BIOL")
+        self.assertEqual([ ("Biology 101 (2023) (Smith)", "s1") ], entries)
+        self.assertEqual(([], 0), index.search("physics"))
+
+    def test_everythingAndLimit(self):
+        index = CatalogIndex("series").update(self.series)
+        entries, total = index.search("", limit=2)
+        self.assertEqual(5, total)
+        self.assertEqual(2, len(entries))
+        entries, total = index.search("", limit=0)
+        self.assertEqual(5, len(entries))
+
+    def test_exactId(self):
+        index = CatalogIndex("series").update(self.series)
+        entries, total = index.search("s3")
+        self.assertEqual([ ("Chemistry (2021)", "s3") ], entries)
+        self.assertEqual(1, total)
+        self.assertEqual("Chemistry (2021)", index.get_label("s3"))
+        self.assertIsNone(index.get_label(None))
+
+    def test_labels(self):
+        acls = { 1101: { "name": "Public", "acl": [] }, 1102: { "name": "Private", "acl": [] } }
+        index = CatalogIndex("acls", label=lambda acl: acl['name']).update(acls)
+        self.assertEqual([ ("Private", "1102"), ("Public", "1101") ], index.search("p")[0])
+        rendered = json.loads(index.render("pub", 50))
+        self.assertEqual({ "catalog": "acls", "version": index.version, "total": 1, "results": [ { "id": "1101", "label": "Public" } ] }, rendered)
+
+    def test_versioning(self):
+        index = CatalogIndex("series").update(self.series)
+        version = index.version
+        etag = index.etag("bio")
+        self.assertNotEqual(etag, index.etag("bi"))
+        self.assertNotEqual(etag, index.etag("bio", 10))
+        #The same contents, even in a new dict, is the same version
+        self.assertEqual(version, index.update(dict(self.series)).version)
+        self.assertEqual(etag, index.etag("bio"))
+        #Additions, ie a series found by get_single_series, are picked up without a refresh
+        self.series["s6"] = "Biophysics (2024)"
+        index.update(self.series)
+        self.assertNotEqual(version, index.version)
+        self.assertEqual(4, json.loads(index.render("bio", 50))['total'])
+
+    def test_options(self):
+        self.series["s6"] = "<Bio> & friends"
+        index = CatalogIndex("series").update(self.series)
+        options = index.options()
+        self.assertTrue('<option value="s6">&lt;Bio&gt; &amp; friends</option>' in options)
+        self.assertEqual(6, options.count("<option "))
+        #Rendered once per version
+        self.assertIs(options, index.options())
+        self.series["s7"] = "Zoology (2024)"
+        index.update(self.series)
+        self.assertEqual(7, index.options().count("<option "))
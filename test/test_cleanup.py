@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from requests import HTTPError
+
+import zingest.db
+from zingest.cleanup import ZoomCleaner
+
+recording_info = None
+with open('test/resources/zoom/get-recording.json', 'r') as info:
+    recording_info = json.loads(info.read())
+
+
+class TestZoomCleaner(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        zingest.db.create_recording(recording_info)
+        self.uuid = recording_info['uuid']
+        self.zoom = MagicMock()
+        self.cleaner = ZoomCleaner(self.zoom, batch_size=2, rate=0)
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def create_ingest(self, uuid=None, status=zingest.db.Status.FINISHED, workflow_state='SUCCEEDED', verified=True):
+        ingest_id = zingest.db.create_ingest(uuid if uuid else self.uuid, {})
+        dbs = zingest.db.get_session()
+        try:
+            ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+            ingest.update_status(status)
+            if workflow_state:
+                ingest.set_workflow_id(str(ingest_id))
+                ingest.set_workflow_state(workflow_state)
+            if verified:
+                ingest.set_verified_files([ { 'id': 'file', 'type': 'shared_screen', 'size': 1234 } ])
+            dbs.commit()
+        finally:
+            dbs.close()
+        return ingest_id
+
+    def get_ingest(self, ingest_id):
+        dbs = zingest.db.get_session()
+        try:
+            return dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+        finally:
+            dbs.close()
+
+    def test_removesVerified(self):
+        ingest_id = self.create_ingest()
+        #An earlier ingest of the same recording
+        earlier_id = self.create_ingest(workflow_state='FAILED')
+        self.assertEqual([ ingest_id ], self.cleaner.find_candidates())
+        self.assertEqual(1, self.cleaner.clean())
+        self.zoom.trash_recording.assert_called_once_with(self.uuid)
+
+        ingest = self.get_ingest(ingest_id)
+        self.assertIsNotNone(ingest.zoom_deleted)
+        self.assertEqual([ 'deleted' ], [ entry['result'] for entry in ingest.get_zoom_deletion_audit() ])
+        self.assertIsNotNone(self.get_ingest(earlier_id).zoom_deleted)
+        self.assertEqual(0, self.cleaner.clean())
+        self.assertEqual(1, self.zoom.trash_recording.call_count)
+
+    def test_onlyVerified(self):
+        self.create_ingest(status=zingest.db.Status.WARNING)
+        self.create_ingest(workflow_state='FAILED')
+        self.create_ingest(workflow_state='RUNNING')
+        self.create_ingest(workflow_state=None)
+        self.create_ingest(verified=False)
+        self.assertEqual([], self.cleaner.find_candidates())
+
+    def test_waitsForOtherIngests(self):
+        self.create_ingest()
+        pending_id = self.create_ingest(status=zingest.db.Status.IN_PROGRESS, workflow_state=None)
+        self.assertEqual([], self.cleaner.find_candidates())
+        dbs = zingest.db.get_session()
+        try:
+            pending = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == pending_id).one()
+            pending.update_status(zingest.db.Status.FINISHED)
+            pending.set_workflow_id("pending")
+            pending.set_workflow_state('SUCCEEDED')
+            dbs.commit()
+        finally:
+            dbs.close()
+        #Only one of them needs to remove it
+        self.assertEqual(1, len(self.cleaner.find_candidates()))
+        self.cleaner.clean()
+        self.assertEqual(1, self.zoom.trash_recording.call_count)
+
+    def test_batches(self):
+        for uuid in [ "one", "two", "three" ]:
+            self.create_ingest(uuid=uuid)
+        self.assertEqual(2, self.cleaner.clean())
+        self.assertEqual(1, self.cleaner.clean())
+        self.assertEqual([ "one", "two", "three" ], [ call[0][0] for call in self.zoom.trash_recording.call_args_list ])
+
+    def test_failures(self):
+        gone_id = self.create_ingest(uuid="gone")
+        failing_id = self.create_ingest(uuid="failing")
+        def trash(uuid):
+            raise HTTPError(response=MagicMock(status_code=404 if uuid == "gone" else 500))
+        self.zoom.trash_recording.side_effect = trash
+        self.cleaner.clean()
+        gone = self.get_ingest(gone_id)
+        self.assertIsNotNone(gone.zoom_deleted)
+        self.assertEqual('gone', gone.get_zoom_deletion_audit()[0]['result'])
+
+        for _ in range(ZoomCleaner.MAX_ATTEMPTS):
+            self.cleaner.clean()
+        failing = self.get_ingest(failing_id)
+        self.assertIsNone(failing.zoom_deleted)
+        self.assertEqual([ 'failed' ] * ZoomCleaner.MAX_ATTEMPTS, [ entry['result'] for entry in failing.get_zoom_deletion_audit() ])
+        self.assertEqual([], self.cleaner.find_candidates())
+
+    def test_config(self):
+        self.assertIsNone(ZoomCleaner.from_config({}, self.zoom))
+        self.assertIsNone(ZoomCleaner.from_config({ "Cleanup": { "delete_from_zoom": "false" } }, self.zoom))
+        cleaner = ZoomCleaner.from_config({ "Cleanup": { "delete_from_zoom": "true", "batch_size": "5", "rate": "" } }, self.zoom)
+        self.assertEqual(5, cleaner.batch_size)
+        self.assertEqual(ZoomCleaner.DEFAULT_RATE, cleaner.rate)
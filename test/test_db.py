@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, inspect, text
+import zingest.db
+
+
+class TestDb(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def test_addMissingColumns(self):
+        #An ingest table from before the mediapackage progress columns existed
+        engine = create_engine('sqlite:///' + self.dbfile)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE ingest (id INTEGER PRIMARY KEY, uuid VARCHAR(32) NOT NULL, status INTEGER NOT NULL, timestamp DATETIME NOT NULL, is_webhook BOOLEAN NOT NULL, zingest_parms BLOB NOT NULL, mediapackage_id VARCHAR(36), workflow_id VARCHAR(36))"))
+        engine.dispose()
+
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+
+        columns = [ column['name'] for column in inspect(zingest.db.engine).get_columns('ingest') ]
+        self.assertTrue('mediapackage' in columns)
+        self.assertTrue('completed_steps' in columns)
+        ingest_id = zingest.db.create_ingest("uuid", {})
+        self.assertEqual(1, ingest_id)
+
+    def test_dataVersion(self):
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        version = zingest.db.get_data_version()
+        self.assertEqual(version, zingest.db.get_data_version())
+
+        with open('test/resources/zoom/get-recording.json', 'r') as recording:
+            zingest.db.create_recording(json.loads(recording.read()))
+        self.assertNotEqual(version, zingest.db.get_data_version())
+        version = zingest.db.get_data_version()
+
+        ingest_id = zingest.db.create_ingest("uuid", {})
+        self.assertNotEqual(version, zingest.db.get_data_version())
+        version = zingest.db.get_data_version()
+
+        #A status change is picked up too
+        dbs = zingest.db.get_session()
+        try:
+            ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+            ingest.update_status(zingest.db.Status.FINISHED)
+            dbs.commit()
+        finally:
+            dbs.close()
+        self.assertNotEqual(version, zingest.db.get_data_version())
+
+    def test_batchCreateAndFind(self):
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        with open('test/resources/zoom/get-recording.json', 'r') as recording:
+            data = json.loads(recording.read())
+        other = dict(data, uuid="other-uuid", topic="Other\u200b meeting")
+        created = zingest.db.create_recordings([ data, other ])
+        #Usable after the session has closed
+        self.assertEqual([ data['uuid'], "other-uuid" ], [ rec.get_rec_id() for rec in created ])
+        self.assertEqual("Other meeting", created[1].get_title())
+
+        found = zingest.db.find_recordings([ data['uuid'], str(created[1].get_id()), "missing" ])
+        self.assertEqual({ data['uuid'], str(created[1].get_id()) }, set(found.keys()))
+        self.assertEqual("other-uuid", found[str(created[1].get_id())].get_rec_id())
+        self.assertEqual({}, zingest.db.find_recordings([]))
+
+        ingest_ids = zingest.db.create_ingests([ (data['uuid'], { 'is_webhook': False }, data), ("other-uuid", { 'title': "Other" }, None) ])
+        self.assertEqual(2, len(set(ingest_ids)))
+        dbs = zingest.db.get_session()
+        try:
+            ingests = { ingest.get_id(): ingest for ingest in dbs.query(zingest.db.Ingest).all() }
+            self.assertEqual("other-uuid", ingests[ingest_ids[1]].get_recording_id())
+            self.assertEqual({ 'title': "Other" }, json.loads(ingests[ingest_ids[1]].get_params()))
+            self.assertIsNotNone(ingests[ingest_ids[0]].get_zoom_recording())
+            self.assertIsNone(ingests[ingest_ids[1]].get_zoom_recording())
+        finally:
+            dbs.close()
+
+    def test_storedZoomRecording(self):
+        with open('test/resources/zoom/get-recording.json', 'r') as recording:
+            data = json.loads(recording.read())
+        ingest = zingest.db.Ingest(data['uuid'], {})
+        self.assertIsNone(ingest.get_zoom_recording())
+
+        ingest.set_zoom_recording(data)
+        stored = ingest.get_zoom_recording(timedelta(hours=1))
+        self.assertEqual(data['uuid'], stored['uuid'])
+        self.assertEqual(len(data['recording_files']), len(stored['recording_files']))
+        self.assertEqual(data['recording_files'][0]['download_url'], stored['recording_files'][0]['download_url'])
+        #Only what the uploader needs is kept
+        self.assertTrue(len(ingest.zoom_recording) < len(json.dumps(data)))
+
+        #Too old to trust the download URLs
+        ingest.set_zoom_recording(data, datetime.utcnow() - timedelta(hours=2))
+        self.assertIsNone(ingest.get_zoom_recording(timedelta(hours=1)))
+        self.assertIsNotNone(ingest.get_zoom_recording())
+
+        ingest.set_zoom_recording(None)
+        self.assertIsNone(ingest.get_zoom_recording())
+        self.assertIsNone(ingest.zoom_recording_fetched)
@@ -0,0 +1,77 @@
+import gzip
+import unittest
+
+from flask import Flask
+
+from zingest import http_cache
+
+
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.renders = 0
+        self.version = 1
+        self.error = False
+        app = Flask(__name__)
+        http_cache.init(app)
+
+        @app.route('/page', methods=['GET', 'POST'])
+        @http_cache.conditional(lambda: [ self.version ])
+        def page():
+            self.renders += 1
+            if self.error:
+                http_cache.uncacheable()
+            return "<html>" + "page " * 1000 + "</html>"
+
+        @app.route('/small')
+        def small():
+            return "small"
+
+        self.client = app.test_client()
+
+    def test_notModified(self):
+        response = self.client.get('/page?q=1')
+        self.assertEqual(200, response.status_code)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+
+        response = self.client.get('/page?q=1', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response.headers['ETag'])
+        #The view wasn't run again
+        self.assertEqual(1, self.renders)
+
+        #Different query parameters, or changed data, are a different version
+        self.assertEqual(200, self.client.get('/page?q=2', headers={'If-None-Match': etag}).status_code)
+        self.version = 2
+        self.assertEqual(200, self.client.get('/page?q=1', headers={'If-None-Match': etag}).status_code)
+        self.assertEqual(3, self.renders)
+
+    def test_uncacheable(self):
+        self.error = True
+        response = self.client.get('/page')
+        self.assertFalse('ETag' in response.headers)
+        #Other methods are left alone
+        self.error = False
+        self.assertFalse('ETag' in self.client.post('/page').headers)
+
+    def test_gzip(self):
+        response = self.client.get('/page', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertTrue('Accept-Encoding' in response.headers['Vary'])
+        self.assertTrue(gzip.decompress(response.data).startswith(b"<html>page "))
+        self.assertEqual(len(response.data), int(response.headers['Content-Length']))
+
+        response = self.client.get('/page')
+        self.assertFalse('Content-Encoding' in response.headers)
+        #Not worth it for small responses
+        response = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(b"small", response.data)
+
+    @unittest.skipIf(http_cache.brotli is None, "brotli is not installed")
+    def test_brotli(self):
+        response = self.client.get('/page', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual('br', response.headers['Content-Encoding'])
+        self.assertTrue(http_cache.brotli.decompress(response.data).startswith(b"<html>page "))
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import zingest.db
+from zingest.idempotency import EventLedger
+
+
+class TestEventLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.key = EventLedger.key("recording.completed", 1695140410494, "Yaxg95jbQyiQbTYP57GqSg==")
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def test_claimOnce(self):
+        ledger = EventLedger()
+        self.assertTrue(ledger.claim(self.key, "Yaxg95jbQyiQbTYP57GqSg=="))
+        self.assertFalse(ledger.claim(self.key))
+        #A different delivery of the same recording is a different event
+        self.assertTrue(ledger.claim(EventLedger.key("recording.completed", 1695140410495, "Yaxg95jbQyiQbTYP57GqSg==")))
+
+    def test_acrossProcesses(self):
+        #ie, two gunicorn workers which don't share memory, racing for the same event
+        ledgers = [ EventLedger() for _ in range(8) ]
+        with ThreadPoolExecutor(max_workers=len(ledgers)) as pool:
+            claimed = list(pool.map(lambda ledger: ledger.claim(self.key), ledgers))
+        self.assertEqual(1, claimed.count(True))
+
+    def test_repeatsSkipTheDatabase(self):
+        ledger = EventLedger()
+        ledger.claim(self.key)
+        with patch('zingest.db.claim_event') as claim_event:
+            self.assertFalse(ledger.claim(self.key))
+            claim_event.assert_not_called()
+
+    def test_release(self):
+        ledger = EventLedger()
+        other = EventLedger()
+        self.assertTrue(ledger.claim(self.key))
+        self.assertFalse(other.claim(self.key))
+        ledger.release(self.key)
+        #The other process must not have cached the claim it lost
+        self.assertTrue(other.claim(self.key))
+        self.assertFalse(ledger.claim(self.key))
+        other.release(self.key)
+        self.assertTrue(ledger.claim(self.key))
+
+    def test_bounded(self):
+        ledger = EventLedger(max_size=3)
+        for i in range(10):
+            ledger.claim(EventLedger.key("event", i))
+        self.assertEqual(3, len(ledger.seen))
+        #Forgotten locally, but still rejected by the database
+        self.assertFalse(ledger.is_known(EventLedger.key("event", 0)))
+        self.assertFalse(ledger.claim(EventLedger.key("event", 0)))
+
+    def test_expiry(self):
+        ledger = EventLedger(ttl=0)
+        self.assertTrue(ledger.claim(self.key))
+        self.assertFalse(ledger.is_known(self.key))
+        zingest.db.expire_events(datetime.utcnow() + timedelta(seconds=1))
+        self.assertTrue(ledger.claim(self.key))
@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import logger
+from logger import DigestSMTPHandler, init_logger
+
+
+class TestDigestSMTPHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = DigestSMTPHandler(("localhost", 25), "zoom-ingest@example.org", ["admin@example.org"], "Zoom Ingest Error", interval=3600, max_groups=2)
+        self.handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.handler._send = MagicMock()
+
+    def tearDown(self):
+        self.handler.close()
+
+    def record(self, message, exception=None):
+        exc_info = None
+        if exception:
+            try:
+                raise exception
+            except Exception:
+                exc_info = logging.sys.exc_info()
+        return logging.LogRecord("zingest.opencast", logging.ERROR, __file__, 1, message, None, exc_info)
+
+    def wait_for_send(self, count):
+        for _ in range(100):
+            if self.handler._send.call_count >= count:
+                return
+            time.sleep(0.01)
+
+    def test_firstSentImmediatelyThenBatched(self):
+        self.handler.emit(self.record("Unable to ingest first"))
+        self.wait_for_send(1)
+        self.assertEqual(1, self.handler._send.call_count)
+        self.assertEqual("Zoom Ingest Error", self.handler._send.call_args[0][0])
+
+        #An outage, failing lots of ingests in the same way
+        for i in range(10):
+            self.handler.emit(self.record(f"Error transferring recording{ i }, will retry later", ConnectionError("Connection refused")))
+        time.sleep(0.05)
+        self.assertEqual(1, self.handler._send.call_count)
+
+        self.handler.flush()
+        self.assertEqual(2, self.handler._send.call_count)
+        subject, body = self.handler._send.call_args[0]
+        self.assertEqual("Zoom Ingest Error (10 errors)", subject)
+        self.assertTrue("10x ERROR zingest.opencast: ConnectionError: Connection refused" in body)
+        self.assertTrue("  Error transferring recording0, will retry later" in body)
+        self.assertEqual(DigestSMTPHandler.EXAMPLES, body.count("  Error transferring recording"))
+        #Only one traceback
+        self.assertEqual(1, body.count("Traceback"))
+
+    def test_maxGroups(self):
+        self.handler.last_sent = time.time()
+        for i in range(4):
+            self.handler.emit(self.record(f"Distinct problem { i }"))
+        self.handler.flush()
+        subject, body = self.handler._send.call_args[0]
+        self.assertEqual("Zoom Ingest Error (4 errors)", subject)
+        self.assertTrue("1x ERROR zingest.opencast: Distinct problem 1" in body)
+        self.assertFalse("Distinct problem 2" in body)
+        self.assertTrue("and 2 more records" in body)
+
+    def test_failedSendIsNotFatal(self):
+        self.handler._send.side_effect = OSError("SMTP server unreachable")
+        self.handler.last_sent = time.time()
+        self.handler.emit(self.record("Unable to ingest"))
+        with patch('sys.stderr') as stderr:
+            self.handler.flush()
+        self.assertTrue("SMTP server unreachable" in stderr.write.call_args[0][0])
+        self.assertEqual({}, self.handler.groups)
+
+
+class TestQueuedLogging(unittest.TestCase):
+
+    def tearDown(self):
+        init_logger()
+
+    def test_handlersRunInBackground(self):
+        handled = []
+        release = threading.Event()
+
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                #ie, an SMTP server which isn't answering
+                release.wait(5)
+                handled.append((record.getMessage(), threading.current_thread()))
+
+        test_logger = logging.getLogger("zingest.test.queued")
+        test_logger.propagate = False
+        test_logger.addHandler(SlowHandler())
+        logger._queue_handlers()
+
+        start = time.perf_counter()
+        test_logger.error("Something went wrong")
+        self.assertTrue(time.perf_counter() - start < 1)
+        release.set()
+        logger.stop_logger()
+        self.assertEqual("Something went wrong", handled[0][0])
+        self.assertNotEqual(threading.current_thread(), handled[0][1])
+
+    def test_restartAfterFork(self):
+        handled = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                handled.append(record.getMessage())
+
+        test_logger = logging.getLogger("zingest.test.fork")
+        test_logger.propagate = False
+        test_logger.addHandler(ListHandler())
+        logger._queue_handlers()
+        #As if we were a freshly forked gunicorn worker
+        logger._restart_after_fork()
+        test_logger.error("From the worker")
+        logger.stop_logger()
+        self.assertEqual([ "From the worker" ], handled)
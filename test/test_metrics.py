@@ -0,0 +1,78 @@
+import unittest
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from prometheus_client import REGISTRY
+from zingest import metrics, timing
+
+
+class TestMetrics(unittest.TestCase):
+
+    def sample(self, name, labels=None):
+        value = REGISTRY.get_sample_value(name, labels or {})
+        return value if value else 0
+
+    def test_span(self):
+        before = self.sample('zingest_stage_duration_seconds_count', {'stage': 'test'})
+        with timing.span('test'):
+            pass
+        self.assertEqual(before + 1, self.sample('zingest_stage_duration_seconds_count', {'stage': 'test'}))
+
+    def test_spanException(self):
+        before = self.sample('zingest_stage_duration_seconds_count', {'stage': 'test_exception'})
+        with self.assertRaises(ValueError):
+            with timing.span('test_exception'):
+                raise ValueError()
+        self.assertEqual(before + 1, self.sample('zingest_stage_duration_seconds_count', {'stage': 'test_exception'}))
+
+    def test_collect(self):
+        with timing.collect() as timings:
+            with timing.span('a'):
+                pass
+            with timing.span('a'):
+                pass
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                def threaded():
+                    with timing.span('c'):
+                        pass
+                pool.submit(timing.propagate(threaded)).result()
+                #Without propagate the span is not collected
+                pool.submit(threaded).result()
+        self.assertEqual(['a', 'c'], sorted(timings.as_dict().keys()))
+        #Spans outside of a collect() block go nowhere
+        with timing.span('d'):
+            pass
+        self.assertFalse('d' in timings.as_dict())
+
+    def test_serverTiming(self):
+        timings = timing.Timings()
+        timings.add('hmac', 0.0000251)
+        timings.add('zoom:RecordingComponentV2.get', 0.25)
+        self.assertEqual("hmac;dur=0.025, zoom-RecordingComponentV2.get;dur=250.000", timings.server_timing())
+
+    def test_transfer(self):
+        before = self.sample('zingest_transfer_bytes_total', {'direction': 'test'})
+        metrics.observe_transfer('test', 1000, 2)
+        metrics.observe_transfer('test', 1000, 0)
+        self.assertEqual(before + 2000, self.sample('zingest_transfer_bytes_total', {'direction': 'test'}))
+        self.assertEqual(1, self.sample('zingest_transfer_bytes_per_second_count', {'direction': 'test'}))
+        self.assertEqual(500, self.sample('zingest_transfer_bytes_per_second_sum', {'direction': 'test'}))
+
+    def test_scrapeTimeGauges(self):
+        opencast = MagicMock()
+        opencast.acls_updated = datetime.utcnow() - timedelta(minutes=10)
+        opencast.themes_updated = None
+        opencast.workflows_updated = datetime.utcnow()
+        opencast.series_updated = datetime.utcnow()
+        rabbit = MagicMock()
+        rabbit.get_queue_depth = MagicMock(return_value=42)
+        metrics.update_catalog_ages(opencast)
+        metrics.update_queue_depth(rabbit)
+        self.assertTrue(self.sample('zingest_catalog_age_seconds', {'catalog': 'acls'}) >= 600)
+        self.assertEqual(42, self.sample('zingest_queue_depth'))
+
+    def test_render(self):
+        body, content_type = metrics.render()
+        self.assertTrue(content_type.startswith("text/plain"))
+        for name in (b'zingest_ingests_in_flight', b'zingest_zoom_rate_limited_total', b'zingest_db_sessions_total'):
+            self.assertTrue(name in body)
@@ -1,15 +1,18 @@
 import os
 import tempfile
 import json
+import threading
 import unittest
 import requests_mock
 import re
 import xmltodict
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock, patch
 from logger import init_logger
 from zingest.rabbit import Rabbit
 from zingest.zoom import Zoom
-from zingest.opencast import Opencast
+from zingest.opencast import Opencast, OpencastException, IngestProgress
+from zingest.scheduler import IngestScheduler
 import tempfile
 import shutil
 import zingest.db
@@ -49,12 +52,14 @@ class TestOpencast(unittest.TestCase):
 
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
+        self.statusdir = tempfile.mkdtemp()
         self.config = {"Opencast": {"Url": "http://localhost", "User": "test_user", "Password": "test_password", 'workflow_filter': None, 'series_filter': None},
                        "Rabbit": {"host": "http://localhost", "user": "test_user", "password": "test_password" },
                        "Zoom": {"oauth_account_id": "test_acount_id",
                                  "oauth_client_id": "test_client_id",
                                  "oauth_client_secret": "test_client_secret",
                                  "GDPR": "False" },
+                       "Progress": {"path": self.statusdir},
                        "TESTING": {"IN_PROGRESS_ROOT": self.tempdir}}
         self.base_zingest = {
             "workflow_id": "schedule-and-upload",
@@ -62,7 +67,7 @@ class TestOpencast(unittest.TestCase):
         }
         self.zoom = Zoom(self.config)
         Zoom._get_zoom_client = MockZoom
-        self.zoom.get_recording = MagicMock(return_value=recording_info)
+        self.zoom.fetch_recording = MagicMock(return_value=recording_info)
         self.zoom.get_user_name = MagicMock(return_value="Logan, Greg")
         self.rabbit = Rabbit(self.config, self.zoom)
         self.rabbit.start_consuming_rabbitmsg = MagicMock(return_value=None)
@@ -70,12 +75,14 @@ class TestOpencast(unittest.TestCase):
 
         zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
         self.zoom._create_recording_from_data(recording_info)
-        zingest.db.create_ingest(recording_info['uuid'], self.base_zingest)
+        #Released by the webhook, as an immediate ingest is
+        zingest.db.create_ingest(recording_info['uuid'], self.base_zingest, released=datetime.utcnow())
 
     def tearDown(self):
         os.close(self.fd)
         os.remove(self.dbfile)
         shutil.rmtree(self.tempdir)
+        shutil.rmtree(self.statusdir)
 
     def test_noConfig(self):
         with self.assertRaises(KeyError):
@@ -190,6 +197,20 @@ class TestOpencast(unittest.TestCase):
         self.assertTrue("ID-blender-foundation2" in workflows.keys())
 
 
+    @requests_mock.Mocker()
+    def test_getCatalog(self, mocker):
+        opencast, _, _ = self.create_mock_opencast(mocker)
+        acls = opencast.get_catalog('acls')
+        self.assertEqual(len(opencast.get_acls()), acls.search("", limit=0)[1])
+        self.assertEqual("authenticated", acls.get_label("501"))
+        self.assertEqual([ ("authenticated", "501") ], acls.search("auth")[0])
+        self.assertTrue("ID-blender-foundation" in [ key for _, key in opencast.get_catalog('series').search("", limit=0)[0] ])
+        self.assertTrue(opencast.get_catalog('workflows').get_label("schedule-and-upload"))
+        self.assertEqual(len(opencast.get_themes()), opencast.get_catalog('themes').search("", limit=0)[1])
+        with self.assertRaises(KeyError):
+            opencast.get_catalog('episodes')
+
+
     @requests_mock.Mocker()
     def test_callback(self, mocker):
         opencast, _, mock_dict = self.create_mock_opencast(mocker)
@@ -209,6 +230,77 @@ class TestOpencast(unittest.TestCase):
         self.assertEqual("b1d7f8d2-91fd-4710-8c63-17e3e14749a9", ingest_db_record.get_mediapackage_id())
         self.assertEqual("5267", ingest_db_record.get_workflow_id())
 
+    @requests_mock.Mocker()
+    def test_callbackStoresTimings(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        timings = self.get_ingest_record().get_timings()
+        for stage in ('process', 'zoom_metadata', 'download', 'oc_upload:create', 'oc_upload:presentation/source', 'oc_upload:ingest'):
+            self.assertTrue(stage in timings, f"{ stage } missing from { timings }")
+        self.assertTrue(timings['process'] >= timings['download'])
+
+    @requests_mock.Mocker()
+    def test_callbackReportsProgress(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        record = self.get_ingest_record()
+        state = opencast.progress_store.read(record.get_id())
+        self.assertEqual("finished", state['state'])
+        self.assertEqual(record.get_recording_id(), state['uuid'])
+        self.assertEqual(["download:shared_screen_with_speaker_view", "upload:presentation/source"], sorted(state['stages'].keys()))
+        for stage in state['stages'].values():
+            self.assertTrue(stage['done'])
+        download = state['stages']['download:shared_screen_with_speaker_view']
+        self.assertEqual(download['total'], download['bytes'])
+
+    @requests_mock.Mocker()
+    def test_callbackUsesStoredRecording(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        dbs = zingest.db.get_session()
+        try:
+            record = dbs.query(zingest.db.Ingest).one()
+            record.set_zoom_recording(recording_info)
+            dbs.commit()
+        finally:
+            dbs.close()
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+        self.assertEqual(zingest.db.Status.FINISHED, self.get_ingest_record().status)
+        self.assert_called(mock_dict['download'], 1)
+        self.zoom.fetch_recording.assert_not_called()
+
+    @requests_mock.Mocker()
+    def test_staleStoredRecordingIsRefetched(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        dbs = zingest.db.get_session()
+        try:
+            record = dbs.query(zingest.db.Ingest).one()
+            record.set_zoom_recording(recording_info, datetime.utcnow() - Opencast.RECORDING_MAX_AGE - timedelta(minutes=1))
+            dbs.commit()
+        finally:
+            dbs.close()
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+        self.assertEqual(zingest.db.Status.FINISHED, self.get_ingest_record().status)
+        self.zoom.fetch_recording.assert_called_once()
+        #And the fresh copy is stored for next time
+        self.assertIsNotNone(self.get_ingest_record().get_zoom_recording(Opencast.RECORDING_MAX_AGE))
+
+    @requests_mock.Mocker()
+    def test_callbackIgnoresFinishedIngest(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+        #ie, the scheduler released it again while the first message was queued
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        self.assert_called(mock_dict['download'], 1)
+        self.assert_called(mock_dict['start'], 1)
+
     @requests_mock.Mocker()
     def test_ocUpload(self, mocker):
         opencast, _, mock_dict = self.create_mock_opencast(mocker)
@@ -222,3 +314,294 @@ class TestOpencast(unittest.TestCase):
 
         self.assertEqual(mpid, wfdict['wf:workflow']['mp:mediapackage']['@id'])
         self.assertEqual(wfInstId, wfdict['wf:workflow']['@id'])
+
+    @requests_mock.Mocker()
+    def test_cachedDownload(self, mocker):
+        self.config["Cache"] = {"path": os.path.join(self.tempdir, "cache"), "max_bytes": "1000"}
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+        #Re-ingesting the recording creates a new ingest
+        second = zingest.db.create_ingest(recording_info['uuid'], self.base_zingest, released=datetime.utcnow())
+        opencast.rabbit_callback("", "", json.dumps({ "uuid": recording_info['uuid'], "ingest_id": second }))
+
+        #The second ingest is served from the cache
+        self.assert_called(mock_dict['download'], 1)
+        self.assert_called(mock_dict['start'], 2)
+        self.assertEqual(1, len(os.listdir(self.config["Cache"]["path"])))
+        #Both ingests have given the cached copy back, so it can be evicted again
+        self.assertEqual({}, opencast.cache.leases)
+
+    def add_extra_files(self, info):
+        extras = []
+        for recording_type, file_type, extension in (("chat_file", "CHAT", "TXT"), ("closed_caption", "CC", "VTT")):
+            extra = dict(info['recording_files'][0])
+            extra.update({'id': f"{ recording_type }-id", 'recording_type': recording_type, 'file_type': file_type, 'file_extension': extension})
+            extras.append(extra)
+        info['recording_files'] = info['recording_files'] + extras
+        return info
+
+    @requests_mock.Mocker()
+    def test_planFiles(self, mocker):
+        opencast, _, _ = self.create_mock_opencast(mocker)
+        info = self.add_extra_files(json.loads(json.dumps(recording_info)))
+        files = self.zoom._parse_recording_files(info)
+
+        tracks, attachments, status = opencast.plan_files("fake_uuid", files)
+        self.assertEqual(zingest.db.Status.FINISHED, status)
+        self.assertEqual(["presentation/source"], list(tracks.keys()))
+        self.assertEqual("shared_screen_with_speaker_view", tracks['presentation/source']['recording_type'])
+        self.assertEqual("chat_file", attachments['chat/transcript']['recording_type'])
+        self.assertEqual("closed_caption", attachments['captions/vtt']['recording_type'])
+
+        #Only the audio is left, so we fall back
+        tracks, attachments, status = opencast.plan_files("fake_uuid", [ f for f in files if f['recording_type'] == 'audio_only' ])
+        self.assertEqual(zingest.db.Status.WARNING, status)
+        self.assertEqual(["presentation/source"], list(tracks.keys()))
+        self.assertEqual({}, attachments)
+
+    @requests_mock.Mocker()
+    def test_callbackWithAttachments(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        self.zoom.fetch_recording = MagicMock(return_value=self.add_extra_files(json.loads(json.dumps(recording_info))))
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        self.assert_called(mock_dict['download'], 3) #video, chat and captions
+        self.assert_called(mock_dict['attach'], 2) #chat and captions, the test ACL does not exist so there is no xacml
+        self.assert_called(mock_dict['track'], 1)
+        self.assert_called(mock_dict['start'], 1)
+        #Everything has been cleaned up
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    @requests_mock.Mocker()
+    def test_ocUploadSingleRequest(self, mocker):
+        self.config["Opencast"]["ingest_strategy"] = "single"
+        self.config["Opencast"]["episode_ethterms"] = "false"
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        single = mocker.post(re.compile("//localhost/ingest/addMediaPackage/"), text=ingest['ingest'])
+        wfdict = xmltodict.parse(ingest['ingest'])
+        mpid, wfInstId = opencast.oc_upload("fake_uuid", "test/resources/media/fake", acl_id="test_acl", workflow_id="test_workflow")
+
+        self.assert_called(single, 1)
+        self.assertTrue(single.last_request.url.endswith("/addMediaPackage/test_workflow"))
+        self.assertFalse(mock_dict['create'].called)
+        self.assertFalse(mock_dict['track'].called)
+        self.assertFalse(mock_dict['start'].called)
+        self.assertEqual(mpid, wfdict['wf:workflow']['mp:mediapackage']['@id'])
+        self.assertEqual(wfInstId, wfdict['wf:workflow']['@id'])
+
+    @requests_mock.Mocker()
+    def test_ocUploadSingleRequestFallback(self, mocker):
+        self.config["Opencast"]["ingest_strategy"] = "single"
+        self.config["Opencast"]["episode_ethterms"] = "false"
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        single = mocker.post(re.compile("//localhost/ingest/addMediaPackage/"), status_code=400)
+        mpid, wfInstId = opencast.oc_upload("fake_uuid", "test/resources/media/fake", acl_id="test_acl", workflow_id="test_workflow")
+
+        self.assert_called(single, 1)
+        self.assert_called(mock_dict['create'], 1)
+        #The same catalogs as the single request would have added
+        self.assert_called(mock_dict['catalog'], 1)
+        self.assert_called(mock_dict['track'], 1)
+        self.assert_called(mock_dict['start'], 1)
+        self.assertEqual("5267", wfInstId)
+
+    @requests_mock.Mocker()
+    def test_createFailureDoesntWaitForDownloads(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        mocker.get("//localhost/ingest/createMediaPackage", text='Internal Server Error', status_code=500)
+        downloading = threading.Event()
+        finish = threading.Event()
+        def slow_download(*args, **kwargs):
+            downloading.set()
+            #ie, many GB still to go
+            finish.wait(10)
+            return os.path.join(self.tempdir, "abandoned.mp4")
+        opencast.download_file = slow_download
+        try:
+            callback = threading.Thread(target=opencast.rabbit_callback, args=("", "", rabbit_msg))
+            callback.start()
+            callback.join(5)
+            self.assertTrue(downloading.is_set())
+            self.assertFalse(callback.is_alive())
+            self.assertEqual(zingest.db.Status.NEW, self.get_ingest_record().status)
+        finally:
+            finish.set()
+
+    @requests_mock.Mocker()
+    def test_ocUploadSingleRequestAmbiguousFailure(self, mocker):
+        self.config["Opencast"]["ingest_strategy"] = "single"
+        self.config["Opencast"]["episode_ethterms"] = "false"
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        #Opencast may well have ingested it before failing, so this isn't retried step by step
+        single = mocker.post(re.compile("//localhost/ingest/addMediaPackage/"), status_code=503)
+        with self.assertRaises(OpencastException):
+            opencast.oc_upload("fake_uuid", "test/resources/media/fake", acl_id="test_acl", workflow_id="test_workflow")
+
+        self.assert_called(single, 1)
+        self.assertFalse(mock_dict['create'].called)
+        self.assertFalse(mock_dict['start'].called)
+
+    @requests_mock.Mocker()
+    def test_singleRequestNotUsedWithEthterms(self, mocker):
+        self.config["Opencast"]["ingest_strategy"] = "single"
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        single = mocker.post(re.compile("//localhost/ingest/addMediaPackage/"), text=ingest['ingest'])
+        opencast.oc_upload("fake_uuid", "test/resources/media/fake", acl_id="test_acl", workflow_id="test_workflow", **{"eth-advertised": "on"})
+
+        self.assertFalse(single.called)
+        #The ethterms catalog is added, as it is without the single strategy
+        self.assert_called(mock_dict['catalog'], 2)
+        self.assert_called(mock_dict['start'], 1)
+
+    def get_ingest_record(self):
+        db = zingest.db.get_session()
+        try:
+            return db.query(zingest.db.Ingest).one_or_none()
+        finally:
+            db.close()
+
+    def make_retry_due(self, release=False):
+        #As though the backoff has passed, and optionally as though the scheduler has released it again
+        dbs = zingest.db.get_session()
+        try:
+            record = dbs.query(zingest.db.Ingest).one()
+            record.not_before = datetime.utcnow() - timedelta(seconds=1)
+            if release:
+                record.released = datetime.utcnow()
+            dbs.commit()
+        finally:
+            dbs.close()
+
+    @requests_mock.Mocker()
+    def test_resumeAfterFailedIngest(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        start = mocker.post(re.compile("//localhost/ingest/ingest/"), [{'text': 'Internal Server Error', 'status_code': 500}, {'text': ingest['ingest']}])
+        available = mocker.head(re.compile("stable.loganite.ca"), status_code=200)
+        queue = MagicMock()
+        queue.get_queue_counts.return_value = (0, 0)
+        scheduler = IngestScheduler(queue)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+        record = self.get_ingest_record()
+        self.assertEqual(zingest.db.Status.NEW, record.status)
+        self.assertEqual(1, record.attempts)
+        self.assertEqual(["create", "dublincore/episode", "ethterms/episode", "presentation/source"], record.get_completed_steps())
+        self.assertEqual(ingest['add-track'], record.get_mediapackage())
+        #Not straight away, even if its original message turns up again
+        self.assertEqual(0, scheduler.release())
+        opencast.rabbit_callback("", "", rabbit_msg)
+        self.assertEqual(1, self.get_ingest_record().attempts)
+        self.assert_called(start, 1)
+
+        self.make_retry_due()
+        self.assertEqual(1, scheduler.release())
+        for uuid, ingest_id in queue.send_rabbit_msgs.call_args.args[0]:
+            opencast.rabbit_callback("", "", json.dumps(self.rabbit._construct_rabbit_msg(uuid, ingest_id)))
+
+        record = self.get_ingest_record()
+        self.assertEqual(zingest.db.Status.FINISHED, record.status)
+        self.assertEqual([], record.get_completed_steps())
+        self.assertIsNone(record.get_mediapackage())
+        #Nothing is downloaded or uploaded twice
+        self.assert_called(mock_dict['download'], 1)
+        self.assert_called(mock_dict['create'], 1)
+        self.assert_called(mock_dict['catalog'], 2)
+        self.assert_called(mock_dict['track'], 1)
+        self.assert_called(start, 2)
+        self.assertTrue(available.called)
+
+    @requests_mock.Mocker()
+    def test_givesUpAfterMaxAttempts(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        opencast.MAX_ATTEMPTS = 2
+        start = mocker.post(re.compile("//localhost/ingest/ingest/"), text='Internal Server Error', status_code=500)
+        mocker.head(re.compile("stable.loganite.ca"), status_code=200)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+        first_retry = self.get_ingest_record().not_before
+        self.make_retry_due(release=True)
+        opencast.rabbit_callback("", "", rabbit_msg)
+        record = self.get_ingest_record()
+        self.assertEqual(zingest.db.Status.FAILED, record.status)
+        self.assertEqual(2, record.attempts)
+        self.assertIsNotNone(first_retry)
+
+    @requests_mock.Mocker()
+    def test_resumeReuploadsMissingTrack(self, mocker):
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        start = mocker.post(re.compile("//localhost/ingest/ingest/"), [{'text': 'Internal Server Error', 'status_code': 500}, {'text': ingest['ingest']}])
+        mocker.head(re.compile("stable.loganite.ca"), status_code=200)
+        mocker.head(re.compile("stable.loganite.ca.*\\.mp4"), status_code=404)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+        self.make_retry_due(release=True)
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        self.assertEqual(zingest.db.Status.FINISHED, self.get_ingest_record().status)
+        self.assert_called(mock_dict['create'], 1)
+        self.assert_called(mock_dict['catalog'], 2)
+        self.assert_called(mock_dict['track'], 2)
+        self.assert_called(start, 2)
+
+    @requests_mock.Mocker()
+    def test_resumeProgressPrunesMissingElements(self, mocker):
+        opencast, _, _ = self.create_mock_opencast(mocker)
+        mocker.head(re.compile("stable.loganite.ca"), status_code=200)
+        mocker.head(re.compile("stable.loganite.ca.*\\.mp4"), status_code=404)
+        steps = ["create", "dublincore/episode", "ethterms/episode", "security/xacml+episode", "presentation/source"]
+        progress = IngestProgress(ingest['add-track'], steps)
+
+        opencast.resume_progress("fake_uuid", progress)
+
+        self.assertEqual(steps[:-1], progress.steps)
+        mp = xmltodict.parse(progress.mediapackage)['mediapackage']
+        self.assertFalse('track' in (mp['media'] or {}))
+        self.assertEqual(2, len(mp['metadata']['catalog']))
+
+    def add_speaker_view(self, info):
+        speaker = dict(info['recording_files'][0])
+        speaker.update({'id': "speaker-id", 'recording_type': "speaker_view"})
+        info['recording_files'] = info['recording_files'] + [ speaker ]
+        return info
+
+    @requests_mock.Mocker()
+    def test_planFilesMultiTrack(self, mocker):
+        self.config["Opencast"]["track_flavors"] = "speaker_view:presenter/source active_speaker:presenter/source shared_screen_with_speaker_view:presentation/source"
+        opencast, _, _ = self.create_mock_opencast(mocker)
+        files = self.zoom._parse_recording_files(self.add_speaker_view(json.loads(json.dumps(recording_info))))
+
+        tracks, attachments, status = opencast.plan_files("fake_uuid", files)
+        self.assertEqual(zingest.db.Status.FINISHED, status)
+        self.assertEqual("speaker_view", tracks['presenter/source']['recording_type'])
+        self.assertEqual("shared_screen_with_speaker_view", tracks['presentation/source']['recording_type'])
+
+        #None of the mapped types are present, so we use the normal single track selection
+        tracks, _, status = opencast.plan_files("fake_uuid", [ f for f in files if f['recording_type'] == 'audio_only' ])
+        self.assertEqual(zingest.db.Status.WARNING, status)
+        self.assertEqual(["presentation/source"], list(tracks.keys()))
+
+    @requests_mock.Mocker()
+    def test_callbackMultiTrack(self, mocker):
+        self.config["Opencast"]["track_flavors"] = "speaker_view:presenter/source shared_screen_with_speaker_view:presentation/source"
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        self.zoom.fetch_recording = MagicMock(return_value=self.add_speaker_view(json.loads(json.dumps(recording_info))))
+
+        def add_track(request, context):
+            #Each parallel upload only gets its own track back
+            if b"presenter/source" in request.body.read():
+                return ingest['add-track'].replace("presentation/source", "presenter/source").replace("1173081d", "2273081d")
+            return ingest['add-track']
+        track = mocker.post("//localhost/ingest/addTrack", text=add_track)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        self.assert_called(mock_dict['download'], 2)
+        self.assert_called(track, 2)
+        self.assert_called(mock_dict['start'], 1)
+        #Both tracks are in the mediapackage which is ingested
+        ingested = mock_dict['start'].last_request.body.read()
+        self.assertTrue(b"presenter/source" in ingested)
+        self.assertTrue(b"presentation/source" in ingested)
+        self.assertEqual(zingest.db.Status.FINISHED, self.get_ingest_record().status)
@@ -0,0 +1,60 @@
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+from zingest import profiling
+from zingest.profiling import ProfilingMiddleware
+
+
+def slow_app(environ, start_response):
+    time.sleep(0.05)
+    return Response("done")(environ, start_response)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_disabledByDefault(self):
+        self.assertTrue(profiling.wrap(slow_app, {}) is slow_app)
+        self.assertTrue(profiling.wrap(slow_app, {"Profiling": {"enabled": "false"}}) is slow_app)
+        wrapped = profiling.wrap(slow_app, {"Profiling": {"enabled": "true", "path": self.tempdir}})
+        self.assertEqual(self.tempdir, wrapped.path)
+
+    def test_notRequested(self):
+        client = Client(ProfilingMiddleware(slow_app, self.tempdir))
+        response = client.get("/")
+        self.assertEqual(b"done", response.data)
+        self.assertFalse("X-Zingest-Profile-File" in response.headers)
+        self.assertEqual([], os.listdir(self.tempdir))
+
+    def test_cprofile(self):
+        client = Client(ProfilingMiddleware(slow_app, self.tempdir))
+        response = client.get("/recordings/abc", headers={"X-Zingest-Profile": "cprofile"})
+        self.assertEqual(b"done", response.data)
+        filename = response.headers["X-Zingest-Profile-File"]
+        self.assertTrue(filename.endswith("-GET-recordings_abc.prof"))
+        stats = pstats.Stats(os.path.join(self.tempdir, filename))
+        self.assertTrue(any([ name == "slow_app" for _, _, name in stats.stats.keys() ]))
+
+    def test_sample(self):
+        client = Client(ProfilingMiddleware(slow_app, self.tempdir, interval=0.001))
+        response = client.get("/?qt=test&_profile=sample")
+        self.assertEqual(b"done", response.data)
+        filename = response.headers["X-Zingest-Profile-File"]
+        self.assertTrue(filename.endswith(".folded"))
+        with open(os.path.join(self.tempdir, filename)) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(len(lines) > 0)
+        self.assertTrue(any([ "slow_app" in line for line in lines ]))
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(int(count) > 0)
@@ -0,0 +1,92 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from zingest import progress
+from zingest.progress import ProgressStore, Tracker
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = ProgressStore(os.path.join(self.tempdir, "status"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_config(self):
+        store = ProgressStore.from_config({"Progress": {"path": os.path.join(self.tempdir, "other"), "retention": "60", "stale_after": ""}})
+        self.assertEqual(os.path.join(self.tempdir, "other"), store.path)
+        self.assertEqual(60, store.retention)
+        self.assertEqual(ProgressStore.DEFAULT_STALE_AFTER, store.stale_after)
+        self.assertTrue(os.path.isdir(store.path))
+
+    def test_trackStages(self):
+        with progress.track(self.store, 1, "abc") as tracker:
+            self.assertEqual(Tracker.RUNNING, self.store.read(1)['state'])
+            stage = progress.stage("download:shared_screen", 100)
+            fd = io.BytesIO()
+            stage.writer(fd).write(b"x" * 40)
+            self.assertEqual(40, len(fd.getvalue()))
+            #Throttled, so the store has not seen this yet
+            self.assertEqual(0, self.store.read(1)['stages']['download:shared_screen']['bytes'])
+            stage.finish()
+            tracker.finish(True, "finished")
+        state = self.store.read(1)
+        self.assertEqual(Tracker.FINISHED, state['state'])
+        self.assertEqual("abc", state['uuid'])
+        download = state['stages']['download:shared_screen']
+        self.assertEqual(40, download['bytes'])
+        self.assertEqual(40.0, download['percent'])
+        self.assertTrue(download['done'])
+        self.assertIsNone(download['eta'])
+
+    def test_eta(self):
+        tracker = Tracker(self.store, 1, "abc")
+        stage = tracker.stage("upload:presentation/source", 1000)
+        stage.started = time.time() - 10
+        stage.set(250)
+        state = stage.as_dict(stage.started + 10)
+        self.assertEqual(25, state['rate'])
+        self.assertEqual(30.0, state['eta'])
+
+    def test_notTracking(self):
+        stage = progress.stage("download", 100)
+        fd = io.BytesIO()
+        self.assertTrue(stage.writer(fd) is fd)
+        stage.advance(10)
+        stage.finish()
+        self.assertEqual([], os.listdir(self.store.path))
+
+    def test_readAll(self):
+        with progress.track(self.store, 1, "first") as tracker:
+            tracker.finish(False, "in progress")
+        with progress.track(self.store, 2, "second"):
+            pass
+        self.assertEqual(["second", "first"], [ state['uuid'] for state in self.store.read_all() ])
+        #Stopped ingests are dropped once they're older than the retention period, running ones never are
+        self.store.retention = -1
+        self.assertEqual(["second"], [ state['uuid'] for state in self.store.read_all() ])
+        self.assertIsNone(self.store.read(1))
+
+    def test_abandonedRunningIngests(self):
+        with progress.track(self.store, 1, "alive"):
+            pass
+        #Written by an uploader which has since been killed
+        dead = subprocess.Popen([ sys.executable, "-c", "" ])
+        dead.wait()
+        with progress.track(self.store, 2, "dead") as tracker:
+            state = tracker.as_dict(time.time())
+        state['pid'] = dead.pid
+        self.store.write(2, state)
+        self.assertIsNone(self.store.read(2))
+        self.assertEqual(["alive"], [ state['uuid'] for state in self.store.read_all() ])
+        self.assertFalse(os.path.isfile(os.path.join(self.store.path, "2.json")))
+        #Or which has stopped making progress
+        self.store.stale_after = -1
+        self.assertEqual([], self.store.read_all())
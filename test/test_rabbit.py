@@ -88,3 +88,19 @@ class TestRabbit(unittest.TestCase):
         #sent is now the UUID, rather than the whole message, so it's kinda pointless to test against
         sent = rabbit.send_rabbit_msg.call_args[0][0]
         self.assert_rabbitmsg(sent, 12345)
+
+    def test_sendingMessagesInBatch(self):
+        rabbit = Rabbit(self.config, self.zoom)
+        connection = MagicMock()
+        rabbit._connect = MagicMock(return_value=connection)
+        uuid = webhook_event['payload']['object']['uuid']
+        rabbit.send_rabbit_msgs([ (uuid, 1), (uuid, 2), (uuid, 3) ])
+
+        #One connection for the whole batch
+        rabbit._connect.assert_called_once()
+        connection.close.assert_called_once()
+        channel = connection.channel.return_value
+        self.assertEqual(3, channel.basic_publish.call_count)
+        for expected_ingest_id, call in zip([ 1, 2, 3 ], channel.basic_publish.call_args_list):
+            self.assertEqual("zoomhook", call[1]['routing_key'])
+            self.assert_rabbitmsg(json.loads(call[1]['body']), expected_ingest_id)
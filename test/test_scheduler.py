@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, time, timedelta
+from unittest.mock import MagicMock
+
+import zingest.db
+from zingest.scheduler import IngestScheduler, Lane
+
+recording_info = None
+with open('test/resources/zoom/get-recording.json', 'r') as info:
+    recording_info = json.loads(info.read())
+
+
+def window(start_offset, end_offset):
+    now = datetime.now()
+    return ((now + timedelta(hours=start_offset)).time(), (now + timedelta(hours=end_offset)).time())
+
+
+class TestIngestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        zingest.db.create_recording(recording_info)
+        self.uuid = recording_info['uuid']
+        self.rabbit = MagicMock()
+        self.rabbit.get_queue_counts.return_value = (0, 0)
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def create_ingest(self, lane, not_before=None, released=None):
+        return zingest.db.create_ingest(self.uuid, {}, lane=lane, not_before=not_before, released=released)
+
+    def get_ingest(self, ingest_id):
+        dbs = zingest.db.get_session()
+        try:
+            return dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+        finally:
+            dbs.close()
+
+    def sent(self):
+        return [ ingest_id for call in self.rabbit.send_rabbit_msgs.call_args_list for _, ingest_id in call.args[0] ]
+
+    def test_windows(self):
+        lane = Lane("bulk", Lane.parse_windows("22:00-06:00 12:00-13:00"))
+        self.assertTrue(lane.is_open(datetime(2020, 1, 1, 23, 30)))
+        self.assertTrue(lane.is_open(datetime(2020, 1, 1, 5, 59)))
+        self.assertTrue(lane.is_open(datetime(2020, 1, 1, 12, 0)))
+        self.assertFalse(lane.is_open(datetime(2020, 1, 1, 6, 0)))
+        self.assertFalse(lane.is_open(datetime(2020, 1, 1, 13, 0)))
+        self.assertTrue(Lane("interactive").is_open())
+
+    def test_immediate(self):
+        scheduler = IngestScheduler(self.rabbit, [ Lane("bulk", [ window(1, 2) ]), Lane("webhook", capacity=2) ])
+        self.assertTrue(scheduler.is_immediate("interactive"))
+        self.assertFalse(scheduler.is_immediate("interactive", datetime.utcnow() + timedelta(hours=1)))
+        self.assertFalse(scheduler.is_immediate("bulk"))
+        self.assertFalse(scheduler.is_immediate("webhook"))
+        #Ingests from before lanes existed
+        self.assertTrue(scheduler.is_immediate(None))
+        self.assertEqual("webhook", IngestScheduler.lane_for({ 'is_webhook': True }))
+        self.assertEqual("interactive", IngestScheduler.lane_for({ 'is_webhook': False }))
+        self.assertEqual("bulk", IngestScheduler.lane_for({}, bulk=True))
+
+    def test_releasesWithinWindowAndCapacity(self):
+        closed = IngestScheduler(self.rabbit, [ Lane("bulk", [ window(1, 2) ]) ])
+        ingest_ids = [ self.create_ingest("bulk") for _ in range(3) ]
+        deferred = self.create_ingest("interactive", not_before=datetime.utcnow() + timedelta(hours=1))
+        self.assertEqual(0, closed.release())
+        self.rabbit.send_rabbit_msgs.assert_not_called()
+
+        scheduler = IngestScheduler(self.rabbit, [ Lane("bulk", [ window(-1, 1) ], capacity=2) ])
+        self.assertEqual(2, scheduler.release())
+        self.assertEqual(ingest_ids[:2], self.sent())
+        self.assertIsNotNone(self.get_ingest(ingest_ids[0]).released)
+        #Full until one of them finishes
+        self.assertEqual(0, scheduler.release())
+        dbs = zingest.db.get_session()
+        try:
+            ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_ids[0]).one()
+            ingest.update_status(zingest.db.Status.FINISHED)
+            dbs.commit()
+        finally:
+            dbs.close()
+        self.assertEqual(1, scheduler.release())
+        self.assertEqual(ingest_ids, self.sent())
+        self.assertIsNone(self.get_ingest(deferred).released)
+
+    def test_redeliversLostMessages(self):
+        scheduler = IngestScheduler(self.rabbit, redeliver_after=3600)
+        recent = self.create_ingest("webhook", released=datetime.utcnow() - timedelta(minutes=5))
+        lost = self.create_ingest("webhook", released=datetime.utcnow() - timedelta(hours=2))
+        #Still queued, rather than lost
+        self.rabbit.get_queue_counts.return_value = (3, 1)
+        self.assertEqual(0, scheduler.release())
+        #Nothing ready, but an uploader is busy and may still be holding its message unacknowledged
+        running = self.create_ingest("webhook", released=datetime.utcnow() - timedelta(minutes=10))
+        dbs = zingest.db.get_session()
+        try:
+            dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == running).update({ zingest.db.Ingest.status: zingest.db.Status.IN_PROGRESS })
+            dbs.commit()
+        finally:
+            dbs.close()
+        self.rabbit.get_queue_counts.return_value = (0, 1)
+        self.assertEqual(0, scheduler.release())
+        self.rabbit.get_queue_counts.return_value = (0, 0)
+        self.assertEqual(1, scheduler.release())
+        self.assertEqual([ lost ], self.sent())
+        self.assertEqual(0, scheduler.release())
+
+    def test_concurrentReleaseSendsOnce(self):
+        ingest_ids = [ self.create_ingest("interactive") for _ in range(2) ]
+        first = IngestScheduler(self.rabbit, [])
+        second = IngestScheduler(self.rabbit, [])
+        #The second uploader releases everything between the first reading the waiting ingests and marking them
+        get_lane = first.get_lane
+        def race(name):
+            if self.rabbit.send_rabbit_msgs.call_count == 0:
+                self.assertEqual(2, second.release())
+            return get_lane(name)
+        first.get_lane = race
+        self.assertEqual(0, first.release())
+        self.assertEqual(ingest_ids, self.sent())
+
+    def test_failedSendIsRetried(self):
+        scheduler = IngestScheduler(self.rabbit)
+        ingest_id = self.create_ingest("bulk")
+        self.rabbit.send_rabbit_msgs.side_effect = ConnectionError("Rabbit is down")
+        with self.assertRaises(ConnectionError):
+            scheduler.release()
+        self.assertIsNone(self.get_ingest(ingest_id).released)
+        self.rabbit.send_rabbit_msgs.side_effect = None
+        self.assertEqual(1, scheduler.release())
+
+    def test_config(self):
+        scheduler = IngestScheduler.from_config({ "Scheduler": { "bulk_windows": "22:00-06:00", "bulk_capacity": "5", "webhook_windows": "", "interval": "30" } }, self.rabbit)
+        self.assertEqual([ (time(22, 0), time(6, 0)) ], scheduler.lanes["bulk"].windows)
+        self.assertEqual(5, scheduler.lanes["bulk"].capacity)
+        self.assertEqual([], scheduler.lanes["webhook"].windows)
+        self.assertEqual(30, scheduler.interval)
+        self.assertEqual(timedelta(seconds=IngestScheduler.DEFAULT_REDELIVER_AFTER), scheduler.redeliver_after)
+        self.assertEqual(timedelta(seconds=IngestScheduler.DEFAULT_REDELIVER_AFTER), IngestScheduler.from_config({}, self.rabbit).redeliver_after)
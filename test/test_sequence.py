@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import unittest
+
+from zingest import sequence
+from zingest.sequence import Abandon, Call, Start
+
+
+class Transport:
+
+    def __init__(self):
+        self.calls = []
+        self.removed = []
+        self.release = threading.Event()
+
+    def echo(self, value):
+        self.calls.append(value)
+        return value
+
+    def fail(self, message):
+        raise ValueError(message)
+
+    def slow(self, value):
+        self.release.wait(5)
+        return value
+
+    def remove(self, value):
+        self.removed.append(value)
+
+
+class AsyncTransport(Transport):
+
+    async def echo(self, value):
+        return super().echo(value)
+
+    async def fail(self, message):
+        super().fail(message)
+
+    async def slow(self, value):
+        await asyncio.sleep(5)
+        return value
+
+    async def remove(self, value):
+        super().remove(value)
+
+
+def ingest(calls):
+    #A cut down version of the download and upload part of Opencast._process_ingest()
+    first = yield Call('echo', 'first')
+    batch = yield Start(calls)
+    try:
+        results = yield from sequence.gather(batch)
+    except ValueError as e:
+        yield Abandon(batch, 'remove')
+        return first, repr(e)
+    return first, results
+
+
+class TestSequence(unittest.TestCase):
+
+    def test_run(self):
+        transport = Transport()
+        result = sequence.run(ingest({ 'a': Call('echo', 'a'), 'b': Call('echo', 'b') }), transport)
+        self.assertEqual(('first', { 'a': 'a', 'b': 'b' }), result)
+        self.assertEqual([], transport.removed)
+
+    def test_runAsync(self):
+        transport = AsyncTransport()
+        result = asyncio.run(sequence.run_async(ingest({ 'a': Call('echo', 'a'), 'b': Call('echo', 'b') }), transport))
+        self.assertEqual(('first', { 'a': 'a', 'b': 'b' }), result)
+        self.assertEqual([], transport.removed)
+
+    def test_errorsAreThrownIntoTheSequence(self):
+        def failing():
+            try:
+                yield Call('fail', 'broken')
+            except ValueError as e:
+                return repr(e)
+        self.assertEqual("ValueError('broken')", sequence.run(failing(), Transport()))
+        self.assertEqual("ValueError('broken')", asyncio.run(sequence.run_async(failing(), AsyncTransport())))
+
+    def test_abandonDoesntWait(self):
+        transport = Transport()
+        calls = { 'done': Call('echo', 'done'), 'slow': Call('slow', 'slow'), 'broken': Call('fail', 'broken') }
+        try:
+            result = sequence.run(ingest(calls), transport)
+            #The slow call is still running, its result is cleaned up once it finishes
+            self.assertEqual(('first', "ValueError('broken')"), result)
+            self.assertNotIn('slow', transport.removed)
+        finally:
+            transport.release.set()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join(5)
+        self.assertEqual([ 'done', 'slow' ], sorted(transport.removed))
+
+    def test_abandonCancelsTasks(self):
+        transport = AsyncTransport()
+        calls = { 'done': Call('echo', 'done'), 'slow': Call('slow', 'slow'), 'broken': Call('fail', 'broken') }
+        result = asyncio.run(asyncio.wait_for(sequence.run_async(ingest(calls), transport), 2))
+        self.assertEqual(('first', "ValueError('broken')"), result)
+        self.assertEqual([ 'done' ], transport.removed)
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests_mock
+
+from zingest.tokens import TokenManager
+from zingest.zoom import Zoom
+
+OAUTH_URI = "https://zoom.us/oauth/token"
+#Other tests replace this on the class, so keep hold of the real one
+get_zoom_client = Zoom._get_zoom_client
+
+
+class TestTokenManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = os.path.join(self.tempdir, "zoom-token.json")
+        self.fetches = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def mock_oauth(self, mocker, expires_in=3599):
+        def token(request, context):
+            self.fetches += 1
+            return {"access_token": f"token{ self.fetches }", "expires_in": expires_in}
+        return mocker.post(OAUTH_URI, json=token)
+
+    def manager(self, path=None):
+        return TokenManager("client", "secret", "account", path=path)
+
+    @requests_mock.Mocker()
+    def test_sharedBetweenThreads(self, mocker):
+        self.mock_oauth(mocker)
+        tokens = self.manager()
+        results = []
+        threads = [ threading.Thread(target=lambda: results.append(tokens.get())) for _ in range(10) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([ "token1" ] * 10, results)
+        self.assertEqual(1, self.fetches)
+        self.assertTrue("grant_type=account_credentials" in mocker.last_request.text)
+
+    @requests_mock.Mocker()
+    def test_sharedBetweenProcessesViaStore(self, mocker):
+        self.mock_oauth(mocker)
+        self.assertEqual("token1", self.manager(self.store).get())
+        #A second manager, ie in another worker, picks the token up from the store
+        self.assertEqual("token1", self.manager(self.store).get())
+        self.assertEqual(1, self.fetches)
+        #But not if the store belongs to different credentials
+        other = TokenManager("other", "secret", "account", path=self.store)
+        self.assertEqual("token2", other.get())
+
+    @requests_mock.Mocker()
+    def test_invalidate(self, mocker):
+        self.mock_oauth(mocker)
+        tokens = self.manager(self.store)
+        self.assertEqual("token1", tokens.get())
+        tokens.invalidate("token1")
+        self.assertEqual("token2", tokens.get())
+        #The rejected token is also ignored if it's still in another worker's store
+        self.assertEqual("token2", self.manager(self.store).get())
+
+    @requests_mock.Mocker()
+    def test_backgroundRefresh(self, mocker):
+        self.mock_oauth(mocker, expires_in=2)
+        tokens = self.manager()
+        tokens.MIN_VALIDITY = 0
+        tokens.REFRESH_MARGIN = 1.5
+        try:
+            self.assertEqual("token1", tokens.get())
+            time.sleep(1)
+            #The refresher replaced the token before it got close to expiring, without a caller having to wait
+            self.assertTrue(self.fetches >= 2)
+            self.assertNotEqual("token1", tokens.peek())
+        finally:
+            tokens.close()
+            tokens.refresher.join()
+
+    @requests_mock.Mocker()
+    def test_adopt(self, mocker):
+        self.mock_oauth(mocker)
+        tokens = self.manager(self.store)
+        tokens.adopt("zoomus-token")
+        self.assertEqual("zoomus-token", tokens.get())
+        self.assertEqual("zoomus-token", self.manager(self.store).get())
+        self.assertEqual(0, self.fetches)
+
+
+class TestZoomReauthentication(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {"Zoom": {"oauth_account_id": "test_acount_id",
+                                "oauth_client_id": "test_client_id",
+                                "oauth_client_secret": "test_client_secret",
+                                "GDPR": "False" }}
+
+    def test_retriesUnauthorizedOnce(self):
+        zoom = Zoom(self.config)
+        zoom._get_zoom_client = get_zoom_client.__get__(zoom)
+        zoom.zoom_client = MagicMock()
+        zoom.zoom_client.config = {"token": "stale"}
+        zoom.tokens.get = MagicMock(return_value="fresh")
+        zoom.tokens.invalidate = MagicMock()
+        ok = MagicMock(status_code=200, content=b'{"id": "user"}')
+        function = MagicMock(side_effect=[ MagicMock(status_code=401), ok ])
+        function.__qualname__ = "UserComponentV2.get"
+
+        self.assertEqual({"id": "user"}, zoom._make_zoom_request(function, {"id": "user"}))
+        self.assertEqual(2, function.call_count)
+        zoom.tokens.invalidate.assert_called_once_with("stale")
+        self.assertEqual("fresh", zoom.zoom_client.config["token"])
+
+    def test_unauthorizedTwiceRaises(self):
+        zoom = Zoom(self.config)
+        zoom.zoom_client = MagicMock()
+        zoom.zoom_client.config = {"token": "stale"}
+        zoom.tokens.get = MagicMock(return_value="fresh")
+        unauthorized = MagicMock(status_code=401)
+        unauthorized.raise_for_status.side_effect = Exception("401")
+        function = MagicMock(return_value=unauthorized)
+        function.__qualname__ = "UserComponentV2.get"
+
+        with self.assertRaises(Exception):
+            zoom._make_zoom_request(function, {"id": "user"})
+        self.assertEqual(2, function.call_count)
+
+    def test_clientCreatedOnceAcrossThreads(self):
+        zoom = Zoom(self.config)
+        zoom._get_zoom_client = get_zoom_client.__get__(zoom)
+        zoom.tokens.get = MagicMock(return_value="token")
+        zoom.tokens.adopt = MagicMock()
+        def slow_client(*args, **kwargs):
+            #Wide enough for every thread to get past the unlocked check
+            time.sleep(0.1)
+            client = MagicMock()
+            client.config = {"token": "token"}
+            return client
+        with patch('zingest.zoom.ZoomClient', side_effect=slow_client) as created:
+            clients = []
+            threads = [ threading.Thread(target=lambda: clients.append(zoom._get_zoom_client())) for i in range(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, created.call_count)
+        self.assertEqual(1, len({ id(client) for client in clients }))
@@ -0,0 +1,157 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+import requests
+import requests_mock
+import sqlalchemy
+
+import zingest.db
+from zingest.opencast import Opencast
+from zingest.workflows import WorkflowPoller
+
+recording_info = None
+with open('test/resources/zoom/get-recording.json', 'r') as info:
+    recording_info = json.loads(info.read())
+
+
+class FakeOpencast:
+    url = "http://localhost"
+    enable_email = False
+    _ensure_list = Opencast._ensure_list
+
+    def _do_get(self, url):
+        return requests.get(url)
+
+
+def epoch_ms(iso):
+    return int(datetime.fromisoformat(iso).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class TestWorkflowPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        zingest.db.create_recording(recording_info)
+        self.ingests = {}
+        for workflow_id in [ "101", "102" ]:
+            ingest_id = zingest.db.create_ingest(recording_info['uuid'], {})
+            dbs = zingest.db.get_session()
+            try:
+                ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+                ingest.update_status(zingest.db.Status.FINISHED)
+                ingest.set_workflow_id(workflow_id)
+                dbs.commit()
+            finally:
+                dbs.close()
+            self.ingests[workflow_id] = ingest_id
+        self.poller = WorkflowPoller(FakeOpencast(), batch_size=2)
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def get_ingest(self, workflow_id):
+        dbs = zingest.db.get_session()
+        try:
+            return dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == self.ingests[workflow_id]).one()
+        finally:
+            dbs.close()
+
+    def finished_workflow(self, workflow_id, state):
+        #The recording ended at 20:09:38, Opencast started at 20:15:00 and finished at 20:45:00
+        return { "workflow": { "id": workflow_id, "state": state, "operations": { "operation": [
+            { "id": "ingest-download", "state": "SUCCEEDED", "started": epoch_ms("2020-10-29T20:15:00"), "completed": epoch_ms("2020-10-29T20:16:00") },
+            { "id": "publish-engage", "state": state, "started": epoch_ms("2020-10-29T20:40:00"), "completed": epoch_ms("2020-10-29T20:45:00") },
+        ] } } }
+
+    def test_bulkListing(self):
+        with requests_mock.Mocker() as mocker:
+            #Our 101 is still running, somewhere among everything else Opencast is doing
+            listing = mocker.get(f"{ FakeOpencast.url }/workflow/instances.json", [
+                { 'json': { "workflows": { "totalCount": "3", "workflow": [ { "id": 99, "state": "RUNNING" }, { "id": 100, "state": "PAUSED" } ] } } },
+                { 'json': { "workflows": { "totalCount": "3", "workflow": { "id": 101, "state": "RUNNING" } } } },
+            ])
+            single = mocker.get(f"{ FakeOpencast.url }/workflow/instance/102.json", json=self.finished_workflow("102", "SUCCEEDED"))
+            self.assertEqual((1, 1), self.poller.poll())
+            self.assertEqual(2, listing.call_count)
+            self.assertTrue("state=RUNNING" in listing.request_history[0].url)
+            self.assertEqual(1, single.call_count)
+
+        running = self.get_ingest("101")
+        self.assertEqual("RUNNING", running.get_workflow_state())
+        self.assertIsNotNone(running.workflow_checked)
+        self.assertIsNone(running.processing_duration)
+
+        finished = self.get_ingest("102")
+        self.assertEqual("SUCCEEDED", finished.get_workflow_state())
+        self.assertEqual(30 * 60, finished.processing_duration)
+        self.assertEqual(datetime(2020, 10, 29, 20, 45), finished.workflow_completed)
+        self.assertEqual(35 * 60 + 22, finished.latency)
+
+        #Finished workflows aren't checked again
+        with requests_mock.Mocker() as mocker:
+            mocker.get(f"{ FakeOpencast.url }/workflow/instances.json", json={ "workflows": { "totalCount": "0" } })
+            mocker.get(f"{ FakeOpencast.url }/workflow/instance/101.json", json=self.finished_workflow("101", "FAILED"))
+            self.assertEqual((0, 1), self.poller.poll())
+            self.assertEqual((0, 0), self.poller.poll())
+            self.assertEqual(1, len([ request for request in mocker.request_history if "/instance/" in request.url ]))
+        self.assertEqual("FAILED", self.get_ingest("101").get_workflow_state())
+
+    def test_withoutListing(self):
+        with requests_mock.Mocker() as mocker:
+            mocker.get(f"{ FakeOpencast.url }/workflow/instances.json", status_code=404)
+            mocker.get(f"{ FakeOpencast.url }/workflow/instance/101.json", json={ "workflow": { "id": 101, "state": "RUNNING" } })
+            mocker.get(f"{ FakeOpencast.url }/workflow/instance/102.json", status_code=404)
+            self.assertEqual((1, 1), self.poller.poll())
+            self.assertFalse(self.poller.can_list)
+            self.assertEqual((1, 0), self.poller.poll())
+            self.assertEqual(1, len([ request for request in mocker.request_history if "/instances.json" in request.url ]))
+        self.assertEqual("RUNNING", self.get_ingest("101").get_workflow_state())
+        self.assertEqual(WorkflowPoller.MISSING, self.get_ingest("102").get_workflow_state())
+
+    def test_unreachable(self):
+        with requests_mock.Mocker() as mocker:
+            mocker.get(f"{ FakeOpencast.url }/workflow/instances.json", status_code=503)
+            mocker.get(f"{ FakeOpencast.url }/workflow/instance/101.json", status_code=503)
+            mocker.get(f"{ FakeOpencast.url }/workflow/instance/102.json", status_code=503)
+            self.assertEqual((2, 0), self.poller.poll())
+        self.assertTrue(self.poller.can_list)
+        self.assertIsNone(self.get_ingest("101").get_workflow_state())
+
+    def test_upgradeSkipsOldIngests(self):
+        #Both ingests were handed to Opencast by a version which didn't follow workflows
+        with zingest.db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text("ALTER TABLE ingest DROP COLUMN workflow_state"))
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.assertEqual(WorkflowPoller.UNTRACKED, self.get_ingest("101").get_workflow_state())
+        #Only the new ingest is polled, and only its workflow is fetched
+        ingest_id = zingest.db.create_ingest(recording_info['uuid'], {})
+        dbs = zingest.db.get_session()
+        try:
+            ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+            ingest.update_status(zingest.db.Status.FINISHED)
+            ingest.set_workflow_id("103")
+            dbs.commit()
+        finally:
+            dbs.close()
+        self.poller.can_list = False
+        with requests_mock.Mocker() as mocker:
+            single = mocker.get(f"{ FakeOpencast.url }/workflow/instance/103.json", json=self.finished_workflow("103", "SUCCEEDED"))
+            self.assertEqual((0, 1), self.poller.poll())
+            self.assertEqual(1, single.call_count)
+            self.assertEqual(1, len(mocker.request_history))
+        self.assertEqual(WorkflowPoller.UNTRACKED, self.get_ingest("102").get_workflow_state())
+
+    def test_config(self):
+        self.assertIsNone(WorkflowPoller.from_config({ "Workflows": { "poll": "false" } }, FakeOpencast()))
+        poller = WorkflowPoller.from_config({ "Workflows": { "min_interval": "10", "max_interval": "", "batch_size": "20" } }, FakeOpencast())
+        self.assertEqual(10, poller.min_interval)
+        self.assertEqual(WorkflowPoller.DEFAULT_MAX_INTERVAL, poller.max_interval)
+        self.assertEqual(20, poller.batch_size)
+        poller.interval = poller.max_interval
+        poller.wakeup()
+        self.assertEqual(10, poller.interval)
@@ -1,8 +1,11 @@
 import json
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
+import zingest.db
 from zingest.common import BadWebhookData, NoMp4Files
-from zingest.zoom import Zoom
+from zingest.zoom import Zoom, parse_json
 
 class TestZoom(unittest.TestCase):
 
@@ -65,6 +68,89 @@ class TestZoom(unittest.TestCase):
         self.assertEqual(self.config["Zoom"]["oauth_client_secret"], zoom.oauth_client_secret)
         self.assertEqual(self.config["Zoom"]["GDPR"].lower(), str(zoom.gdpr).lower())
 
+    def test_clientOverrides(self):
+        self.assertEqual({}, Zoom(self.config).client_overrides)
+        self.config["TESTING"] = {"zoom_base_uri": "http://127.0.0.1:1234/v2", "zoom_oauth_uri": "http://127.0.0.1:1234/oauth/token"}
+        zoom = Zoom(self.config)
+        self.assertEqual({"base_uri": "http://127.0.0.1:1234/v2", "oauth_uri": "http://127.0.0.1:1234/oauth/token"}, zoom.client_overrides)
+
+    def test_parseJsonCleans(self):
+        body = json.dumps({"topic": "Zero\u200bwidth", "recording_files": [{"id": "a\u200b", "file_size": 12}], "tags": ["b\u200b"]})
+        for content in (body, body.encode('utf-8'), json.dumps(json.loads(body), ensure_ascii=False).encode('utf-8')):
+            parsed = parse_json(content)
+            self.assertEqual("Zerowidth", parsed["topic"])
+            self.assertEqual("a", parsed["recording_files"][0]["id"])
+            self.assertEqual(12, parsed["recording_files"][0]["file_size"])
+            self.assertEqual(["b"], parsed["tags"])
+        #A literal backslash followed by u200b is not a zero width space
+        self.assertEqual("\\u200b", parse_json(json.dumps({"topic": "\\u200b"}))["topic"])
+
+    def test_cleanerIsIterative(self):
+        zoom = Zoom(self.config)
+        nested = {"value": "deep\u200b"}
+        outer = nested
+        for i in range(5000):
+            outer = {"child": [ outer ]}
+        zoom._cleaner(outer)
+        self.assertEqual("deep", nested["value"])
+
+    def test_iterUserRecordings(self):
+        zoom = Zoom(self.config)
+        pages = [ dict(self.available_recordings, next_page_token="page2"), dict(self.available_recordings, next_page_token="") ]
+        zoom._get_user_recordings = MagicMock(side_effect=pages)
+        self.assertEqual(pages, list(zoom.iter_user_recordings("user")))
+        self.assertEqual("page2", zoom._get_user_recordings.call_args_list[1][0][4])
+
+    def test_getUserRecordingsSinglePage(self):
+        fd, dbfile = tempfile.mkstemp()
+        try:
+            zingest.db.init({'Database': {'database': 'sqlite:///' + dbfile}})
+            zoom = Zoom(self.config)
+            zoom.get_user = MagicMock()
+            zoom.get_user_name = MagicMock(return_value="Logan, Greg")
+            meetings = self.available_recordings['meetings']
+            pages = [ dict(self.available_recordings, meetings=meetings[:1], next_page_token="page2"),
+                      dict(self.available_recordings, meetings=meetings[1:], next_page_token="") ]
+            zoom._get_user_recordings = MagicMock(side_effect=pages)
+            renderable = zoom.get_user_recordings("user")
+            #The UI's page size limits what's rendered, later pages aren't fetched
+            self.assertEqual(1, zoom._get_user_recordings.call_count)
+            self.assertEqual([ meetings[0]['uuid'] ], [ recording['id'] for recording in renderable ])
+            self.assertEqual([ "new" ], [ recording['status'] for recording in renderable ])
+        finally:
+            os.close(fd)
+            os.remove(dbfile)
+
+    def test_trashRecording(self):
+        zoom = Zoom(self.config)
+        client = MagicMock()
+        client.recording.delete.__qualname__ = "RecordingComponentV2.delete"
+        client.recording.delete.return_value = MagicMock(status_code=204, content=b"")
+        zoom._get_zoom_client = MagicMock(return_value=client)
+        self.assertEqual({}, zoom.trash_recording("/abc//def=="))
+        client.recording.delete.assert_called_once_with(meeting_id="%252Fabc%252F%252Fdef%253D%253D", action="trash")
+        with self.assertRaises(ValueError):
+            zoom.trash_recording(None)
+
+    def test_fetchRecordingBypassesCache(self):
+        fd, dbfile = tempfile.mkstemp()
+        try:
+            zingest.db.init({'Database': {'database': 'sqlite:///' + dbfile}})
+            zoom = Zoom(self.config)
+            client = MagicMock()
+            client.recording.get.__qualname__ = "RecordingComponentV2.get"
+            client.recording.get.side_effect = lambda **kwargs: MagicMock(status_code=200, content=json.dumps(self.event['object']).encode())
+            zoom._get_zoom_client = MagicMock(return_value=client)
+            zoom.get_recording("uuid")
+            zoom.get_recording("uuid")
+            self.assertEqual(1, client.recording.get.call_count)
+            #Anything stored with an ingest has to be as fresh as the time it's stored with
+            zoom.fetch_recording("uuid")
+            self.assertEqual(2, client.recording.get.call_count)
+        finally:
+            os.close(fd)
+            os.remove(dbfile)
+
     def validate_bad_data(self, payload):
         zoom = Zoom(self.config)
         with self.assertRaises(BadWebhookData):
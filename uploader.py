@@ -5,12 +5,17 @@ import sys
 import threading
 import time
 
-from flask import Flask
+from flask import Flask, Response
 
 import zingest.db
+from zingest import metrics, timing
 from logger import init_logger
+from zingest.async_engine import AsyncIngestEngine
+from zingest.cleanup import ZoomCleaner
+from zingest.common import get_config_ignore
 from zingest.opencast import Opencast
 from zingest.rabbit import Rabbit
+from zingest.scheduler import IngestScheduler
 from zingest.zoom import Zoom
 
 init_logger()
@@ -35,6 +40,7 @@ except (NoSectionError, NoOptionError):
     enable_email = False
 
 zingest.db.init(config)
+timing.init(config, "zoom-ingest-uploader")
 z = Zoom(config)
 r = Rabbit(config, z)
 o = Opencast(config, r, z, enable_email)
@@ -51,23 +57,55 @@ def run_and_notify_about(thing):
                 logger.exception("Zoom Uploader general error, will retry in 10 seconds...")
             time.sleep(10)
 
-thread = threading.Thread(
-        target=run_and_notify_about(o.run),
-        daemon=True)
-thread.start()
+try:
+    engine = get_config_ignore(config, "Uploader", "engine", True).strip().lower()
+except KeyError:
+    engine = None
+
+#NB: Pass the function and its argument separately, calling it here would run the loop in this thread instead
+if engine == "asyncio":
+    async_engine = AsyncIngestEngine(config, o)
+    thread = threading.Thread(target=run_and_notify_about, args=(async_engine.start,), daemon=True)
+    thread.start()
+else:
+    thread = threading.Thread(target=run_and_notify_about, args=(o.run,), daemon=True)
+    thread.start()
 
-thread = threading.Thread(
-        target=run_and_notify_about(o.process_backlog),
-        daemon=True)
+#Releases deferred ingests into the queue as their lanes open, and any whose messages were lost
+scheduler = IngestScheduler.from_config(config, r)
+thread = threading.Thread(target=run_and_notify_about, args=(scheduler.run,), daemon=True)
 thread.start()
 
+if o.workflow_poller:
+    thread = threading.Thread(target=run_and_notify_about, args=(o.workflow_poller.run,), daemon=True)
+    thread.start()
+
+cleaner = ZoomCleaner.from_config(config, z)
+if cleaner:
+    if not o.workflow_poller:
+        logger.warning("Removing recordings from Zoom needs the workflow poller, no recordings will be removed")
+    thread = threading.Thread(target=run_and_notify_about, args=(cleaner.run,), daemon=True)
+    thread.start()
+
 
 app = Flask(__name__)
 
 @app.route('/', methods=['GET'])
 def get_index():
-    return "Doc links, links to /count"
+    return "Doc links, links to /count and /metrics"
 
 @app.route('/count', methods=['GET'])
-def get_count():
-    return "Count of currently ingesting recordings is: "
+@zingest.db.with_session
+def get_count(dbs):
+    count = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.status == zingest.db.Status.IN_PROGRESS).count()
+    return f"Count of currently ingesting recordings is: { count }"
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    metrics.update_catalog_ages(o)
+    try:
+        metrics.update_queue_depth(r)
+    except Exception as e:
+        logger.warning(f"Unable to determine queue depth: { repr(e) }")
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
@@ -2,21 +2,25 @@ import configparser
 import logging
 import os.path
 import sys
+import time
 import urllib.parse
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 from urllib.parse import urlencode, parse_qs
 from requests import HTTPError
 import hmac
 import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from flask import Flask, request, render_template, render_template_string, redirect
+from flask import Flask, g, request, render_template, render_template_string, redirect, Response, jsonify, make_response
 
-from zingest import db
+from zingest import db, http_cache, metrics, profiling, timing
 from logger import init_logger
 from zingest.common import BadWebhookData, NoMp4Files, get_config_ignore
 from zingest.filter import RegexFilter
+from zingest.idempotency import EventLedger
 from zingest.opencast import Opencast
 from zingest.rabbit import Rabbit
+from zingest.scheduler import IngestScheduler
 from zingest.zoom import Zoom
 
 MIN_DURATION = 0
@@ -84,16 +88,38 @@ except ValueError as err:
     sys.exit("Invalid value, integer expected : {0}".format(err))
 
 db.init(config)
+timing.init(config, "zoom-ingest-webhook")
 z = Zoom(config)
 r = Rabbit(config, z)
 o = Opencast(config, r, z)
 
 recording_filter = RegexFilter(config)
+#Webhook events (and webhook ingests) which have already been handled
+events = EventLedger()
+#Decides whether new ingests go to the uploader straight away, or wait for the uploader's scheduler to release them
+scheduler = IngestScheduler.from_config(config, r)
 
 app = Flask(__name__)
+#Opt-in, per request profiling.  This is a no-op unless enabled in the config.
+app.wsgi_app = profiling.wrap(app.wsgi_app, config)
+http_cache.init(app)
+#The catalog <select>s are rendered once per catalog version, rather than looping over the catalog on every request
+app.jinja_env.globals['catalog_options'] = lambda name: o.get_catalog(name).options()
+
+#How many Zoom lookups a bulk ingest makes at once
+BULK_ZOOM_THREADS = 8
+#Pages showing data from Zoom are re-rendered at least this often (in seconds), even if nothing else has changed
+ZOOM_PAGE_VALIDITY = 300
+#Changes whenever the templates do, ie on upgrade
+TEMPLATE_VERSION = max(os.path.getmtime(os.path.join(app.root_path, app.template_folder, name)) for name in os.listdir(os.path.join(app.root_path, app.template_folder)))
 
 ## Utility Methods
 
+def page_validators():
+    #Everything the UI pages render, other than the query parameters which are part of the ETag anyway
+    catalogs = [ o.get_catalog(name).version for name in ('series', 'acls', 'workflows') ]
+    return [ TEMPLATE_VERSION, catalogs, db.get_data_version(), int(time.time() // ZOOM_PAGE_VALIDITY) ]
+
 def validate_date(date_obj):
     if not date:
         logger.error(f"Date object is None")
@@ -148,6 +174,7 @@ def build_query_string(param_dict = None, overrides = None):
 ## List of recordings for a single user,
 
 @app.route('/recordings/<user_id>', methods=['GET'])
+@http_cache.conditional(page_validators)
 def do_list_recordings(user_id):
     try:
         query_params = get_query_params()
@@ -167,9 +194,6 @@ def do_list_recordings(user_id):
                 'user': user,
                 'month_back': month_back,
                 'month_forward': month_forward,
-                'workflow_list': o.get_workflows(),
-                'series_list': o.get_series(),
-                'acl_list': o.get_acls(),
             }
         params.update(query_params)
         params['origin_page'] = f"/recordings/{ user_id }"
@@ -182,12 +206,14 @@ def do_list_recordings(user_id):
         return render_template("list-user-recordings.html", **params)
     except Exception as e:
         logger.exception(f"Unable to render recording list for { user_id }")
+        http_cache.uncacheable()
         return render_template("error.html", message = repr(e))
 
 
 ## Handling of a single recording
 
 @app.route('/recording/<path:recording_id>', methods=['GET', 'POST'])
+@http_cache.conditional(page_validators)
 def single_recording(recording_id):
     try:
         # We should double quote the recording_id as it may contain, start or end with an /
@@ -214,11 +240,12 @@ def single_recording(recording_id):
             params = {
                 'recording': renderable,
                 'workflow': workflow_id,
-                'workflow_list': o.get_workflows(),
                 'series': series,
-                'series_list': o.get_series(),
+                #Only the preselected choices are rendered, the rest are loaded from the catalog API as the user types
+                'series_label': o.get_catalog('series').get_label(series_id),
                 'acl': acl,
-                'acl_list': o.get_acls(),
+                'acl_id': acl_id if acl else None,
+                'acl_label': o.get_catalog('acls').get_label(acl_id) if acl else None,
                 'visibility': EPISODE_FIELDS,
                 'series_create_enabled': SERIES_CREATE_ENABLED,
             }
@@ -230,9 +257,11 @@ def single_recording(recording_id):
             origin_page, query_string = _ingest_single_recording(recording_id_decoded, dur_check)
             return redirect(f'{ origin_page }?{ query_string }')
     except HTTPError as e:
+        http_cache.uncacheable()
         return render_template("error.html", message = f"Recording not found.  Zoom may still be processing this recording, try again in a few minutes")
     except Exception as e:
         logger.exception(f"Unable to render or ingest recording { recording_id }")
+        http_cache.uncacheable()
         return render_template("error.html", message = repr(e))
 
 
@@ -264,8 +293,6 @@ def get_series_list(series_id=None):
             params = {
                 'origin_epid': request.args.get('epid', ""),
                 'series': series,
-                'acl_list': o.get_acls(),
-                'theme_list': o.get_themes(),
                 'visibility': EPISODE_FIELDS,
             }
             params.update(query_params)
@@ -291,6 +318,7 @@ def get_series_list(series_id=None):
 
 @app.route('/', methods=["GET"])
 @app.errorhandler(400)
+@http_cache.conditional(page_validators)
 def do_search():
     try:
         query_params = get_query_params()
@@ -333,9 +361,6 @@ def do_search():
         params['next_token'] = token_quoted if token_quoted != None else ''
         params['recordings'] = recordings
         params['users'] = users
-        params['workflow_list'] = o.get_workflows()
-        params['series_list'] = o.get_series()
-        params['acl_list'] = o.get_acls()
 
         params['origin_page'] = "/"
         params['query_string'] = build_query_string(params)
@@ -343,9 +368,12 @@ def do_search():
         params['dur_disable_qs'] = build_query_string(params, {'dur_check': 'false'})
         params['more_qs'] = build_query_string(params, {'token': token_quoted})
 
+        if 'message' in params:
+            http_cache.uncacheable()
         return render_template("search.html", **params )
     except Exception as e:
         logger.exception(f"Unable to render search")
+        http_cache.uncacheable()
         return render_template("error.html", message = repr(e))
 
 ## Bulk ingest support
@@ -368,8 +396,11 @@ def do_bulk():
             return render_template_string("No workflow ID set"), 400
         logger.debug(f"Bulk ingest with workflow { workflow_id } and acl id { acl_id } to series { series_id }")
 
-        for event_id in event_ids:
-            origin_page, query_string = _ingest_single_recording(event_id, dur_check)
+        params = { key: value for key, value in form_params.items() if not key.startswith("origin") and not key.startswith("bulk_") and not '' == value }
+        params['is_webhook'] = False
+        params['dur_check'] = dur_check
+        queued, skipped = _queue_recordings(event_ids, params)
+        logger.info(f"Bulk ingest queued { queued } recordings, skipped { len(skipped) }")
 
         logger.debug(f"Referrer is { request.referrer }")
         if request.referrer:
@@ -385,8 +416,37 @@ def do_bulk():
 
 @app.route('/webhook', methods=['POST'])
 @app.errorhandler(400)
+def do_POST():
+    #Report where the time went (HMAC, validation, DB, Zoom, publishing) in a Server-Timing header
+    try:
+        with timing.collect() as timings:
+            response = make_response(_handle_webhook())
+    except Exception:
+        _release_claims()
+        raise
+    if response.status_code >= 500:
+        #Let Zoom's retry through
+        _release_claims()
+    response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+def _release_claims():
+    for key in (g.get('webhook_event_key', None), g.get('webhook_ingest_key', None)):
+        if key:
+            try:
+                events.release(key)
+            except Exception:
+                logger.exception("Unable to release webhook claim, a retry of this event will be ignored")
+
+def _webhook_event_key(body):
+    #Zoom's events don't carry an id, but a retry or repeat of an event has the same type, timestamp and recording
+    try:
+        return EventLedger.key(body['event'], body['event_ts'], body['payload']['object']['uuid'])
+    except (KeyError, TypeError):
+        return None
+
 @db.with_session
-def do_POST(dbs):
+def _handle_webhook(dbs):
     logger.debug("POST received")
 
 #Check UTF8 safeness of this
@@ -397,10 +457,11 @@ def do_POST(dbs):
     #First check that the request originated from Zoom using the webhook secret
     if WEBHOOK_SECRET:
         #NB: body (above) formats the incoming json.  This message must contain *exactly* what Zoom sends since it's being hashed, so we use the raw request.data way instead.
-        message = f"v0:{ zoom_req_ts }:{ request.data.decode('utf-8') }"
-        calc_hmac = "v0=" + hmac.new(key=WEBHOOK_SECRET.encode('utf-8'),
-                             msg=message.encode('utf-8'),
-                             digestmod=hashlib.sha256).hexdigest()
+        with timing.span('hmac'):
+            message = f"v0:{ zoom_req_ts }:{ request.data.decode('utf-8') }"
+            calc_hmac = "v0=" + hmac.new(key=WEBHOOK_SECRET.encode('utf-8'),
+                                 msg=message.encode('utf-8'),
+                                 digestmod=hashlib.sha256).hexdigest()
         if zoom_req_hmac != calc_hmac:
             logger.error("Request signature does not match")
             return render_template_string("Request signature does not match"), 400
@@ -435,24 +496,38 @@ def do_POST(dbs):
     payload = body["payload"]
     event_type = body["event"]
     obj = None
+
+    #Zoom retries deliveries, and sometimes sends the same event more than once, so drop repeats before doing any work
+    event_key = _webhook_event_key(body)
+    if event_key:
+        with timing.span('dedup'):
+            claimed = events.claim(event_key, payload['object']['uuid'])
+        if not claimed:
+            logger.info(f"Ignoring duplicate { event_type } event for { payload['object']['uuid'] }")
+            return f"Duplicate { event_type } event, ignored"
+        g.webhook_event_key = event_key
     try:
-        z.validate_recording_payload(payload)
+        with timing.span('validate'):
+            z.validate_recording_payload(payload)
         obj = payload['object']
         if "recording.completed" == event_type:
             logger.debug(f"Validating recording.completed event")
-            z.validate_recording_object(obj)
+            with timing.span('validate'):
+                z.validate_recording_object(obj)
             logger.debug(f"Validated recording.completed event for { obj['uuid'] }, processing.")
         elif "recording.renamed" == event_type:
             logger.debug(f"Validating recording.renamed event")
-            z.validate_recording_renamed(payload)
+            with timing.span('validate'):
+                z.validate_recording_renamed(payload)
             uuid = obj['uuid']
             new_title = obj['topic'].replace('\u200b', '')
-            existing_db_recording = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
-            if existing_db_recording:
-                existing_db_recording.set_title(new_title)
-                dbs.merge(existing_db_recording)
-                dbs.commit()
-            existing_db_ingest = dbs.query(db.Ingest).filter(db.Ingest.uuid == uuid).all()
+            with timing.span('db'):
+                existing_db_recording = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
+                if existing_db_recording:
+                    existing_db_recording.set_title(new_title)
+                    dbs.merge(existing_db_recording)
+                    dbs.commit()
+                existing_db_ingest = dbs.query(db.Ingest).filter(db.Ingest.uuid == uuid).all()
             if len(existing_db_ingest) > 1:
                 workflow_ids = [ existing.get_workflow_id() for existing in existing_db_ingest ]
                 logger.debug(f"Received a rename event for event { uuid }, renamed to { new_title }.  No further processing, already ingested as workflow(s) { ', '.join(workflow_ids) }.")
@@ -465,7 +540,8 @@ def do_POST(dbs):
             #before this line it's a small blob giving you the uuid and new name
             obj = z.get_recording(uuid)
             #Validate it again, just in case Zoom changes something
-            z.validate_recording_object(obj)
+            with timing.span('validate'):
+                z.validate_recording_object(obj)
             #We're seeing the occasional issue where the rename event fires, but the response from Zoom contains the *old* name.
             #So we override it here.
             obj['topic'] = new_title
@@ -507,27 +583,89 @@ def do_POST(dbs):
     if len(WEBHOOK_ACL) > 0:
         zingest_params['acl_id'] = WEBHOOK_ACL
 
-    return _queue_recording(uuid, zingest_params, token)
+    #The event carries the whole recording, so the rest of the pipeline doesn't need to fetch it again
+    return _queue_recording(uuid, zingest_params, token, recording=obj)
+
+## Monitoring
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    metrics.update_catalog_ages(o)
+    try:
+        metrics.update_queue_depth(r)
+    except Exception as e:
+        logger.warning(f"Unable to determine queue depth: { repr(e) }")
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+## Job status API
+#NB: These read the live progress store written by the uploader, rather than the database, so they're cheap to poll
+
+@app.route('/api/ingests', methods=['GET'])
+def get_ingests_status():
+    return jsonify({ 'ingests': o.progress_store.read_all() })
+
+@app.route('/api/ingests/<int:ingest_id>', methods=['GET'])
+@db.with_session
+def get_ingest_status(dbs, ingest_id):
+    state = o.progress_store.read(ingest_id)
+    if state:
+        return jsonify(state)
+    #Not running, and not recently finished, so all we have is what's in the database
+    ingest = dbs.query(db.Ingest).filter(db.Ingest.ingest_id == ingest_id).one_or_none()
+    if not ingest:
+        return jsonify({ 'error': f"No such ingest { ingest_id }" }), 404
+    state = ingest.serialize()
+    state['ingest_id'] = ingest.get_id()
+    state['status'] = ingest.status_str()
+    return jsonify(state)
+
+## Catalog API
+#NB: The UI's series, ACL and workflow choices are loaded from here as the user types, rather than embedded in every page
+
+@app.route('/api/catalogs/<name>', methods=['GET'])
+def get_catalog(name):
+    try:
+        index = o.get_catalog(name)
+    except KeyError:
+        return jsonify({ 'error': f"No such catalog { name }" }), 404
+    prefix = request.args.get('q', "")
+    try:
+        limit = int(request.args.get('limit', index.DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({ 'error': "limit must be an integer" }), 400
+    #Browsers revalidate with the ETag each time, and get a 304 unless the catalog has changed in the meantime
+    etag = index.etag(prefix, limit)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(index.render(prefix.strip(), limit), content_type='application/json')
+    #Weak, since the same response may be sent compressed or not
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 ## Actually ingesting the recording (validating things, creating the rabbit message)
 
 @db.with_session
-def _queue_recording(dbs, uuid, zingest, token=None):
+def _queue_recording(dbs, uuid, zingest, token=None, recording=None):
 
     logger.debug(f"_queue_recording called with { uuid } and { zingest }")
     #Check if the recording exists, and create it if it does not
     #Check if the uuid is a uuid
-    uuid_rec = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
+    with timing.span('db'):
+        uuid_rec = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
     if uuid_rec:
         logger.debug(f"Found recording by uuid")
     #Check if the uuid is actually the raw db ID (used in bulk ingest)
-    id_rec = dbs.query(db.Recording).filter(str(db.Recording.rec_id) == uuid).one_or_none()
+    with timing.span('db'):
+        id_rec = dbs.query(db.Recording).filter(str(db.Recording.rec_id) == uuid).one_or_none()
     if id_rec:
         logger.debug(f"Found recording by raw id")
     #Still doesn't exist?  Create it then.
     if not uuid_rec and not id_rec:
         logger.debug(f"{ uuid } is not in the database, adding it")
-        existing_rec = z.create_recording_from_uuid(uuid)
+        existing_rec = z.create_recording_from_uuid(uuid, recording)
     else:
         existing_rec = uuid_rec if uuid_rec else id_rec
 
@@ -553,12 +691,49 @@ def _queue_recording(dbs, uuid, zingest, token=None):
     elif not recording_filter.matches(existing_rec.get_title()) and is_webhook: #Only filter on webhook events
         logger.info(f"Recording { db_uuid } does not match the configured filter")
         return render_template_string(f"Recording { db_uuid } did not match configured filter(s) and has been dropped"), 200
-    elif is_webhook and dbs.query(db.Ingest).filter(db.Ingest.uuid == db_uuid, db.Ingest.webhook_ingest == True).one_or_none():
+    elif is_webhook and not _claim_webhook_ingest(dbs, db_uuid):
         logger.info(f"Not creating a new ingest for { db_uuid } via webhook event because it has already created one")
         return render_template_string(f"Not creating a new ingest for { db_uuid } via webhook event because it has already created one"), 200
 
-    #Ensure the required metadata is all present
-    renderable = z.get_renderable_recording(db_uuid)
+    #Ensure the required metadata is all present.  Unless it came with a webhook event this is the only time we fetch the
+    #recording, and it is stored with the ingest so that the uploader can use it too (see Ingest.set_zoom_recording())
+    if not recording:
+        recording = z.fetch_recording(db_uuid)
+    renderable = z.get_renderable_recording(db_uuid, recording)
+    _complete_params(zingest, renderable)
+
+    lane = IngestScheduler.lane_for(zingest)
+    not_before = _pop_not_before(zingest)
+    immediate = scheduler.is_immediate(lane, not_before)
+
+    #Create the ingest record
+    logger.debug(f"Creating ingest record for { db_uuid } with params { zingest }")
+    with timing.span('db'):
+        ingest_id = db.create_ingest(db_uuid, zingest, recording, lane=lane, not_before=not_before, released=datetime.utcnow() if immediate else None)
+
+    if not immediate:
+        logger.info(f"Scheduled ingest { ingest_id } of { db_uuid } in the { lane } lane, not before { not_before }")
+        return f"Successfully scheduled { db_uuid } as { ingest_id }"
+
+    logger.debug(f"Sending rabbit message to ingest { db_uuid } with params { ingest_id }")
+    r.send_rabbit_msg(db_uuid, ingest_id)
+
+    logger.debug("POST processed successfully")
+    return f"Successfully sent { db_uuid } and { ingest_id } to rabbit"
+
+def _pop_not_before(zingest):
+    """
+    Remove the optional not_before parameter (a local date and time, ie from a datetime-local input) from the ingest
+    parameters, since it isn't for Opencast.
+
+    :return: The time in UTC, or None
+    """
+    value = zingest.pop('not_before', None)
+    if not value:
+        return None
+    return datetime.fromisoformat(value).astimezone(timezone.utc).replace(tzinfo=None)
+
+def _complete_params(zingest, renderable):
     for el in ('title', 'date', 'time', 'duration'):
         if el not in zingest:
             zingest[el] = renderable[el]
@@ -574,15 +749,92 @@ def _queue_recording(dbs, uuid, zingest, token=None):
     if "creator" not in zingest:
         zingest["creator"] = renderable["host"]
 
-    #Create the ingest record
-    logger.debug(f"Creating ingest record for { db_uuid } with params { zingest }")
-    ingest_id = db.create_ingest(db_uuid, zingest)
-
-    logger.debug(f"Sending rabbit message to ingest { db_uuid } with params { ingest_id }")
-    r.send_rabbit_msg(db_uuid, ingest_id)
+def _fan_out(fn, things):
+    """
+    Call fn on each of things concurrently, returning a dict of thing to result.  Failures are logged and left out.
+    """
+    results = {}
+    if len(things) == 0:
+        return results
+    with ThreadPoolExecutor(max_workers=min(BULK_ZOOM_THREADS, len(things))) as pool:
+        futures = { pool.submit(timing.propagate(fn), thing): thing for thing in things }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logger.warning(f"Unable to fetch { futures[future] } from Zoom: { repr(e) }")
+    return results
+
+def _queue_recordings(recording_ids, zingest):
+    """
+    The batch version of _queue_recording(), for manual ingests of many recordings at once.  The recordings are looked
+    up with a single query, any which aren't in the database yet (and their hosts' names) are fetched from Zoom
+    concurrently, every ingest is created in a single transaction, and the messages are all sent over one connection.
+
+    :return: The number of ingests queued, and a dict of each skipped recording id to why it was skipped
+    """
+    recording_ids = list(dict.fromkeys(recording_ids))
+    skipped = {}
+    lane = IngestScheduler.lane_for(zingest, bulk=True)
+    not_before = _pop_not_before(zingest)
+    immediate = scheduler.is_immediate(lane, not_before)
+    check_duration = zingest['dur_check'] if 'dur_check' in zingest else True
 
-    logger.debug("POST processed successfully")
-    return f"Successfully sent { db_uuid } and { ingest_id } to rabbit"
+    with timing.span('db'):
+        recordings = db.find_recordings(recording_ids)
+    missing = [ recording_id for recording_id in recording_ids if recording_id not in recordings ]
+    fetched = {}
+    if len(missing) > 0:
+        logger.debug(f"Fetching { len(missing) } recordings which are not in the database from Zoom")
+        fetched = _fan_out(z.fetch_recording, missing)
+        found = [ recording_id for recording_id in missing if recording_id in fetched ]
+        with timing.span('db'):
+            created = db.create_recordings([ { key: fetched[recording_id][key] for key in ('uuid', 'host_id', 'start_time', 'topic', 'duration') } for recording_id in found ])
+        recordings.update(zip(found, created))
+
+    names = _fan_out(z.get_user_name, list({ rec.get_user_id() for rec in recordings.values() }))
+
+    ingests = []
+    for recording_id in recording_ids:
+        rec = recordings.get(recording_id, None)
+        if not rec:
+            skipped[recording_id] = "not found"
+        elif check_duration and rec.get_duration() < MIN_DURATION:
+            skipped[recording_id] = "too short"
+        elif rec.get_user_id() not in names:
+            skipped[recording_id] = "unable to look up the host"
+        else:
+            params = dict(zingest)
+            renderable = rec.serialize()
+            renderable['host'] = names[rec.get_user_id()]
+            _complete_params(params, renderable)
+            #Recordings we've just fetched are stored with the ingest, the uploader fetches the rest itself
+            ingests.append((rec.get_rec_id(), params, fetched.get(recording_id, None)))
+    for recording_id, reason in skipped.items():
+        logger.warning(f"Not ingesting { recording_id }: { reason }")
+
+    logger.debug(f"Creating { len(ingests) } ingest records")
+    with timing.span('db'):
+        ingest_ids = db.create_ingests(ingests, lane=lane, not_before=not_before, released=datetime.utcnow() if immediate else None)
+    if immediate:
+        r.send_rabbit_msgs([ (uuid, ingest_id) for (uuid, _, _), ingest_id in zip(ingests, ingest_ids) ])
+    else:
+        logger.info(f"Scheduled { len(ingest_ids) } ingests in the { lane } lane, not before { not_before }")
+    return len(ingest_ids), skipped
+
+def _claim_webhook_ingest(dbs, uuid):
+    """
+    Each recording is only ingested once via the webhook.  The claim makes this hold even when several workers get
+    (different) events for the same recording at once, the query covers ingests older than the claims.
+    """
+    key = EventLedger.key('webhook-ingest', uuid)
+    with timing.span('db'):
+        if dbs.query(db.Ingest.ingest_id).filter(db.Ingest.uuid == uuid, db.Ingest.webhook_ingest == True).first():
+            return False
+        if not events.claim(key, uuid):
+            return False
+    g.webhook_ingest_key = key
+    return True
 
 
 if __name__ == "__main__":
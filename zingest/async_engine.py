@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+
+from zingest import db, metrics, sequence
+from zingest.async_opencast import AsyncOpencast
+from zingest.async_zoom import AsyncZoom
+from zingest.common import get_config_ignore
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+
+class AsyncIngestEngine:
+    """
+    Runs the uploader on a single asyncio event loop instead of a thread per ingest.
+
+    Messages are consumed from RabbitMQ with aio-pika, and each one becomes a task which fetches the recording from
+    Zoom, downloads its media and ingests it into Opencast, with all of the network I/O done asynchronously (see
+    AsyncZoom and AsyncOpencast).  The ingest itself is the same sequence the threaded uploader runs, see
+    zingest.sequence.  Database work is short and blocking, so it runs in the default thread pool via
+    asyncio.to_thread().  At most concurrency ingests run at once: RabbitMQ never hands us more unacknowledged
+    messages than that.  Since media is streamed to and from disk the memory used stays flat however many ingests are
+    in flight.
+
+    Messages are acknowledged once the ingest has been attempted, as the threaded uploader does.  Ingests whose
+    messages are lost are released again by the scheduler (see IngestScheduler).
+    """
+
+    DEFAULT_CONCURRENCY = 20
+    QUEUE = "zoomhook"
+
+    def __init__(self, config, opencast, concurrency=None, zoom=None, transfers=None):
+        self.logger = logging.getLogger(__name__)
+        self.opencast = opencast
+        self.rabbit = opencast.rabbit
+        if concurrency is None:
+            try:
+                concurrency = get_config_ignore(config, "Uploader", "concurrency", True)
+            except KeyError:
+                concurrency = None
+            if not concurrency or len(str(concurrency).strip()) == 0:
+                concurrency = self.DEFAULT_CONCURRENCY
+        self.concurrency = int(concurrency)
+        self.zoom = zoom if zoom else AsyncZoom(config, tokens=opencast.zoom.tokens)
+        self.transfers = transfers if transfers else AsyncOpencast(opencast, self.zoom, max_connections=self.concurrency)
+        self.slots = None
+        #Ingests which are running, or waiting for a slot
+        self.active = set()
+        self.tasks = set()
+        self.logger.info(f"Asyncio ingest engine running up to { self.concurrency } ingests at once")
+
+    def start(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        #Created here so that it belongs to this event loop, start() is called again after a failure
+        self.slots = asyncio.Semaphore(self.concurrency)
+        async with self.zoom, self.transfers:
+            try:
+                await self.consume()
+            finally:
+                #Let anything already running finish, rather than leaving it in progress
+                if self.tasks:
+                    await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def _spawn(self, coroutine):
+        #Keep a reference to every task, otherwise the event loop may garbage collect them mid-ingest
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def consume(self):
+        if not aio_pika:
+            raise RuntimeError("The asyncio uploader engine requires aio-pika, please install it (pip3 install aio-pika)")
+        self.logger.info("Consuming rabbits")
+        connection = await aio_pika.connect_robust(host=self.rabbit.rabbit_url, login=self.rabbit.rabbit_user, password=self.rabbit.rabbit_pass)
+        async with connection:
+            channel = await connection.channel()
+            await channel.set_qos(prefetch_count=self.concurrency)
+            queue = await channel.declare_queue(self.QUEUE)
+            async with queue.iterator() as messages:
+                async for message in messages:
+                    self._spawn(self.on_message(message))
+
+    async def on_message(self, message):
+        try:
+            await self.handle_message(message.body)
+        finally:
+            await message.ack()
+
+    async def handle_message(self, body):
+        j = json.loads(body)
+        rec_id = j['uuid']
+        ing_id = int(j['ingest_id'])
+        self.logger.debug(f"Received rabbit message to ingest { rec_id } with id { ing_id }")
+        await self.process(ing_id)
+
+    async def process(self, ingest_id):
+        if ingest_id in self.active:
+            self.logger.debug(f"Ingest { ingest_id } is already queued or running, ignoring")
+            return
+        self.active.add(ingest_id)
+        try:
+            async with self.slots:
+                with metrics.INGESTS_IN_FLIGHT.track_inprogress():
+                    await self._process(ingest_id)
+        finally:
+            self.active.discard(ingest_id)
+
+    async def _process(self, ingest_id):
+        ingest = await asyncio.to_thread(_find_ingest, ingest_id)
+        if not ingest:
+            self.logger.warning(f"Asked to ingest an invalid ingest id of { ingest_id }.")
+            return
+        uuid = ingest.get_recording_id()
+        if ingest.status in [ db.Status.FINISHED, db.Status.WARNING ]:
+            #ie, a message redelivered after a connection drop
+            self.logger.info(f"{ uuid }: Ingest { ingest_id } has already finished, ignoring")
+            return
+        if ingest.is_held():
+            #The scheduler will send it again when it's due
+            self.logger.info(f"{ uuid }: Ingest { ingest_id } has not been released yet, ignoring")
+            return
+        await sequence.run_async(self.opencast._attempt(ingest, self.transfers.TRANSFER_ERRORS), self.transfers)
+
+
+@db.with_session
+def _find_ingest(dbs, ingest_id):
+    #NB: The ingest is detached once the session closes, changes are written back with Opencast.save_ingest()
+    return dbs.query(db.Ingest).filter(db.Ingest.ingest_id == ingest_id).one_or_none()
+
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import os
+import os.path
+import time
+from pathlib import Path
+
+import httpx
+
+from zingest import metrics, progress, timing
+from zingest.opencast import Opencast
+
+
+class AsyncOpencast:
+    """
+    asyncio flavour of the transport of zingest.opencast.Opencast: the Zoom, Opencast and database I/O which an ingest
+    sequence asks for (see zingest.sequence).  The sequence itself, and everything else (configuration, catalogs, file
+    selection, metadata rendering) comes from the Opencast instance it wraps, so both always ingest identically.
+
+    Media is streamed to and from disk in CHUNK_SIZE pieces, so memory use does not depend on the size of the
+    recordings, or on how many of them are in flight.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    #What the transfers raise when they fail, see Opencast._attempt()
+    TRANSFER_ERRORS = (httpx.HTTPError,)
+
+    def __init__(self, opencast, zoom, max_connections=20, transport=None):
+        self.logger = logging.getLogger(__name__)
+        self.opencast = opencast
+        self.zoom = zoom
+        self.url = opencast.url
+        self.max_connections = int(max_connections)
+        self.transport = transport
+        self.client = None
+        self.download_client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def _get_client(self):
+        #Created lazily so that everything belongs to the event loop we're actually running in
+        if not self.client:
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            #No overall timeout, as with the synchronous client, since Opencast can take a long time to accept big files
+            timeout = httpx.Timeout(None, connect=15)
+            self.client = httpx.AsyncClient(auth=httpx.DigestAuth(self.opencast.user, self.opencast.password),
+                                            headers=Opencast.HEADERS, limits=limits, timeout=timeout, transport=self.transport)
+            #Zoom's download urls redirect to its CDN
+            self.download_client = httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True, transport=self.transport)
+        return self.client
+
+    async def aclose(self):
+        if self.client:
+            await self.client.aclose()
+            await self.download_client.aclose()
+            self.client = None
+            self.download_client = None
+
+    async def download_file(self, recording_id, recording_file, extension_overrides={}):
+        recording_type = recording_file['recording_type']
+        dl_url = recording_file["download_url"]
+        expected_size = recording_file["file_size"]
+        uuid = recording_file["recording_id"]
+        extension = recording_file["file_extension"] if recording_type not in extension_overrides else extension_overrides[recording_type]
+        name = f"download:{ recording_type }"
+
+        cache = self.opencast.cache
+        if cache:
+            cached = await asyncio.to_thread(cache.get, uuid, expected_size, extension)
+            if cached:
+                self.logger.info(f"{ recording_id }: Using cached copy of file id { uuid } at { cached }")
+                return cached
+            temp = cache.temp_path(uuid, extension)
+            self.logger.debug(f"{ recording_id  }: Downloading file id { uuid } from { dl_url } to { temp }")
+            try:
+                await self._do_download(dl_url, temp, expected_size, name=name)
+            except BaseException:
+                await asyncio.to_thread(cache.discard, temp)
+                raise
+            return await asyncio.to_thread(cache.put, uuid, expected_size, extension, temp)
+
+        filename = f"{ self.opencast.IN_PROGRESS_ROOT }/{ uuid }.{ extension.lower() }"
+        self.logger.debug(f"{ recording_id  }: Downloading file id { uuid } from { dl_url } to { filename }")
+        await self._do_download(dl_url, filename, expected_size, name=name)
+        return filename
+
+    async def _do_download(self, url, output, expected_size, name='download'):
+        self._get_client()
+        Path(f"{ self.opencast.IN_PROGRESS_ROOT }").mkdir(parents=True, exist_ok=True)
+        if os.path.isfile(output) and expected_size == os.path.getsize(output):
+            self.logger.debug(f"{ output } already exists and is the right size")
+            return
+        start = time.perf_counter()
+        transfer = progress.stage(name, expected_size)
+        with timing.span('download'), open(output, 'wb') as fd:
+            for force in (False, True):
+                token = await self.zoom.get_bearer_access_token(force=force)
+                async with self.download_client.stream('GET', url, headers={"Authorization": f"Bearer { token }"}) as response:
+                    if response.status_code == 401 and not force:
+                        #The token was revoked or expired early, try once more with a new one
+                        continue
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(self.CHUNK_SIZE):
+                        fd.write(chunk)
+                        transfer.advance(len(chunk))
+                break
+        transfer.finish()
+        duration = time.perf_counter() - start
+        if os.path.isfile(output):
+            metrics.observe_transfer('download', os.path.getsize(output), duration)
+        if not os.path.isfile(output) or expected_size != os.path.getsize(output):
+            if os.path.isfile(output):
+                raise Exception(f"{ output } is the wrong size!  { expected_size } != { os.path.getsize(output) }")
+            raise Exception(f"{ output } is missing!")
+
+    async def _do_get(self, url):
+        self.logger.debug(f"GETting { url }")
+        return await self._get_client().get(url)
+
+    async def _do_post(self, url, data, files=None):
+        self.logger.debug(f"POSTing { data } to { url }")
+        #Everything goes in as a multipart 'file' so that field order is kept, see Opencast._oc_upload_single_request
+        fields = list(data.items()) if isinstance(data, dict) else list(data)
+        if files:
+            fields = fields + list(files.items())
+        multipart = []
+        readers = []
+        for name, value in fields:
+            if isinstance(value, tuple):
+                filename, content, mimetype = value
+                if hasattr(content, 'read'):
+                    content = _CountingReader(content)
+                    readers.append(content)
+                multipart.append((name, (filename, content, mimetype)))
+            else:
+                multipart.append((name, (None, str(value).encode('utf-8'))))
+        transfer = None
+        if readers:
+            #Only report the uploads which actually carry media, everything else is tiny
+            transfer = progress.stage(self.opencast._transfer_name(url, data), sum([ reader.size() for reader in readers ]))
+            for reader in readers:
+                reader.transfer = transfer
+        try:
+            return await self._get_client().post(url, files=multipart)
+        finally:
+            if transfer:
+                transfer.finish()
+
+    async def _element_available(self, url):
+        if not url:
+            return False
+        try:
+            response = await self._get_client().head(url, follow_redirects=True)
+            return 200 == response.status_code
+        except Exception as e:
+            self.logger.debug(f"Unable to check { url }: { repr(e) }")
+            return False
+
+    async def recording_exists(self, uuid):
+        return await asyncio.to_thread(self.opencast.recording_exists, uuid)
+
+    async def save_ingest(self, ingest):
+        await asyncio.to_thread(self.opencast.save_ingest, ingest)
+
+    async def fetch_recording(self, uuid):
+        return await self.zoom.get_recording(uuid)
+
+    async def get_recording_files(self, uuid, recording):
+        return await self.zoom.get_recording_files(uuid, recording)
+
+    async def _rm(self, path):
+        await asyncio.to_thread(self.opencast._rm, path)
+
+    async def _get_text(self, endpoint):
+        return (await self._do_get(f'{ self.url }/ingest/{ endpoint }')).text
+
+    async def _post_text(self, endpoint, data, files=None):
+        return (await self._do_post(f'{ self.url }/ingest/{ endpoint }', data, files)).text
+
+    async def _add_file(self, endpoint, flavor, mp, filename, mimetype):
+        start = time.perf_counter()
+        with open(filename, 'rb') as fobj:
+            result = await self._post_text(endpoint, {'flavor': flavor, 'mediaPackage': mp, 'fileName': os.path.basename(filename)}, { "BODY": (os.path.basename(filename), fobj, mimetype) })
+        metrics.observe_transfer('upload', os.path.getsize(filename), time.perf_counter() - start)
+        return result
+
+    async def _add_track_timed(self, flavor, mp, filename):
+        with timing.span(f"oc_upload:{ flavor }"):
+            return await self._add_file('addTrack', flavor, mp, filename, "video/mp4")
+
+
+class _CountingReader:
+    """
+    Wraps a file being uploaded, and reports how much of it has been read to a progress stage.
+    """
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.transfer = None
+        self.position = 0
+
+    def size(self):
+        return os.fstat(self.fobj.fileno()).st_size
+
+    def fileno(self):
+        return self.fobj.fileno()
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        self.position += len(data)
+        if self.transfer:
+            self.transfer.advance(len(data))
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        #httpx rewinds the file if it has to send it again, ie after a digest auth challenge
+        position = self.fobj.seek(offset, whence)
+        if self.transfer:
+            self.transfer.advance(position - self.position)
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.fobj.tell()
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from random import uniform
+from urllib.parse import quote
+
+import httpx
+import zoomus
+
+from zingest import db, metrics, timing
+from zingest.common import get_config, get_config_ignore
+from zingest.zoom import Zoom, parse_json
+
+
+class AsyncZoom:
+    """
+    asyncio flavour of zingest.zoom.Zoom, for batch work (user search, recording listing, host resolution) where
+    making one request at a time is the bottleneck.
+
+    Requests share a pooled httpx.AsyncClient, and at most max_concurrency of them are in flight at once, so it is safe
+    to asyncio.gather() large numbers of calls.  The OAuth token is fetched on first use and refreshed shortly before it
+    expires (or if Zoom rejects it).  Responses are cleaned exactly as the synchronous client cleans them.
+
+    Use as an async context manager, or call aclose() when done:
+        async with AsyncZoom(config) as zoom:
+            recordings = await asyncio.gather(*[ zoom.get_recording(uuid) for uuid in uuids ])
+    """
+
+    DEFAULT_BASE_URI = zoomus.client.API_BASE_URIS[2]
+    DEFAULT_OAUTH_URI = "https://zoom.us/oauth/token"
+    DEFAULT_CONCURRENCY = 10
+    #Refresh the token this long before Zoom says it will expire
+    TOKEN_MARGIN = timedelta(seconds=60)
+
+    #Share the normalization and parsing code with the synchronous client
+    validate_recording_object = Zoom.validate_recording_object
+    _validate_object_fields = Zoom._validate_object_fields
+    _parse_recording_files = Zoom._parse_recording_files
+    format_user_name = Zoom.format_user_name
+
+    def __init__(self, config, max_concurrency=DEFAULT_CONCURRENCY, transport=None, tokens=None):
+        self.logger = logging.getLogger(__name__)
+        self.oauth_account_id = get_config(config, 'Zoom', 'oauth_account_id')
+        self.oauth_client_id = get_config(config, 'Zoom', 'oauth_client_id')
+        self.oauth_client_secret = get_config(config, 'Zoom', 'oauth_client_secret')
+        self.gdpr = get_config(config, 'Zoom', 'GDPR').lower() == 'true'
+        self.base_uri = zoomus.client.API_BASE_URIS[zoomus.util.API_GDPR] if self.gdpr else self.DEFAULT_BASE_URI
+        self.oauth_uri = self.DEFAULT_OAUTH_URI
+        #Same undocumented testing overrides as the synchronous client
+        try:
+            self.base_uri = get_config_ignore(config, "TESTING", "zoom_base_uri", True)
+        except KeyError:
+            pass
+        try:
+            self.oauth_uri = get_config_ignore(config, "TESTING", "zoom_oauth_uri", True)
+        except KeyError:
+            pass
+        self.max_concurrency = int(max_concurrency)
+        self.transport = transport
+        #Optionally share a zingest.tokens.TokenManager (ie, the synchronous client's) rather than fetching our own
+        self.tokens = tokens
+        self.client = None
+        self.semaphore = None
+        self.token = None
+        self.token_exp = None
+        self.token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def _get_client(self):
+        #Created lazily so that everything belongs to the event loop we're actually running in
+        if not self.client:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            self.client = httpx.AsyncClient(limits=limits, timeout=15, transport=self.transport)
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.token_lock = asyncio.Lock()
+        return self.client
+
+    async def aclose(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def get_bearer_access_token(self, force=False):
+        client = self._get_client()
+        if self.tokens:
+            if force:
+                self.tokens.invalidate(self.token)
+            token = self.tokens.peek()
+            if not token:
+                #Only blocks if there's no usable token at all, the manager otherwise refreshes in the background
+                token = await asyncio.to_thread(self.tokens.get)
+            self.token = token
+            return token
+        async with self.token_lock:
+            if force or not self.token or datetime.utcnow() + self.TOKEN_MARGIN > self.token_exp:
+                self.logger.debug("Fetching new Zoom OAuth token")
+                resp = await client.post(self.oauth_uri, auth=(self.oauth_client_id, self.oauth_client_secret),
+                                         data={'grant_type': 'account_credentials', 'account_id': self.oauth_account_id})
+                resp.raise_for_status()
+                token = resp.json()
+                self.token = token['access_token']
+                self.token_exp = datetime.utcnow() + timedelta(seconds=int(token.get('expires_in', 3600)))
+            return self.token
+
+    async def _make_zoom_request(self, path, params=None, attempts=5):
+        client = self._get_client()
+        self.logger.debug(f"Making async zoom call to { path } with { params }")
+        token = await self.get_bearer_access_token()
+        async with self.semaphore:
+            with timing.span(f"zoom:{ path.split('/')[1] }"):
+                resp = await client.get(f"{ self.base_uri }{ path }", params=params, headers={'Authorization': f"Bearer { token }"})
+                if resp.status_code == 401:
+                    #The token was revoked or expired early, get a new one and try once more
+                    self.logger.debug("Zoom rejected our token, refreshing it")
+                    token = await self.get_bearer_access_token(force=True)
+                    resp = await client.get(f"{ self.base_uri }{ path }", params=params, headers={'Authorization': f"Bearer { token }"})
+        if resp.status_code == 429:
+            # we hit the Zoom API rate limit,
+            # see https://marketplace.zoom.us/docs/api-reference/rate-limits
+            metrics.ZOOM_RATE_LIMITED.inc()
+            if attempts > 0:
+                self.logger.warning(f"Calling { path } failed due to Zoom API rate limitation. Retry { attempts } more times.")
+                #Sleep outside of the semaphore so that we don't hold up everything else
+                await asyncio.sleep(uniform(1, 5))
+                return await self._make_zoom_request(path, params, attempts=(attempts - 1))
+        resp.raise_for_status()
+        return parse_json(resp.content)
+
+    async def get_recording(self, recording_id):
+        if not recording_id:
+            raise ValueError('Recording ID not set or is empty.')
+        self.logger.debug(f"Getting recording { recording_id }")
+        # If recording_id starts with / or contains //, we must **double encode** the recording_id
+        # before making an API request.
+        # See https://marketplace.zoom.us/docs/api-reference/zoom-api/cloud-recording/recordingget
+        if recording_id.startswith('/') or '//' in recording_id:
+            meeting_id = quote(quote(recording_id, safe=''), safe='')
+        else:
+            meeting_id = recording_id
+        try:
+            return await self._make_zoom_request(f"/meetings/{ meeting_id }/recordings")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                self.logger.debug(f"Zoom has returned a 404 for recording ID { recording_id }, removing it from the db")
+                await asyncio.to_thread(_forget_recording, recording_id)
+            raise
+
+    async def get_recording_files(self, rec_id, recording=None):
+        rec = recording if recording else await self.get_recording(rec_id)
+        self.validate_recording_object(rec)
+        return self._parse_recording_files(rec)
+
+    async def get_user(self, email_or_id):
+        #Search the DB for the user
+        existing_user = await asyncio.to_thread(db.find_user_by_id_or_email, email_or_id)
+        if existing_user:
+            return existing_user.serialize()
+        #Else, create the user in the db and return it
+        user_json = await self._make_zoom_request(f"/users/{ email_or_id }")
+        existing_user = await asyncio.to_thread(db.ensure_user, user_json)
+        return existing_user.serialize()
+
+    async def get_user_name(self, user_id_or_email):
+        return self.format_user_name(await self.get_user(user_id_or_email))
+
+    async def get_users(self, user_ids):
+        """
+        Resolve many users (eg, the hosts of a page of recordings) at once.  Returns a dict of id to user.
+        """
+        unique = list(dict.fromkeys(user_ids))
+        users = await asyncio.gather(*[ self.get_user(user_id) for user_id in unique ])
+        return dict(zip(unique, users))
+
+    async def get_recordings(self, recording_ids):
+        """
+        Fetch many recordings at once.  Returns a dict of id to recording, or to the exception raised fetching it.
+        """
+        results = await asyncio.gather(*[ self.get_recording(recording_id) for recording_id in recording_ids ], return_exceptions=True)
+        return dict(zip(recording_ids, results))
+
+    async def _get_user_recordings(self, user_id, from_date=None, to_date=None, page_size=None, next_page_token=None):
+        if None == from_date:
+            from_date = datetime.utcnow() - timedelta(days = 7)
+        if None == to_date:
+            to_date = datetime.utcnow()
+        if None == page_size:
+            page_size = 30
+        params = {
+            'from': from_date.strftime('%Y-%m-%d'),
+            'to': to_date.strftime('%Y-%m-%d'),
+            'page_size': int(page_size),
+            'trash_type': 'meeting_recordings',
+            'mc': 'false'
+        }
+        if next_page_token and len(next_page_token) > 0:
+            params['next_page_token'] = next_page_token
+        return await self._make_zoom_request(f"/users/{ user_id }/recordings", params)
+
+    async def iter_user_recordings(self, user_id, from_date=None, to_date=None, page_size=None):
+        """
+        Async generator yielding each page of a user's recordings as it arrives, see Zoom.iter_user_recordings().
+        """
+        next_page_token = None
+        while True:
+            page = await self._get_user_recordings(user_id, from_date, to_date, page_size, next_page_token)
+            yield page
+            next_page_token = page.get('next_page_token', None)
+            if not next_page_token:
+                return
+
+    async def search_user(self, search_key, page_size=25, next_page_token=None):
+        params = {
+            'search_key': search_key,
+            'query_presence_status': 'false',
+            'page_size': page_size,
+        }
+        if next_page_token and len(next_page_token) > 0:
+            params['next_page_token'] = next_page_token
+        self.logger.debug(f"Search zoom contacts with params: " + str(params))
+        return await self._make_zoom_request("/contacts", params)
+
+
+@db.with_session
+def _forget_recording(dbs, recording_id):
+    rec = dbs.query(db.Recording).filter(db.Recording.uuid == recording_id).one_or_none()
+    if rec:
+        dbs.delete(rec)
+        dbs.commit()
@@ -0,0 +1,169 @@
+import logging
+import os
+import os.path
+import shutil
+import threading
+import uuid as uuidlib
+from pathlib import Path
+
+from zingest.common import get_config_ignore
+
+
+class MediaCache:
+    """
+    Local disk cache for downloaded Zoom media, keyed by the Zoom file's recording_id and size.
+
+    Files are only ever visible in the cache once they are complete: new entries are written to a temporary name
+    inside the cache directory, then atomically renamed into place.  Access times are bumped on every hit, and the
+    least recently used entries are evicted once the cache grows beyond its byte budget.
+
+    Every path handed out by get() or put() is leased to the caller until it calls release(), and leased entries are
+    never evicted, so an ingest's media can't disappear part way through uploading it.  Leases are only known to this
+    process, entries in use by another uploader sharing the directory are protected by their recent access time alone.
+    """
+
+    #5GiB by default, which is a handful of long meetings
+    DEFAULT_MAX_BYTES = 5 * 1024 * 1024 * 1024
+    TEMP_PREFIX = ".partial-"
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+        #Path to the number of leases on it
+        self.leases = {}
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        self.logger.info(f"Media cache at { self.path } with a budget of { self.max_bytes } bytes")
+
+    @staticmethod
+    def from_config(config):
+        """
+        Build a cache from the [Cache] config section, or return None if the cache is not configured.
+        """
+        try:
+            path = get_config_ignore(config, "Cache", "path", True)
+        except KeyError:
+            return None
+        if not path or len(path.strip()) == 0:
+            return None
+        try:
+            max_bytes = get_config_ignore(config, "Cache", "max_bytes", True)
+        except KeyError:
+            max_bytes = None
+        if not max_bytes or len(max_bytes.strip()) == 0:
+            max_bytes = MediaCache.DEFAULT_MAX_BYTES
+        return MediaCache(path.strip(), max_bytes)
+
+    def _key(self, file_id, size, extension):
+        #NB: Zoom file ids are UUIDs, but let's not trust that they're filesystem safe
+        safe_id = "".join([ c if c.isalnum() or c in "-_" else "_" for c in str(file_id) ])
+        return f"{ safe_id }-{ int(size) }.{ extension.lower() }"
+
+    def entry_path(self, file_id, size, extension):
+        return os.path.join(self.path, self._key(file_id, size, extension))
+
+    def contains(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.path)
+
+    def get(self, file_id, size, extension):
+        """
+        Look up a cached file.  Returns the path to the cached copy, leased until release() is called, or None if
+        there is no (complete) copy.
+        """
+        path = self.entry_path(file_id, size, extension)
+        #Under the lock, so that the entry can't be evicted between finding it and leasing it
+        with self.lock:
+            try:
+                if os.path.getsize(path) != int(size):
+                    self.logger.warning(f"Cached copy of { file_id } at { path } is the wrong size, discarding it")
+                    self.discard(path)
+                    return None
+                #Mark this entry as recently used
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            self._lease(path)
+        self.logger.debug(f"Cache hit for { file_id } at { path }")
+        return path
+
+    def temp_path(self, file_id, extension):
+        """
+        Returns a unique temporary filename in the cache directory, suitable for downloading into then calling put()
+        """
+        return os.path.join(self.path, f"{ self.TEMP_PREFIX }{ uuidlib.uuid4().hex }.{ extension.lower() }")
+
+    def put(self, file_id, size, extension, source):
+        """
+        Move a completed download into the cache.  Returns the path to the cached copy, leased until release() is called.
+        """
+        path = self.entry_path(file_id, size, extension)
+        if not self.contains(source):
+            #os.replace is only atomic within a filesystem, so copy into the cache dir first
+            temp = self.temp_path(file_id, extension)
+            shutil.copyfile(source, temp)
+            os.remove(source)
+            source = temp
+        with self.lock:
+            self._lease(path)
+        try:
+            os.replace(source, path)
+        except Exception:
+            self.release(path)
+            raise
+        self.logger.debug(f"Cached { file_id } at { path }")
+        self.evict()
+        return path
+
+    def _lease(self, path):
+        self.leases[path] = self.leases.get(path, 0) + 1
+
+    def release(self, path):
+        """
+        Give up a lease from get() or put(), once the file has been uploaded (or won't be).
+        """
+        with self.lock:
+            count = self.leases.get(path, 0) - 1
+            if count > 0:
+                self.leases[path] = count
+            else:
+                self.leases.pop(path, None)
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith(self.TEMP_PREFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    #Another process evicted this in the meantime
+                    continue
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum([ size for _, size, _ in self._entries() ])
+
+    def evict(self):
+        """
+        Remove the least recently used entries which aren't leased until the cache fits inside its budget.
+        """
+        with self.lock:
+            entries = sorted(self._entries())
+            total = sum([ size for _, size, _ in entries ])
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path in self.leases:
+                    continue
+                self.logger.debug(f"Evicting { path } from the media cache")
+                self.discard(path)
+                total -= size
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
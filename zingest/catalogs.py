@@ -0,0 +1,108 @@
+import bisect
+import functools
+import hashlib
+import json
+import threading
+
+from markupsafe import Markup, escape
+
+
+class CatalogIndex:
+    """
+    A searchable, versioned snapshot of one of Opencast's catalogs (series, ACLs, workflows or themes), used to serve
+    the UI's type-ahead choices instead of embedding the whole catalog in every page.
+
+    Entries are kept sorted by their lowercased label, so a prefix search is a binary search plus a slice however large
+    the catalog is.  The version is a hash of the catalog's contents, which makes it usable as an ETag: it only changes
+    when the catalog really does.  Rendered responses and <option> lists are cached per version.
+    """
+
+    DEFAULT_LIMIT = 50
+    #How many distinct searches to keep rendered responses for
+    CACHED_RESPONSES = 256
+
+    def __init__(self, name, label=None):
+        self.name = name
+        #Turns a catalog value into the text shown to the user, ie the ACL's name
+        self.label = label if label else str
+        self.lock = threading.Lock()
+        self.source = None
+        self.size = None
+        #(lowercased labels, (label, id) pairs, id to label), replaced as a whole so that readers never need the lock
+        self.current = ([], [], {})
+        self.version = None
+        self.render = None
+        #(the entries it was rendered from, the rendered <option>s)
+        self.rendered_options = (None, None)
+
+    def update(self, catalog):
+        """
+        Rebuild the index if catalog (a dict of id to value) has changed since the last call.  The Opencast catalogs are
+        replaced wholesale when they are refreshed, and only ever grow in between, so this is normally a cheap no-op.
+        """
+        catalog = catalog if catalog else {}
+        if catalog is self.source and len(catalog) == self.size:
+            return self
+        with self.lock:
+            if catalog is self.source and len(catalog) == self.size:
+                return self
+            entries = sorted(((self.label(value), str(key)) for key, value in list(catalog.items())), key=lambda entry: (entry[0].lower(), entry[1]))
+            digest = hashlib.sha1()
+            for label, key in entries:
+                digest.update(f"{ key }\0{ label }\0".encode('utf-8'))
+            self.current = ([ label.lower() for label, _ in entries ], entries, { key: label for label, key in entries })
+            self.version = digest.hexdigest()[:16]
+            self.render = functools.lru_cache(maxsize=self.CACHED_RESPONSES)(self._render)
+            self.source = catalog
+            self.size = len(catalog)
+        return self
+
+    def get_label(self, key):
+        return self.current[2].get(str(key), None) if key is not None else None
+
+    def search(self, prefix="", limit=DEFAULT_LIMIT):
+        """
+        Return the (label, id) pairs whose label starts with prefix, ignoring case, in label order, along with the total
+        number of matches.  An id which matches prefix exactly is always included first.  A limit of 0 means no limit.
+        """
+        prefix = prefix.strip() if prefix else ""
+        keys, entries, ids = self.current
+        start, end = 0, len(entries)
+        exact = []
+        if prefix:
+            lowered = prefix.lower()
+            start = bisect.bisect_left(keys, lowered)
+            #Every string starting with lowered sorts before lowered followed by the highest code point
+            end = bisect.bisect_left(keys, lowered + "\U0010ffff", lo=start)
+            label = ids.get(prefix, None)
+            if label is not None and not label.lower().startswith(lowered):
+                exact = [ (label, prefix) ]
+        total = len(exact) + end - start
+        if limit and limit > 0:
+            end = min(end, start + limit - len(exact))
+        return exact + entries[start:end], total
+
+    def options(self):
+        """
+        The whole catalog as <option> elements, for the pages which still use a plain <select>.  This is rendered once
+        per version of the catalog rather than by a template loop on every request.
+        """
+        entries = self.current[1]
+        rendered_from, options = self.rendered_options
+        if rendered_from is not entries:
+            options = Markup("\n".join(f'<option value="{ escape(key) }">{ escape(label) }</option>' for label, key in entries))
+            self.rendered_options = (entries, options)
+        return options
+
+    def etag(self, prefix="", limit=DEFAULT_LIMIT):
+        query = json.dumps([ prefix.strip() if prefix else "", limit ])
+        return f"{ self.version }-{ hashlib.sha1(query.encode('utf-8')).hexdigest()[:8] }"
+
+    def _render(self, prefix, limit):
+        entries, total = self.search(prefix, limit)
+        return json.dumps({
+            'catalog': self.name,
+            'version': self.version,
+            'total': total,
+            'results': [ { 'id': key, 'label': label } for label, key in entries ],
+        })
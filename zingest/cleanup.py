@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+
+from requests import HTTPError
+from sqlalchemy import and_, or_
+
+from zingest import db
+from zingest.common import get_config_ignore
+from zingest.workflows import WorkflowPoller
+
+
+class ZoomCleaner:
+    """
+    Moves recordings to the Zoom trash once they are safely in Opencast, to save on Zoom cloud storage.
+
+    A recording is only removed once one of its ingests has finished normally (not with a warning, ie a fallback
+    recording type), every file it downloaded matched the size Zoom reported, and the Opencast workflow has succeeded
+    (see WorkflowPoller).  Zoom doesn't publish checksums for recording files, so the size is what we can verify.  A
+    recording with another ingest still pending is left alone until that one has finished too.
+
+    Recordings are removed at most batch_size per interval seconds, with a pause between each, to stay well clear of
+    Zoom's rate limits.  Every attempt is recorded on the ingest.
+    """
+
+    DEFAULT_BATCH_SIZE = 10
+    DEFAULT_INTERVAL = 300
+    DEFAULT_RATE = 1
+    #Give up on a recording after this many failed attempts
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, zoom, batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_INTERVAL, rate=DEFAULT_RATE):
+        self.logger = logging.getLogger(__name__)
+        self.zoom = zoom
+        self.batch_size = int(batch_size)
+        self.interval = float(interval)
+        #Removals per second
+        self.rate = float(rate)
+        self.woken = threading.Event()
+
+    @staticmethod
+    def from_config(config, zoom):
+        """
+        Build a cleaner from the [Cleanup] config section, or return None if it is disabled (the default).
+        """
+        try:
+            enabled = get_config_ignore(config, "Cleanup", "delete_from_zoom", True)
+        except KeyError:
+            enabled = None
+        if not enabled or str(enabled).strip().lower() != 'true':
+            return None
+        settings = {}
+        for key, default in (("batch_size", ZoomCleaner.DEFAULT_BATCH_SIZE), ("interval", ZoomCleaner.DEFAULT_INTERVAL), ("rate", ZoomCleaner.DEFAULT_RATE)):
+            try:
+                value = get_config_ignore(config, "Cleanup", key, True)
+            except KeyError:
+                value = None
+            settings[key] = value if value and len(str(value).strip()) > 0 else default
+        return ZoomCleaner(zoom, **settings)
+
+    def run(self):
+        self.logger.info("Removing ingested recordings from Zoom")
+        while True:
+            removed = self.clean()
+            if removed < self.batch_size:
+                self.woken.wait(self.interval)
+                self.woken.clear()
+            else:
+                #There may well be more waiting, but still leave a gap between batches
+                time.sleep(self.batch_size / self.rate if self.rate > 0 else 0)
+
+    @db.with_session
+    def find_candidates(dbs, self):
+        """
+        :return: Up to batch_size verified ingests whose recordings are still in Zoom, oldest first
+        """
+        verified = dbs.query(db.Ingest).filter(
+                    db.Ingest.status == db.Status.FINISHED,
+                    db.Ingest.workflow_state == 'SUCCEEDED',
+                    db.Ingest.verified_files != None,
+                    db.Ingest.zoom_deleted == None).order_by(db.Ingest.timestamp).all()
+        candidates = []
+        uuids = set()
+        for ingest in verified:
+            if len(candidates) >= self.batch_size:
+                break
+            #Re-ingests of the same recording only need to remove it once
+            if ingest.uuid in uuids:
+                continue
+            failures = len([ entry for entry in ingest.get_zoom_deletion_audit() if entry['result'] == 'failed' ])
+            if failures >= self.MAX_ATTEMPTS:
+                continue
+            #Another ingest of the same recording which hasn't finished still needs the files
+            pending = dbs.query(db.Ingest).filter(
+                        db.Ingest.uuid == ingest.uuid,
+                        db.Ingest.ingest_id != ingest.ingest_id,
+                        or_(db.Ingest.status.in_([ db.Status.NEW, db.Status.IN_PROGRESS ]),
+                            and_(db.Ingest.workflow_id != None, db.Ingest.workflow_state == None),
+                            db.Ingest.workflow_state.in_(WorkflowPoller.RUNNING_STATES))).count()
+            if pending > 0:
+                continue
+            candidates.append(ingest.get_id())
+            uuids.add(ingest.uuid)
+        return candidates
+
+    def clean(self):
+        """
+        Remove one batch of recordings from Zoom.
+
+        :return: How many ingests were dealt with, successfully or not
+        """
+        candidates = self.find_candidates()
+        for index, ingest_id in enumerate(candidates):
+            if index > 0 and self.rate > 0:
+                time.sleep(1 / self.rate)
+            self._remove(ingest_id)
+        return len(candidates)
+
+    @db.with_session
+    def _remove(dbs, self, ingest_id):
+        ingest = dbs.query(db.Ingest).filter(db.Ingest.ingest_id == ingest_id).one()
+        uuid = ingest.get_recording_id()
+        try:
+            self.zoom.trash_recording(uuid)
+            self.logger.info(f"{ uuid }: Moved to the Zoom trash after ingest { ingest_id } was verified")
+            ingest.audit_zoom_deletion('deleted')
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                #Already gone, ie someone removed it by hand
+                self.logger.info(f"{ uuid }: Already removed from Zoom")
+                ingest.audit_zoom_deletion('gone')
+            else:
+                self.logger.warning(f"{ uuid }: Unable to move to the Zoom trash: { repr(e) }")
+                ingest.audit_zoom_deletion('failed', repr(e))
+        except Exception as e:
+            self.logger.warning(f"{ uuid }: Unable to move to the Zoom trash: { repr(e) }")
+            ingest.audit_zoom_deletion('failed', repr(e))
+        dbs.commit()
+        #Any other ingests of the same recording don't need to do this again
+        if ingest.zoom_deleted:
+            for other in dbs.query(db.Ingest).filter(db.Ingest.uuid == uuid, db.Ingest.ingest_id != ingest_id, db.Ingest.zoom_deleted == None).all():
+                other.audit_zoom_deletion('gone', f"Removed after ingest { ingest_id }")
+            dbs.commit()
@@ -1,13 +1,18 @@
 import json
 import logging
 import string
+import zlib
 from datetime import datetime
 from functools import wraps
 
 from sqlalchemy import Column, Integer, String, LargeBinary, DateTime, \
-    Boolean, create_engine, func, or_, and_
+    Boolean, create_engine, func, or_, and_, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateColumn
+
+from zingest import metrics
 
 Base = declarative_base()
 
@@ -29,6 +34,35 @@ def init(config):
         log.warn("Using default SQLite database, this is probably not what you want!")
         engine = create_engine(db)
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+
+
+def add_missing_columns(engine):
+    """
+    create_all() only creates missing tables, so add any new (nullable)
+    columns to tables which were created by an older version.
+    :param engine:
+    """
+    log = logging.getLogger(__name__)
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = [ column['name'] for column in inspector.get_columns(table.name) ]
+        for column in table.columns:
+            if column.name in existing_columns or not column.nullable:
+                continue
+            table_name = engine.dialect.identifier_preparer.format_table(table)
+            column_definition = CreateColumn(column).compile(dialect=engine.dialect)
+            log.info(f"Adding missing column { column.name } to table { table.name }")
+            with engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE { table_name } ADD COLUMN { column_definition }"))
+                #Some columns need a value for the rows which predate them, see the column's info
+                if 'backfill' in column.info:
+                    value, condition = column.info['backfill']
+                    column_name = engine.dialect.identifier_preparer.quote(column.name)
+                    connection.execute(text(f"UPDATE { table_name } SET { column_name } = :value WHERE { condition }"), {'value': value})
 
 
 def get_session():
@@ -41,6 +75,7 @@ def get_session():
     if 'engine' not in globals():
         init()
     Session = sessionmaker(bind=engine)
+    metrics.DB_SESSIONS.inc()
     return Session()
 
 
@@ -56,6 +91,7 @@ def with_session(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         session = get_session()
+        metrics.DB_SESSIONS_OPEN.inc()
         try:
             result = f(session, *args, **kwargs)
         except Exception as e:
@@ -63,6 +99,7 @@ def with_session(f):
             raise e
         finally:
             session.close()
+            metrics.DB_SESSIONS_OPEN.dec()
         return result
     return decorated
 
@@ -83,13 +120,69 @@ def create_recording_if_needed(dbs, j):
     return existing_recording
 
 @with_session
-def create_ingest(dbs, uuid, params):
+def create_recordings(dbs, recordings):
+    """
+    Create many recordings in a single transaction.
+
+    :return: The new recordings, in the same order
+    """
+    #The new objects stay usable once the session has closed, without a refresh (and query) for each of them
+    dbs.expire_on_commit = False
+    created = [ Recording(j) for j in recordings ]
+    dbs.add_all(created)
+    dbs.commit()
+    return created
+
+@with_session
+def find_recordings(dbs, recording_ids):
+    """
+    Look up many recordings with a single query, by Zoom uuid or (as used by bulk ingests) database id.
+
+    :return: A dict of each id which was found to its recording
+    """
+    recording_ids = [ str(recording_id) for recording_id in recording_ids ]
+    if len(recording_ids) == 0:
+        return {}
+    preds = [ Recording.uuid.in_(recording_ids) ]
+    db_ids = [ int(recording_id) for recording_id in recording_ids if recording_id.isdigit() ]
+    if len(db_ids) > 0:
+        preds.append(Recording.rec_id.in_(db_ids))
+    found = {}
+    for rec in dbs.query(Recording).filter(or_(*preds)).all():
+        found[str(rec.rec_id)] = rec
+        #A uuid wins over a database id which happens to look the same
+        found[rec.uuid] = rec
+    return { recording_id: found[recording_id] for recording_id in recording_ids if recording_id in found }
+
+@with_session
+def create_ingest(dbs, uuid, params, recording=None, lane=None, not_before=None, released=None):
     ingest = Ingest(uuid, params)
+    ingest.set_zoom_recording(recording)
+    ingest.set_schedule(lane, not_before, released)
     dbs.add(ingest)
     dbs.commit()
     dbs.refresh(ingest)
     return ingest.get_id()
 
+@with_session
+def create_ingests(dbs, ingests, lane=None, not_before=None, released=None):
+    """
+    Create many ingests, from (uuid, params, recording) tuples, in a single transaction.  The recording is optional,
+    see Ingest.set_zoom_recording().  The ingests are all scheduled the same way, see Ingest.set_schedule().
+
+    :return: The new ingests' ids, in the same order
+    """
+    dbs.expire_on_commit = False
+    created = []
+    for uuid, params, recording in ingests:
+        ingest = Ingest(uuid, params)
+        ingest.set_zoom_recording(recording)
+        ingest.set_schedule(lane, not_before, released)
+        created.append(ingest)
+    dbs.add_all(created)
+    dbs.commit()
+    return [ ingest.get_id() for ingest in created ]
+
 @with_session
 def ensure_user(dbs, j):
     user_id = j['id']
@@ -185,6 +278,44 @@ def find_user_by_id_or_email(dbs, query):
             )).one_or_none()
 
 
+@with_session
+def get_data_version(dbs):
+    """
+    A cheap summary of the recordings and ingests tables, which changes whenever a recording or ingest is added or an
+    ingest changes status.  Used to validate cached UI pages.
+    """
+    recordings = dbs.query(func.count(Recording.rec_id), func.max(Recording.rec_id)).one()
+    ingests = dbs.query(func.count(Ingest.ingest_id), func.max(Ingest.ingest_id), func.max(Ingest.timestamp)).one()
+    return [ *recordings, *ingests ]
+
+
+@with_session
+def claim_event(dbs, key, uuid=None):
+    """
+    Record that the event identified by key is being handled.  The key is the table's primary key, so this is atomic
+    across processes.
+
+    :return: True if this call claimed the event, False if it had already been claimed
+    """
+    dbs.add(WebhookEvent(key, uuid))
+    try:
+        dbs.commit()
+    except IntegrityError:
+        dbs.rollback()
+        return False
+    return True
+
+@with_session
+def release_event(dbs, key):
+    dbs.query(WebhookEvent).filter(WebhookEvent.key == key).delete()
+    dbs.commit()
+
+@with_session
+def expire_events(dbs, older_than):
+    dbs.query(WebhookEvent).filter(WebhookEvent.received < older_than).delete()
+    dbs.commit()
+
+
 
 class Constants:
 
@@ -202,6 +333,8 @@ class Status(Constants):
     IN_PROGRESS = 1
     FINISHED = 2
     WARNING = 3
+    #Gave up after too many failed attempts, see Ingest.retry_later()
+    FAILED = 4
 
 
 # Database Schema Definition
@@ -275,6 +408,40 @@ class Ingest(Base):
     params = Column('zingest_parms', LargeBinary(), nullable=False)
     mediapackage_id = Column('mediapackage_id', String(length=36), nullable=True, default=None)
     workflow_id = Column('workflow_id', String(length=36), nullable=True, default=None)
+    #The intermediate mediapackage XML, and the ingest steps already completed against it
+    mediapackage = Column('mediapackage', LargeBinary(), nullable=True, default=None)
+    completed_steps = Column('completed_steps', String(length=512), nullable=True, default=None)
+    #JSON map of stage name to seconds spent in it during the last attempt
+    timings = Column('timings', String(length=2048), nullable=True, default=None)
+    #The Opencast workflow's state, when we last checked it, and once it has finished: when, how long Opencast spent
+    #processing (in seconds), and how long after the end of the Zoom recording that was (also in seconds)
+    #Ingests which were handed to Opencast before workflows were followed are marked as untracked when the column is
+    #added, otherwise the first poll after upgrading would fetch (and report on) every workflow ever started
+    workflow_state = Column('workflow_state', String(length=16), nullable=True, default=None,
+                            info={'backfill': ('UNTRACKED', 'workflow_id IS NOT NULL')})
+    workflow_checked = Column('workflow_checked', DateTime(), nullable=True, default=None)
+    workflow_completed = Column('workflow_completed', DateTime(), nullable=True, default=None)
+    processing_duration = Column('processing_duration', Integer(), nullable=True, default=None)
+    latency = Column('latency', Integer(), nullable=True, default=None)
+    #JSON list of the Zoom files which were downloaded and verified against Zoom's reported sizes during the ingest
+    verified_files = Column('verified_files', String(length=2048), nullable=True, default=None)
+    #When the recording was moved to the Zoom trash after the ingest, and a JSON list of every attempt to do so
+    zoom_deleted = Column('zoom_deleted', DateTime(), nullable=True, default=None)
+    zoom_deletion_audit = Column('zoom_deletion_audit', String(length=2048), nullable=True, default=None)
+    #A compact copy of the Zoom recording (see set_zoom_recording()), and when it was fetched from Zoom
+    zoom_recording = Column('zoom_recording', LargeBinary(), nullable=True, default=None)
+    zoom_recording_fetched = Column('zoom_recording_fetched', DateTime(), nullable=True, default=None)
+    #Which scheduling lane the ingest is in, the earliest it may start, and when it was last sent to the uploader (see
+    #zingest.scheduler).  An ingest which hasn't been released yet is waiting for its lane's window or capacity.
+    lane = Column('lane', String(length=32), nullable=True, default=None)
+    not_before = Column('not_before', DateTime(), nullable=True, default=None)
+    released = Column('released', DateTime(), nullable=True, default=None)
+    #How many attempts have failed
+    attempts = Column('attempts', Integer(), nullable=True, default=None)
+
+    #The parts of the recording, and of each of its files, which the uploader uses
+    ZOOM_RECORDING_FIELDS = ('id', 'uuid', 'host_id', 'topic', 'start_time', 'duration')
+    ZOOM_FILE_FIELDS = ('id', 'recording_start', 'recording_end', 'download_url', 'file_type', 'file_size', 'file_extension', 'recording_type', 'status')
 
     def __init__(self, uuid, params="{}"):
         self.uuid = uuid
@@ -314,6 +481,108 @@ class Ingest(Base):
     def get_workflow_id(self):
         return self.workflow_id
 
+    def set_workflow_state(self, workflow_state):
+        self.workflow_state = workflow_state
+
+    def get_workflow_state(self):
+        return self.workflow_state
+
+    def get_mediapackage(self):
+        return self.mediapackage.decode('utf-8') if self.mediapackage else None
+
+    def get_completed_steps(self):
+        return self.completed_steps.split(" ") if self.completed_steps else []
+
+    def set_progress(self, mediapackage, completed_steps):
+        self.mediapackage = mediapackage.encode('utf-8') if mediapackage else None
+        self.completed_steps = " ".join(completed_steps) if completed_steps else None
+
+    def clear_progress(self):
+        self.set_progress(None, None)
+
+    def get_timings(self):
+        return json.loads(self.timings) if self.timings else {}
+
+    def set_timings(self, timings):
+        self.timings = json.dumps(timings) if timings else None
+
+    def set_zoom_recording(self, recording, fetched=None):
+        """
+        Store the recording from Zoom (ie, from a webhook event) with the ingest, so that the uploader doesn't need to
+        fetch it again.  Only the fields the uploader needs are kept, compressed.
+        """
+        if not recording:
+            self.zoom_recording = None
+            self.zoom_recording_fetched = None
+            return
+        compact = { key: recording[key] for key in self.ZOOM_RECORDING_FIELDS if key in recording }
+        compact['recording_files'] = [ { key: recording_file[key] for key in self.ZOOM_FILE_FIELDS if key in recording_file } for recording_file in recording.get('recording_files', []) ]
+        self.zoom_recording = zlib.compress(json.dumps(compact, separators=(',', ':')).encode('utf-8'))
+        self.zoom_recording_fetched = fetched if fetched else datetime.utcnow()
+
+    def get_zoom_recording(self, max_age=None):
+        """
+        :return: The stored recording, or None if there isn't one or it was fetched more than max_age (a timedelta) ago
+        """
+        if not self.zoom_recording:
+            return None
+        if max_age is not None and (not self.zoom_recording_fetched or self.zoom_recording_fetched < datetime.utcnow() - max_age):
+            return None
+        return json.loads(zlib.decompress(self.zoom_recording).decode('utf-8'))
+
+    def set_schedule(self, lane, not_before=None, released=None):
+        self.lane = lane
+        self.not_before = not_before
+        self.released = released
+
+    def is_held(self):
+        """
+        :return: True if the scheduler is holding this ingest back, ie a duplicate message arrived before its retry
+        """
+        return self.released is None or (self.not_before is not None and self.not_before > datetime.utcnow())
+
+    def retry_later(self, delay, max_attempts):
+        """
+        Record a failed attempt.  The ingest goes back to NEW, not before delay (a timedelta, doubled for each further
+        attempt) from now, and the scheduler releases it again from there, resuming from its stored progress.  After
+        max_attempts it is FAILED instead.
+
+        :return: True if the ingest will be retried
+        """
+        self.attempts = (self.attempts or 0) + 1
+        if self.attempts >= max_attempts:
+            self.update_status(Status.FAILED)
+            return False
+        self.update_status(Status.NEW)
+        self.not_before = datetime.utcnow() + delay * 2 ** (self.attempts - 1)
+        self.released = None
+        return True
+
+    def get_verified_files(self):
+        return json.loads(self.verified_files) if self.verified_files else []
+
+    def set_verified_files(self, files):
+        self.verified_files = json.dumps(files) if files else None
+
+    def get_zoom_deletion_audit(self):
+        return json.loads(self.zoom_deletion_audit) if self.zoom_deletion_audit else []
+
+    def audit_zoom_deletion(self, result, detail=None):
+        """
+        Record an attempt to remove the recording from Zoom, marking it as deleted if result is 'deleted' or 'gone'.
+        """
+        now = datetime.utcnow()
+        entry = { 'time': now.isoformat(timespec='seconds') + 'Z', 'result': result }
+        if detail:
+            entry['detail'] = str(detail)[:200]
+        #Keep the first attempt and the most recent ones, so that this fits in its column however many retries there are
+        audit = self.get_zoom_deletion_audit() + [ entry ]
+        if len(audit) > 6:
+            audit = audit[:1] + audit[-5:]
+        self.zoom_deletion_audit = json.dumps(audit)
+        if result in [ 'deleted', 'gone' ]:
+            self.zoom_deleted = now
+
     def serialize(self):
         """
         Serialize this object as dictionary usable for conversion to JSON.
@@ -325,8 +594,31 @@ class Ingest(Base):
             'status': self.status,
             'mediapackage_id': self.mediapackage_id,
             'workflow_id': self.workflow_id,
+            'timings': self.get_timings(),
+            'workflow_state': self.workflow_state,
+            'processing_duration': self.processing_duration,
+            'latency': self.latency,
+            'zoom_deleted': self.zoom_deleted.isoformat() + 'Z' if self.zoom_deleted else None,
+            'zoom_deletion_audit': self.get_zoom_deletion_audit(),
+            'lane': self.lane,
+            'not_before': self.not_before.isoformat() + 'Z' if self.not_before else None,
+            'released': self.released.isoformat() + 'Z' if self.released else None,
         }
 
+class WebhookEvent(Base):
+    """Database definition of a claimed webhook event, see zingest.idempotency."""
+
+    __tablename__ = 'webhook_event'
+
+    key = Column('event_key', String(length=40), primary_key=True)
+    uuid = Column('uuid', String(length=32), nullable=True)
+    received = Column('received', DateTime(), nullable=False, index=True)
+
+    def __init__(self, key, uuid=None):
+        self.key = key
+        self.uuid = uuid
+        self.received = datetime.utcnow()
+
 class User(Base):
     """Database definition of a Zoom user."""
 
@@ -0,0 +1,92 @@
+import gzip
+import hashlib
+import json
+import logging
+from functools import wraps
+
+from flask import Response, g, make_response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#Only responses at least this big are compressed, below this the headers outweigh the saving
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript')
+#Both are well below their maximums, which cost a lot more CPU for very little more compression
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def init(app):
+    """
+    Compress every suitable response from app with brotli (if installed) or gzip, depending on what the client accepts.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug(f"Compressing responses with { 'brotli or gzip' if brotli else 'gzip' }")
+    app.after_request(compress)
+
+
+def _encodings():
+    return [ 'br', 'gzip' ] if brotli else [ 'gzip' ]
+
+
+def compress(response):
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200 \
+            or 'Content-Encoding' in response.headers or not response.mimetype.startswith(COMPRESSIBLE_TYPES):
+        return response
+    #Whether or not we compress this one, the response depends on the Accept-Encoding header
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(_encodings())
+    if not encoding:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    if encoding == 'br':
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def make_etag(*parts):
+    return hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()[:20]
+
+
+def uncacheable():
+    """
+    Mark the current response as not to be given an ETag by conditional(), ie because it is an error page.
+    """
+    g.uncacheable = True
+
+
+def conditional(validators):
+    """
+    Decorate a GET view so that its response carries a weak ETag, built from the request's path and query string plus
+    whatever validators() returns, and is marked as needing revalidation.  If the client already has that version it
+    gets an empty 304 without the view being run at all, so validators() must be much cheaper than the view, and must
+    change whenever anything the view renders does.
+
+    The ETags are weak since the same page may be sent compressed or not.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            etag = make_etag(request.full_path, *validators())
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or g.get('uncacheable', False):
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,78 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from zingest import db
+
+
+class EventLedger:
+    """
+    Remembers which webhook events (and other one-off actions) have already been claimed, so that Zoom's retries and
+    repeated deliveries of the same event are only acted on once.
+
+    A claim is an insert into a table keyed on the event's key, so exactly one claim for a key can ever succeed,
+    however many gunicorn workers receive the same event at once.  Keys this process has already seen are also kept in
+    memory for ttl seconds, so that most repeats are rejected with a dict lookup before touching the database at all.
+    Claims older than ttl are removed from the table as new ones arrive.
+    """
+
+    #Zoom retries a failed webhook delivery for a few hours, this is comfortably longer
+    DEFAULT_TTL = 7 * 24 * 3600
+    DEFAULT_MAX_SIZE = 10000
+    #Remove expired claims from the table once every this many claims
+    EXPIRE_EVERY = 100
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.logger = logging.getLogger(__name__)
+        self.ttl = float(ttl)
+        self.max_size = int(max_size)
+        self.lock = threading.Lock()
+        #Key to when we stop remembering it, oldest first
+        self.seen = OrderedDict()
+        self.claims = 0
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1("\0".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def _remember(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self.seen[key] = now + self.ttl
+            self.seen.move_to_end(key)
+            while self.seen and (len(self.seen) > self.max_size or next(iter(self.seen.values())) <= now):
+                self.seen.popitem(last=False)
+
+    def is_known(self, key):
+        with self.lock:
+            expires = self.seen.get(key, None)
+        return expires is not None and expires > time.monotonic()
+
+    def claim(self, key, uuid=None):
+        """
+        Claim key, returning False if it has already been claimed (by any process).
+        """
+        if self.is_known(key):
+            return False
+        claimed = db.claim_event(key, uuid)
+        #Only cache our own claims, another process' claim may yet be released and the event retried
+        if claimed:
+            self._remember(key)
+            self.claims += 1
+            if self.claims % self.EXPIRE_EVERY == 0:
+                try:
+                    db.expire_events(datetime.utcnow() - timedelta(seconds=self.ttl))
+                except Exception:
+                    self.logger.exception("Unable to remove expired webhook events")
+        return claimed
+
+    def release(self, key):
+        """
+        Give up a claim, ie because handling the event failed and the sender should be allowed to retry it.
+        """
+        with self.lock:
+            self.seen.pop(key, None)
+        db.release_event(key)
@@ -0,0 +1,62 @@
+import os
+from datetime import datetime
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess
+
+#NB: When running under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory *before* starting the service.
+#Every worker then writes its samples there, and /metrics aggregates them across all of the workers.
+
+STAGE_DURATION = Histogram('zingest_stage_duration_seconds', 'Time spent in each ingest stage', ['stage'],
+                           buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float("inf")))
+TRANSFER_RATE = Histogram('zingest_transfer_bytes_per_second', 'Throughput of each media transfer', ['direction'],
+                          buckets=(1e5, 5e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 1e9, float("inf")))
+TRANSFER_BYTES = Counter('zingest_transfer_bytes', 'Bytes of media transferred', ['direction'])
+INGESTS_IN_FLIGHT = Gauge('zingest_ingests_in_flight', 'Ingests currently being processed', multiprocess_mode='livesum')
+QUEUE_DEPTH = Gauge('zingest_queue_depth', 'Messages waiting in the ingest queue', multiprocess_mode='livemax')
+ZOOM_RATE_LIMITED = Counter('zingest_zoom_rate_limited', 'Zoom API calls rejected with a 429')
+ZOOM_TOKEN_FETCHES = Counter('zingest_zoom_token_fetches', 'Zoom OAuth tokens fetched')
+CATALOG_AGE = Gauge('zingest_catalog_age_seconds', 'Time since each Opencast catalog was refreshed', ['catalog'], multiprocess_mode='livemax')
+WORKFLOWS_FINISHED = Counter('zingest_workflows_finished', 'Opencast workflows followed to completion', ['state'])
+WORKFLOW_DURATION = Histogram('zingest_workflow_duration_seconds', 'Time Opencast spent processing each ingest',
+                              buckets=(60, 300, 600, 1200, 1800, 3600, 7200, 14400, 43200, 86400, float("inf")))
+END_TO_END_LATENCY = Histogram('zingest_end_to_end_latency_seconds', 'Time from the end of a Zoom recording to the end of its Opencast workflow',
+                               buckets=(600, 1800, 3600, 7200, 14400, 28800, 43200, 86400, 172800, 604800, float("inf")))
+DB_SESSIONS = Counter('zingest_db_sessions', 'Database sessions opened')
+DB_SESSIONS_OPEN = Gauge('zingest_db_sessions_open', 'Database sessions currently open', multiprocess_mode='livesum')
+
+
+def observe_stage(stage, seconds):
+    STAGE_DURATION.labels(stage).observe(seconds)
+
+
+def observe_transfer(direction, num_bytes, seconds):
+    TRANSFER_BYTES.labels(direction).inc(num_bytes)
+    if seconds > 0:
+        TRANSFER_RATE.labels(direction).observe(num_bytes / seconds)
+
+
+def update_catalog_ages(opencast):
+    now = datetime.utcnow()
+    for catalog, updated in (('acls', opencast.acls_updated), ('themes', opencast.themes_updated),
+                             ('workflows', opencast.workflows_updated), ('series', opencast.series_updated)):
+        if updated:
+            CATALOG_AGE.labels(catalog).set((now - updated).total_seconds())
+
+
+def update_queue_depth(rabbit):
+    QUEUE_DEPTH.set(rabbit.get_queue_depth())
+
+
+def render():
+    """
+    Render the current metrics in the Prometheus text format.
+
+    :return: The body and the content type of the response
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -17,14 +17,56 @@ from requests_toolbelt.exceptions import StreamingError
 from requests_toolbelt.downloadutils import stream
 
 import zingest
-from zingest import db
+from zingest import db, metrics, progress, sequence, timing
+from zingest.cache import MediaCache
+from zingest.catalogs import CatalogIndex
 from zingest.common import NoMp4Files, BadWebhookData, get_config, get_config_ignore
+from zingest.sequence import Abandon, Call, Next, Start
+from zingest.workflows import WorkflowPoller
 
 
 class OpencastException(Exception):
     pass
 
 
+class IngestRejected(OpencastException):
+    """
+    Opencast refused an ingest request outright (a 4xx response), so nothing was ingested.
+    """
+    pass
+
+
+class IngestProgress:
+    """
+    The intermediate mediapackage of an ingest, and the steps already completed against it.
+    Steps are named after the flavor of the element they add, plus 'create' for the mediapackage itself.
+    If the progress belongs to an ingest it is copied to the ingest after every step, and saved with it (see
+    Opencast._checkpoint()), so that a failed ingest can later resume from there.
+    """
+
+    CREATE = 'create'
+
+    def __init__(self, mediapackage=None, steps=None, ingest=None):
+        self.mediapackage = mediapackage
+        self.steps = list(steps) if steps else []
+        self.ingest = ingest
+
+    def is_done(self, step):
+        return step in self.steps
+
+    def update(self, steps, mediapackage):
+        self.steps = list(steps)
+        self.mediapackage = mediapackage
+        if self.ingest:
+            self.ingest.set_progress(self.mediapackage, self.steps)
+
+    def complete(self, step, mediapackage):
+        self.update(self.steps + [ step ], mediapackage)
+
+    def reset(self):
+        self.update([], None)
+
+
 class Opencast:
 
     IN_PROGRESS_ROOT = "in-progress"
@@ -49,6 +91,23 @@ class Opencast:
     RECORDING_TYPE_PREFERENCE = [ 'shared_screen_with_speaker_view', 'shared_screen_with_speaker_view(CC)', 'shared_screen' ,'active_speaker' ]
     #If none of the above match, see if these do
     FALLBACK_RECORDING_TYPE_PREFERENCE = [ 'shared_screen_with_gallery_view', 'gallery_view', 'speaker_view', 'audio_only' ]
+    #Optional, non-video files which are attached to the mediapackage if Zoom has them
+    CHAT_RECORDING_TYPE = 'chat_file'
+    CAPTIONS_RECORDING_TYPE = 'closed_caption'
+    EXTENSION_OVERRIDES = {'chat_file': 'TXT', 'closed_caption': 'VTT'}
+    CHAT_FLAVOR = 'chat/transcript'
+    CAPTIONS_FLAVOR = 'captions/vtt'
+    TRACK_FLAVOR = 'presentation/source'
+    #How long a recording stored with the ingest (see Ingest.set_zoom_recording()) can be used for, rather than fetching
+    #it again.  The download URLs in webhook events are only valid for 24 hours.
+    RECORDING_MAX_AGE = timedelta(hours=23)
+    #A failed ingest is retried after this long, doubling each time, until it has failed this many times
+    RETRY_DELAY = timedelta(minutes=15)
+    MAX_ATTEMPTS = 5
+    #steps: one request per mediapackage element, single: everything in one addMediaPackage request
+    INGEST_STRATEGIES = [ 'steps', 'single' ]
+    #What the transfers raise when they fail, see _attempt()
+    TRANSFER_ERRORS = (StreamingError, HTTPError)
 
     def __init__(self, config, rabbit, zoom, enable_email=False):
         if not rabbit or type(rabbit) != zingest.rabbit.Rabbit:
@@ -83,9 +142,35 @@ class Opencast:
             self.logger.warning(f"Using default filter config: \"{ filter_config }\" because user provided config is blank!")
         self.series_filter = re.compile(filter_config)
         self.logger.debug(f"Workflow filter configured as { self.workflow_filter }")
+        try:
+            self.ingest_strategy = get_config_ignore(config, "Opencast", "ingest_strategy", True).strip().lower()
+        except KeyError:
+            self.ingest_strategy = None
+        if self.ingest_strategy not in self.INGEST_STRATEGIES:
+            self.ingest_strategy = self.INGEST_STRATEGIES[0]
+        self.logger.debug(f"Ingest strategy configured as { self.ingest_strategy }")
+        #Whether every episode gets an ethterms/episode catalog, as it always has
+        try:
+            episode_ethterms = get_config_ignore(config, "Opencast", "episode_ethterms", True)
+        except KeyError:
+            episode_ethterms = None
+        self.episode_ethterms = not episode_ethterms or str(episode_ethterms).strip().lower() != 'false'
+        if self.ingest_strategy == 'single' and self.episode_ethterms:
+            self.logger.warning("The single ingest strategy can't add the ethterms catalog, set episode_ethterms to false to use it.  Using steps.")
+        #Multi-track mode maps Zoom recording types to Opencast flavors, eg speaker_view:presenter/source
+        try:
+            track_config = get_config_ignore(config, "Opencast", "track_flavors", True)
+        except KeyError:
+            track_config = None
+        self.track_flavors = None
+        if track_config and len(track_config.strip()) > 0:
+            self.track_flavors = { recording_type: flavor for recording_type, flavor in [ pair.split(":", 1) for pair in track_config.split() ] }
+            self.logger.info(f"Multi-track ingest configured as { self.track_flavors }")
         self.auth = HTTPDigestAuth(self.user, self.password)
         self.rabbit = rabbit
         self.zoom = zoom
+        self.cache = MediaCache.from_config(config)
+        self.progress_store = progress.ProgressStore.from_config(config)
         self.acls_updated = None
         self.acls = None
         self.themes_updated = None
@@ -95,34 +180,45 @@ class Opencast:
         self.series_updated = None
         self.series_full = None
         self.series = None
+        #Searchable snapshots of the catalogs above, for the UI's type-ahead choices
+        self.catalogs = {
+            'series': CatalogIndex('series'),
+            'acls': CatalogIndex('acls', label=lambda acl: acl['name']),
+            'workflows': CatalogIndex('workflows'),
+            'themes': CatalogIndex('themes'),
+        }
         self.get_acls()
         self.get_themes()
         self.get_workflows()
         self.get_series()
         self.enable_email = enable_email
+        #Follows the workflows we start through to the end, run by the uploader
+        self.workflow_poller = WorkflowPoller.from_config(config, self)
         self.logger.info("Setup complete")
 
     def run(self):
         self.logger.info("Consuming rabbits")
         self.rabbit.start_consuming_rabbitmsg(self.rabbit_callback)
 
-    @db.with_session
-    def process_backlog(dbs, self):
-        self.logger.info("Checking backlog")
-        hour_ago = datetime.utcnow() - timedelta(hours=1)
-        ing_list = dbs.query(db.Ingest).filter(db.Ingest.status != db.Status.FINISHED, db.Ingest.status != db.Status.WARNING, db.Ingest.status != db.Status.IN_PROGRESS, db.Ingest.timestamp <= hour_ago).all()
-        for ing in ing_list:
-            self._process(ing)
-        time.sleep(60)
-
-    def _do_download(self, url, output, expected_size):
+    def _do_download(self, url, output, expected_size, name='download'):
         Path(f"{ self.IN_PROGRESS_ROOT }").mkdir(parents=True, exist_ok=True)
         if os.path.isfile(output) and expected_size == os.path.getsize(output):
           self.logger.debug(f"{ output } already exists and is the right size")
           return
-        with open(output, 'wb') as fd:
-            r = requests.get(url, stream=True, headers={"Authorization": f"Bearer { self.zoom.get_bearer_access_token() }"})
-            stream.stream_response_to_file(r, path=fd, chunksize=8192)
+        start = time.perf_counter()
+        transfer = progress.stage(name, expected_size)
+        with timing.span('download'), open(output, 'wb') as fd:
+            token = self.zoom.get_bearer_access_token()
+            r = requests.get(url, stream=True, headers={"Authorization": f"Bearer { token }"})
+            if r.status_code == 401:
+                r.close()
+                self.zoom.reject_bearer_access_token(token)
+                r = requests.get(url, stream=True, headers={"Authorization": f"Bearer { self.zoom.get_bearer_access_token() }"})
+            stream.stream_response_to_file(r, path=transfer.writer(fd), chunksize=8192)
+        transfer.finish()
+        duration = time.perf_counter() - start
+        if os.path.isfile(output):
+            metrics.observe_transfer('download', os.path.getsize(output), duration)
         if not os.path.isfile(output) or expected_size != os.path.getsize(output):
             if os.path.isfile(output):
                 raise Exception(f"{ output } is the wrong size!  { expected_size } != { os.path.getsize(output) }")
@@ -133,10 +229,12 @@ class Opencast:
         self.logger.debug(f"GETting { url }")
         return requests.get(url, auth=self.auth, headers=Opencast.HEADERS)
 
-    def create_callback(self, encoder):
+    def create_callback(self, encoder, transfer=None):
         last = 0
         def callback(monitor):
             nonlocal last
+            if transfer:
+                transfer.set(monitor.bytes_read)
             pct = int(monitor.bytes_read / monitor.len * 100)
             #Log every 5%, and only if it's a *new* percentage
             #This callback gets called for every read() of the underlying file (possibly every 512 bytes)
@@ -149,20 +247,38 @@ class Opencast:
     def _do_post(self, url, data, files=None):
         self.logger.debug(f"POSTing { data } to { url }")
         #Take the data params (form params)
+        #NB: This may be a list of tuples rather than a dict, where field order matters or fields repeat
         fields = data
         #Add the files
         #TODO: validate this somehow
         if files:
-            fields.update(files)
+            if isinstance(fields, list):
+                fields = fields + list(files.items())
+            else:
+                fields.update(files)
         e = MultipartEncoder(fields = fields)
         #self.logger.debug(e.to_string())
-        m = MultipartEncoderMonitor(e, self.create_callback(e))
+        transfer = None
+        if files:
+            #Only report the uploads which actually carry media, everything else is tiny
+            transfer = progress.stage(self._transfer_name(url, data), e.len)
+        m = MultipartEncoderMonitor(e, self.create_callback(e, transfer))
         #Clone the defaul headers, then set the content type
         #NB: Without setting this content type the ingest will fail when uploading anything!
         headers = {}
         headers.update(Opencast.HEADERS)
         headers['Content-Type'] = m.content_type
-        return requests.post(url, auth=self.auth, headers=headers, data=m)
+        try:
+            return requests.post(url, auth=self.auth, headers=headers, data=m)
+        finally:
+            if transfer:
+                transfer.finish()
+
+    def _transfer_name(self, url, data):
+        #NB: Requests with several files (ie, addMediaPackage) pass a list here, and get named by their endpoint instead
+        if isinstance(data, dict) and 'flavor' in data:
+            return f"upload:{ data['flavor'] }"
+        return f"upload:{ url.rstrip('/').rsplit('/', 1)[-1] }"
 
     def _do_put(self, url, data):
         self.logger.debug(f"PUTing { data } to { url }")
@@ -175,14 +291,29 @@ class Opencast:
         ing_id = int(j['ingest_id'])
         self.logger.debug(f"Received rabbit message to ingest { rec_id } with id { ing_id }")
         ingest = dbs.query(db.Ingest).filter(db.Ingest.ingest_id == ing_id).one_or_none()
-        if ingest:
+        if ingest and ingest.status in [ db.Status.FINISHED, db.Status.WARNING ]:
+            #ie, the scheduler released it again while its first message was still queued
+            self.logger.info(f"{ rec_id }: Ingest { ing_id } has already finished, ignoring")
+        elif ingest and ingest.is_held():
+            #The scheduler will send it again when it's due
+            self.logger.info(f"{ rec_id }: Ingest { ing_id } has not been released yet, ignoring")
+        elif ingest:
             self.logger.debug(f"Ingest { ing_id } found")
             self._process(ingest)
         else:
-            self.logger.warn(f"Received rabbit message for { rec_id } with an invalid ingest id of { ing_id }.")
-
-    @db.with_session
-    def _process(dbs, self, ingest):
+            self.logger.warning(f"Received rabbit message for { rec_id } with an invalid ingest id of { ing_id }.")
+
+    @metrics.INGESTS_IN_FLIGHT.track_inprogress()
+    def _process(self, ingest):
+        sequence.run(self._attempt(ingest, self.TRANSFER_ERRORS), self)
+
+    def _attempt(self, ingest, transfer_errors):
+        """
+        Attempt an ingest, then either schedule its retry or record that it finished, with its stage timings.
+        This, and the rest of the ingest sequence below, is run by the uploader engine with its own transport (this
+        class, or AsyncOpencast), see zingest.sequence.  transfer_errors are what that transport raises when a
+        transfer fails.
+        """
         uuid = ingest.get_recording_id()
         params = json.loads(ingest.get_params().decode('utf-8'))
 
@@ -190,67 +321,130 @@ class Opencast:
         if self.enable_email:
             exception_logger = logging.getLogger("mail")
 
-        try:
-            rec = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
-            if not rec:
-                self.logger.error(f"Unable to find recording { uuid }, this is a bug.")
-                return
-            self.logger.debug(f"{ uuid }: Recording found, processing")
-
-            ingest.update_status(db.Status.IN_PROGRESS);
-            dbs.merge(ingest)
-            dbs.commit()
-
-            if not os.path.isdir(f'{self.IN_PROGRESS_ROOT}'):
-                os.mkdir(f'{self.IN_PROGRESS_ROOT}')
-
-            self.logger.info(f"{ uuid }: Fetching {uuid}")
-            files = self.zoom.get_recording_files(uuid)
-            status = db.Status.FINISHED
-            try:
-                filename = self.fetch_file(uuid, files)
-            except NoMp4Files:
-                self.logger.warn(f"{ uuid }: Does not contain any of the normal recording files, falling back to backup")
-                #If this *still* throws a NoMp4Files then we want to pass this up the chain and retry later
-                filename = self.fetch_file(uuid, files, self.FALLBACK_RECORDING_TYPE_PREFERENCE)
-          #If we found a fallback file finish, but set the state to warning to mark that this is (potentially) broken
-                status = db.Status.WARNING
-
-            chat = None
+        with timing.collect() as timings, progress.track(self.progress_store, ingest.get_id(), uuid) as tracker:
             try:
-                self.logger.debug(f"{ uuid }: Checking if chat transcript exists")
-                chat = self.fetch_file(uuid, files, ['chat_file'], {'chat_file': 'TXT'})
-            except NoMp4Files:
-                #Ignore this.  If there's no file we don't care.
-                pass
-            self.logger.info(f"{ uuid }: Uploading { uuid } as { filename } to { self.url }")
-
-            mp_id, workflow_id = self.oc_upload(uuid, filename, chat, **params)
-
-            #Clean up the files
-            self._rm(filename)
-            if None != chat:
-                self._rm(chat)
-
-            ingest.update_status(status)
-            ingest.set_workflow_id(workflow_id)
-            ingest.set_mediapackage_id(mp_id)
-            dbs.merge(ingest)
-            dbs.commit()
-        except FileNotFoundError as e:
-            exception_logger.error(f"Unable to ingest { uuid }, file not found, will retry later")
-        except ExpatError as e:
-            exception_logger.error(f"Opencast did not return a valid mediapackage for { uuid }, will retry later")
-        except StreamingError as e:
-            exception_logger.exception(f"Error downloading media for { uuid }, will retry")
-        except HTTPError as er:
-            exception_logger.exception(f"Unable to fetch file for { uuid }, will retry later")
-            #We're going to retry this since it's not in FINISHED, so we don't need to do anything here.
+                with timing.span('process'):
+                    yield from self._process_ingest(ingest, uuid, params)
+            except FileNotFoundError as e:
+                exception_logger.error(f"Unable to ingest { uuid }, file not found, will retry later")
+            except ExpatError as e:
+                exception_logger.error(f"Opencast did not return a valid mediapackage for { uuid }, will retry later")
+            except transfer_errors as e:
+                exception_logger.exception(f"Error transferring { uuid }, will retry later")
+                #We're going to retry this since it's not in FINISHED, so we don't need to do anything here.
+            except Exception as e:
+                exception_logger.exception(f"General Exception processing { uuid }")
+                #We're going to retry this since it's not in FINISHED, so we don't need to do anything here.
+            if tracker:
+                tracker.finish(ingest.status in [ db.Status.FINISHED, db.Status.WARNING ], ingest.status_str())
+        if ingest.status not in [ db.Status.FINISHED, db.Status.WARNING ]:
+            self.retry_later(ingest, exception_logger)
+        try:
+            self.logger.debug(f"{ uuid }: Stage timings { timings.as_dict() }")
+            ingest.set_timings(timings.as_dict())
+            yield Call('save_ingest', ingest)
         except Exception as e:
-            exception_logger.exception(f"General Exception processing { uuid }")
-            #We're going to retry this since it's not in FINISHED, so we don't need to do anything here.
+            self.logger.exception(f"Unable to store stage timings for { uuid }")
+
+    def retry_later(self, ingest, exception_logger):
+        #The stored recording's download URLs may be why this failed, so the retry fetches it again
+        ingest.set_zoom_recording(None)
+        if ingest.retry_later(self.RETRY_DELAY, self.MAX_ATTEMPTS):
+            self.logger.info(f"{ ingest.get_recording_id() }: Ingest { ingest.get_id() } will be retried after { ingest.not_before }")
+        else:
+            exception_logger.error(f"{ ingest.get_recording_id() }: Giving up on ingest { ingest.get_id() } after { ingest.attempts } failed attempts")
+
+    def _process_ingest(self, ingest, uuid, params):
+        if not (yield Call('recording_exists', uuid)):
+            self.logger.error(f"Unable to find recording { uuid }, this is a bug.")
+            return
+        self.logger.debug(f"{ uuid }: Recording found, processing")
+
+        ingest.update_status(db.Status.IN_PROGRESS);
+        yield Call('save_ingest', ingest)
+
+        if not os.path.isdir(f'{self.IN_PROGRESS_ROOT}'):
+            os.mkdir(f'{self.IN_PROGRESS_ROOT}')
+
+        ingest_progress = IngestProgress(ingest.get_mediapackage(), ingest.get_completed_steps(), ingest)
+
+        self.logger.info(f"{ uuid }: Fetching {uuid}")
+        with timing.span('zoom_metadata'):
+            #Use the recording stored with the ingest while its download URLs are still good, otherwise fetch it again
+            recording = ingest.get_zoom_recording(self.RECORDING_MAX_AGE)
+            if not recording:
+                recording = yield Call('fetch_recording', uuid)
+                ingest.set_zoom_recording(recording)
+            files = yield Call('get_recording_files', uuid, recording)
+        #If this throws a NoMp4Files then we want to pass this up the chain and retry later
+        tracks, attachments, status = self.plan_files(uuid, files)
+        plan = dict(tracks)
+        plan.update(attachments)
+
+        #Find out what a previous attempt already got into Opencast first, so that only what's missing is downloaded
+        resuming = len(ingest_progress.steps) > 0
+        if resuming:
+            yield from self._resume_progress(uuid, ingest_progress)
+        pending = { flavor: recording_file for flavor, recording_file in plan.items() if not ingest_progress.is_done(flavor) }
+
+        self.logger.info(f"{ uuid }: Downloading { ', '.join(pending.keys()) } and preparing the mediapackage")
+        downloads = yield Start({ flavor: Call('download_file', uuid, recording_file, self.EXTENSION_OVERRIDES) for flavor, recording_file in pending.items() })
+        try:
+            if resuming or not self._use_single_request(len(attachments) > 0, **params):
+                #Opencast doesn't need the media to start building the mediapackage, so do that while the downloads run
+                yield from self._oc_create_mediapackage(uuid, ingest_progress=ingest_progress, **params)
+            downloaded = yield from sequence.gather(downloads)
+        except BaseException:
+            #Don't wait for the rest of the (possibly multi-GB) downloads before giving up, nothing is going to upload
+            #any of it
+            yield Abandon(downloads, '_rm')
+            raise
+
+        #NB: Anything already in Opencast has no file, its step is skipped
+        track_files = { flavor: downloaded.get(flavor, None) for flavor in tracks.keys() }
+        chat = downloaded.get(self.CHAT_FLAVOR, None)
+        captions = downloaded.get(self.CAPTIONS_FLAVOR, None)
+        self.logger.info(f"{ uuid }: Uploading { uuid } as { track_files } to { self.url }")
+
+        try:
+            mp_id, workflow_id = yield from self._oc_upload(uuid, track_files, chat, captions_file=captions, ingest_progress=ingest_progress, **params)
+        finally:
+            #Clean up the files, a retry downloads whatever it still needs again
+            for downloaded_file in downloaded.values():
+                yield Call('_rm', downloaded_file)
+
+        ingest.update_status(status)
+        ingest.set_workflow_id(workflow_id)
+        #NB: A download which didn't match Zoom's reported size would have raised by now
+        ingest.set_verified_files([ { 'id': recording_file['recording_id'], 'type': recording_file['recording_type'], 'size': recording_file['file_size'] } for recording_file in plan.values() ])
+        ingest.set_mediapackage_id(mp_id)
+        ingest.clear_progress()
+        yield Call('save_ingest', ingest)
+        if self.workflow_poller:
+            self.workflow_poller.wakeup()
+
+    @db.with_session
+    def recording_exists(dbs, self, uuid):
+        return dbs.query(db.Recording).filter(db.Recording.uuid == uuid).count() > 0
+
+    @db.with_session
+    def save_ingest(dbs, self, ingest):
+        #NB: The ingest may belong to another session, so this writes a copy of it
+        dbs.merge(ingest)
+        dbs.commit()
+
+    def fetch_recording(self, uuid):
+        return self.zoom.fetch_recording(uuid)
+
+    def get_recording_files(self, uuid, recording):
+        return self.zoom.get_recording_files(uuid, recording)
 
     def _rm(self, path):
+        if self.cache and self.cache.contains(path):
+            #Cached files are cleaned up by the cache's own eviction, once nothing is using them
+            self.logger.debug(f"Not removing { path }, it belongs to the media cache")
+            self.cache.release(path)
+            return
         self.logger.debug(f"Removing { path }")
         try:
             if os.path.isfile(path):
@@ -263,8 +457,43 @@ class Opencast:
                 else:
                     self.logger.exception(f"Exception removing { path }.  File will need to be manually removed.")
 
-    def fetch_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE, extension_overrides={}):
-        dl_url = ''
+    def plan_files(self, recording_id, files):
+        """
+        Work out every file an ingest needs before downloading anything.
+        Returns dicts of track flavor to recording file and attachment flavor to recording file, and the status the
+        ingest should end in.
+        """
+        status = db.Status.FINISHED
+        tracks = {}
+        if self.track_flavors:
+            for recording_type, flavor in self.track_flavors.items():
+                if flavor in tracks:
+                    continue
+                try:
+                    tracks[flavor] = self.select_file(recording_id, files, [ recording_type ])
+                except NoMp4Files:
+                    pass
+            if len(tracks) == 0:
+                self.logger.warning(f"{ recording_id }: Does not contain any of the multi-track recording files, using a single track")
+        if len(tracks) == 0:
+            try:
+                tracks[self.TRACK_FLAVOR] = self.select_file(recording_id, files)
+            except NoMp4Files:
+                self.logger.warning(f"{ recording_id }: Does not contain any of the normal recording files, falling back to backup")
+                tracks[self.TRACK_FLAVOR] = self.select_file(recording_id, files, self.FALLBACK_RECORDING_TYPE_PREFERENCE)
+                #If we found a fallback file finish, but set the state to warning to mark that this is (potentially) broken
+                status = db.Status.WARNING
+        attachments = {}
+        for flavor, recording_type in ((self.CHAT_FLAVOR, self.CHAT_RECORDING_TYPE), (self.CAPTIONS_FLAVOR, self.CAPTIONS_RECORDING_TYPE)):
+            try:
+                self.logger.debug(f"{ recording_id }: Checking if { recording_type } exists")
+                attachments[flavor] = self.select_file(recording_id, files, [ recording_type ])
+            except NoMp4Files:
+                #Ignore this.  If there's no file we don't care.
+                pass
+        return tracks, attachments, status
+
+    def select_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE):
         recording_file = None
         for preference in preferences:
             self.logger.debug(f"{ recording_id  }: Checking if recording contains a file of type { preference }")
@@ -282,22 +511,46 @@ class Opencast:
         #If we've somehow cycled through all the candidates and nothing matches, fail
         if not recording_file:
             raise NoMp4Files(f"{ recording_id }: No acceptable filetype found!")
+        return recording_file
 
-        recording_type = candidate['recording_type']
+    def fetch_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE, extension_overrides={}):
+        recording_file = self.select_file(recording_id, files, preferences)
+        return self.download_file(recording_id, recording_file, extension_overrides)
+
+    def download_file(self, recording_id, recording_file, extension_overrides={}):
+        recording_type = recording_file['recording_type']
         dl_url = recording_file["download_url"]
         expected_size = recording_file["file_size"]
         uuid = recording_file["recording_id"]
         extension = recording_file["file_extension"] if recording_type not in extension_overrides else extension_overrides[recording_type]
 
+        if self.cache:
+            return self._fetch_cached_file(recording_id, uuid, dl_url, expected_size, extension, name=f"download:{ recording_type }")
+
         #Output file lives in the in-progress directory
         #NB: recording_id likely contains characters which are invalid on some filesystems
         filename = f"{self.IN_PROGRESS_ROOT}/{ uuid }.{  extension.lower() }"
 
         self.logger.debug(f"{ recording_id  }: Downloading file id { uuid } from { dl_url } to { filename }")
-        self._do_download(f"{ dl_url }", filename, expected_size)
+        self._do_download(f"{ dl_url }", filename, expected_size, name=f"download:{ recording_type }")
 
         return filename
 
+    def _fetch_cached_file(self, recording_id, file_id, dl_url, expected_size, extension, name='download'):
+        cached = self.cache.get(file_id, expected_size, extension)
+        if cached:
+            self.logger.info(f"{ recording_id }: Using cached copy of file id { file_id } at { cached }")
+            return cached
+        #Download to a temporary name inside the cache, so that other ingests never see a partial file
+        temp = self.cache.temp_path(file_id, extension)
+        self.logger.debug(f"{ recording_id  }: Downloading file id { file_id } from { dl_url } to { temp }")
+        try:
+            self._do_download(f"{ dl_url }", temp, expected_size, name=name)
+        except Exception:
+            self.cache.discard(temp)
+            raise
+        return self.cache.put(file_id, expected_size, extension, temp)
+
     def _build_ingest_renderable(self, results):
         ip = []
         for result in results:
@@ -326,7 +579,7 @@ class Opencast:
                         break
                     #We need the total, count, and result fields.  If the count doesn't match the length of results, or any of the fields are missing
                     if 'total' not in result or 'results' not in result or ('count' in result and len(result['results']) != result['count']):
-                        self.logger.warn("Bad data from Opencast when loading themes")
+                        self.logger.warning("Bad data from Opencast when loading themes")
                         raise Exception("Bad data from Opencast")
                     self.themes_updated = datetime.utcnow()
                     self.themes = { theme['id']: theme['name'] for theme in result['results'] }
@@ -476,6 +729,20 @@ class Opencast:
         self.series[sid] = stitle
         return stitle
 
+    def get_catalog(self, name):
+        """
+        The CatalogIndex for the named catalog (series, acls, workflows or themes), refreshed from Opencast if it is
+        stale.  Raises a KeyError for any other name.
+        """
+        index = self.catalogs[name]
+        if name == 'series':
+            return index.update(self.get_series())
+        elif name == 'acls':
+            return index.update(self.get_acls())
+        elif name == 'themes':
+            return index.update(self.get_themes())
+        return index.update(self.get_workflows())
+
     def _ensure_list(self, value):
         if type(value) != list:
             return [ value ]
@@ -558,53 +825,151 @@ class Opencast:
         #We throw out the results here, we're just looking for the exception if the mediapackage is invalid
         xmltodict.parse(mp)
 
-    def oc_upload(self, rec_id, filename, chat_file=None, acl_id=None, workflow_id=None, **kwargs):
-
+    def _check_workflow_id(self, rec_id, workflow_id):
         if not workflow_id:
             self.logger.error(f"Attempting to ingest { rec_id } with no workflow id!")
             raise Exception("Workflow ID is missing!")
 
+    def resume_progress(self, rec_id, ingest_progress):
+        """
+        Check that the elements of a previously interrupted ingest are still present in Opencast.
+        Anything Opencast no longer has is removed from the mediapackage so that it gets uploaded again.
+        """
+        return sequence.run(self._resume_progress(rec_id, ingest_progress), self)
+
+    def _resume_progress(self, rec_id, ingest_progress):
+        if not ingest_progress.is_done(IngestProgress.CREATE):
+            return ingest_progress
+        self.logger.info(f"{ rec_id }: Resuming ingest, already completed { ', '.join(ingest_progress.steps) }")
+        try:
+            mpdict = xmltodict.parse(ingest_progress.mediapackage)
+            mp = mpdict['mediapackage']
+        except (ExpatError, KeyError, TypeError):
+            self.logger.warning(f"{ rec_id }: Stored mediapackage is invalid, starting over")
+            ingest_progress.reset()
+            yield from self._checkpoint(ingest_progress)
+            return ingest_progress
+        elements = { (section, element_name): self._ensure_list(mp[section][element_name])
+                     for section, element_name in (('media', 'track'), ('metadata', 'catalog'), ('attachments', 'attachment'))
+                     if mp.get(section) and element_name in mp[section] }
+        #Check all of the elements at once
+        checks = yield Start({ (key, index): Call('_element_available', element.get('url', None)) for key, found in elements.items() for index, element in enumerate(found) })
+        available = yield from sequence.gather(checks)
+        missing = []
+        for key, found in elements.items():
+            section, element_name = key
+            kept = []
+            for index, element in enumerate(found):
+                if available[(key, index)]:
+                    kept.append(element)
+                else:
+                    self.logger.debug(f"{ rec_id }: Opencast no longer has { element.get('@type', None) } at { element.get('url', None) }")
+                    missing.append(element.get('@type', None))
+            if len(kept) > 0:
+                mp[section][element_name] = kept
+            else:
+                del mp[section][element_name]
+        if len(missing) > 0:
+            self.logger.info(f"{ rec_id }: Opencast no longer has { ', '.join(missing) }, these will be uploaded again")
+            ingest_progress.update([ step for step in ingest_progress.steps if step not in missing ], xmltodict.unparse(mpdict))
+            yield from self._checkpoint(ingest_progress)
+        return ingest_progress
+
+    def _element_available(self, url):
+        if not url:
+            return False
+        try:
+            return 200 == requests.head(url, auth=self.auth, headers=Opencast.HEADERS, allow_redirects=True).status_code
+        except Exception as e:
+            self.logger.debug(f"Unable to check { url }: { repr(e) }")
+            return False
+
+    def _checkpoint(self, ingest_progress):
+        if ingest_progress.ingest:
+            yield Call('save_ingest', ingest_progress.ingest)
+
+    def _run_step(self, rec_id, ingest_progress, step, message, request, log=None):
+        if ingest_progress.is_done(step):
+            self.logger.debug(f"{ rec_id  }: Already done, skipping: { message }")
+            return
+        (log if log else self.logger.debug)(f"{ rec_id  }: { message }")
+        with timing.span(f"oc_upload:{ step }"):
+            mp = yield request(ingest_progress.mediapackage)
+        self._check_valid_mediapackage(mp)
+        ingest_progress.complete(step, mp)
+        yield from self._checkpoint(ingest_progress)
+
+    def oc_create_mediapackage(self, rec_id, acl_id=None, workflow_id=None, ingest_progress=None, **kwargs):
+        """
+        Create a mediapackage containing the episode metadata and security, but no media.
+        This only needs the ingest parameters, so it can run while the media is still downloading.
+        """
+        return sequence.run(self._oc_create_mediapackage(rec_id, acl_id=acl_id, workflow_id=workflow_id, ingest_progress=ingest_progress, **kwargs), self)
+
+    def _oc_create_mediapackage(self, rec_id, acl_id=None, workflow_id=None, ingest_progress=None, **kwargs):
+        self._check_workflow_id(rec_id, workflow_id)
+        if not ingest_progress:
+            ingest_progress = IngestProgress()
+
         selected_acl = self.get_single_acl(acl_id) if self.get_single_acl(acl_id) is not None else []
         ep_dc = self._prep_dublincore(**kwargs)
-        eth_dc = self._prep_eth_dublincore(**kwargs)
+        eth_dc = self._prep_eth_dublincore(**kwargs) if self.episode_ethterms else None
         if selected_acl:
             ep_acl = self._prep_episode_xacml(rec_id, selected_acl)
         else:
             ep_acl = None
 
-        #TODO: Make this configurable, cf pyca's setup
-        wf_config = {'publishToSearch': 'true', 'flagQuality720p':'true', 'publishToApi':'true', 'publishToEngage':'true','straightToPublishing':'true','publishToOaiPmh':'true'}
-
-        with open(filename, 'rb') as fobj:
-            self.logger.info(f"{ rec_id  }: Creating mediapackage")
-            mp = self._do_get(f'{ self.url }/ingest/createMediaPackage').text
-            self._check_valid_mediapackage(mp)
-
-            self.logger.debug(f"{ rec_id  }: Ingesting episode dublin core settings")
-            mp = self._do_post(f'{ self.url }/ingest/addDCCatalog', data={'flavor': 'dublincore/episode', 'mediaPackage': mp, 'dublinCore': ep_dc}).text
-            self._check_valid_mediapackage(mp)
-            if eth_dc:
-                self.logger.debug(f"{ rec_id  }: Ingesting episode ethterms")
-                mp = self._do_post(f'{ self.url }/ingest/addDCCatalog', data={'flavor': 'ethterms/episode', 'mediaPackage': mp, 'dublinCore': eth_dc}).text
-                self._check_valid_mediapackage(mp)
-            if ep_acl:
-                self.logger.debug(f"{ rec_id  }: Ingesting episode security settings")
-                mp = self._do_post(f'{ self.url }/ingest/addAttachment', data={'flavor': 'security/xacml+episode', 'mediaPackage': mp}, files = {"BODY": ("xacml.xml", ep_acl, "text/xml") }).text
-                self._check_valid_mediapackage(mp)
-            else:
-                self.logger.debug(f"{ rec_id  }: Blank episode security was selected, skip creating episode ACL")
-            if chat_file:
-                with open(chat_file, 'rb') as cobj:
-                    self.logger.debug(f"{ rec_id  }: Ingesting chat transcript { chat_file }")
-                    mp = self._do_post(f'{ self.url }/ingest/addAttachment', data={'flavor': 'chat/transcript', 'mediaPackage': mp, 'fileName': os.path.basename(chat_file)}, files = {"BODY": (os.path.basename(chat_file), cobj, "text/plain") }).text
-                    self.logger.info(mp)
-                    self._check_valid_mediapackage(mp)
-            self.logger.info(f"{ rec_id  }: Ingesting zoom video { filename }")
-            mp = self._do_post(f'{ self.url }/ingest/addTrack', data={'flavor': 'presentation/source', 'mediaPackage': mp, 'fileName': os.path.basename(filename)}, files={ "BODY": (os.path.basename(filename), fobj, "video/mp4") }).text
-            self._check_valid_mediapackage(mp)
-            self.logger.info(f"{ rec_id  }: Triggering processing")
-            workflow = self._do_post(f'{ self.url }/ingest/ingest/{ workflow_id }', data={'mediaPackage': mp}).text
+        yield from self._run_step(rec_id, ingest_progress, IngestProgress.CREATE, "Creating mediapackage",
+            lambda mp: Call('_get_text', 'createMediaPackage'), self.logger.info)
+
+        yield from self._run_step(rec_id, ingest_progress, 'dublincore/episode', "Ingesting episode dublin core settings",
+            lambda mp: Call('_post_text', 'addDCCatalog', {'flavor': 'dublincore/episode', 'mediaPackage': mp, 'dublinCore': ep_dc}))
+        if eth_dc:
+            yield from self._run_step(rec_id, ingest_progress, 'ethterms/episode', "Ingesting episode ethterms",
+                lambda mp: Call('_post_text', 'addDCCatalog', {'flavor': 'ethterms/episode', 'mediaPackage': mp, 'dublinCore': eth_dc}))
+        if ep_acl:
+            yield from self._run_step(rec_id, ingest_progress, 'security/xacml+episode', "Ingesting episode security settings",
+                lambda mp: Call('_post_text', 'addAttachment', {'flavor': 'security/xacml+episode', 'mediaPackage': mp}, {"BODY": ("xacml.xml", ep_acl, "text/xml") }))
+        else:
+            self.logger.debug(f"{ rec_id  }: Blank episode security was selected, skip creating episode ACL")
+        return ingest_progress.mediapackage
+
+    def _use_single_request(self, has_attachments, **kwargs):
+        #addMediaPackage only takes the episode dublin core, an ACL and tracks
+        #Attachments and extra catalogs (ie, ethterms) still need the step by step ingest, so that an episode gets the
+        #same elements whichever way it was ingested
+        if self.ingest_strategy != 'single' or self.episode_ethterms:
+            return False
+        return not has_attachments
+
+    def _oc_upload_single_request(self, rec_id, tracks, acl_id=None, workflow_id=None, **kwargs):
+        selected_acl = self.get_single_acl(acl_id)
+        ep_dc = self._prep_dublincore(**kwargs)
 
+        #NB: Order matters here, each flavor must come before the BODY it applies to
+        fields = [ ('episodeDCCatalog', ep_dc) ]
+        if selected_acl:
+            fields.append(('acl', json.dumps({'acl': {'ace': selected_acl }})))
+        fobjs = []
+        try:
+            for flavor, filename in tracks.items():
+                fobj = open(filename, 'rb')
+                fobjs.append(fobj)
+                fields.append(('flavor', flavor))
+                fields.append(('BODY', (os.path.basename(filename), fobj, "video/mp4")))
+            self.logger.info(f"{ rec_id  }: Ingesting zoom video { ', '.join(tracks.values()) } and metadata in a single request")
+            with timing.span("oc_upload:addMediaPackage"):
+                response = yield Call('_do_post', f'{ self.url }/ingest/addMediaPackage/{ workflow_id }', data=fields)
+        finally:
+            for fobj in fobjs:
+                fobj.close()
+        if 400 <= response.status_code < 500:
+            raise IngestRejected(f"addMediaPackage returned a { response.status_code } http response")
+        if 200 != response.status_code:
+            raise OpencastException(f"addMediaPackage returned a { response.status_code } http response")
+        return self._parse_workflow(rec_id, response.text)
+
+    def _parse_workflow(self, rec_id, workflow):
         wfdict = xmltodict.parse(workflow)
         mpid = wfdict['wf:workflow']['mp:mediapackage']['@id']
         workflow_instance_id = wfdict['wf:workflow']['@id']
@@ -612,6 +977,109 @@ class Opencast:
         self.logger.info(f"Ingested { rec_id } as workflow { workflow_instance_id } on mediapackage { mpid }")
         return mpid, workflow_instance_id
 
+    def _get_text(self, endpoint):
+        return self._do_get(f'{ self.url }/ingest/{ endpoint }').text
+
+    def _post_text(self, endpoint, data, files=None):
+        return self._do_post(f'{ self.url }/ingest/{ endpoint }', data=data, files=files).text
+
+    def _add_file(self, endpoint, flavor, mp, filename, mimetype):
+        start = time.perf_counter()
+        with open(filename, 'rb') as fobj:
+            result = self._post_text(endpoint, {'flavor': flavor, 'mediaPackage': mp, 'fileName': os.path.basename(filename)}, { "BODY": (os.path.basename(filename), fobj, mimetype) })
+        metrics.observe_transfer('upload', os.path.getsize(filename), time.perf_counter() - start)
+        return result
+
+    def _add_track_timed(self, flavor, mp, filename):
+        with timing.span(f"oc_upload:{ flavor }"):
+            return self._add_file('addTrack', flavor, mp, filename, "video/mp4")
+
+    def _merge_track(self, mp, returned, flavor):
+        #Parallel addTrack calls each return the mediapackage they were given plus their own track
+        #so copy the new track(s) of this flavor into the mediapackage we're building up
+        mpdict = xmltodict.parse(mp)
+        existing = mpdict['mediapackage'].get('media', None) or {}
+        existing_tracks = self._ensure_list(existing.get('track', []))
+        existing_ids = [ track.get('@id', None) for track in existing_tracks ]
+        returned_media = xmltodict.parse(returned)['mediapackage'].get('media', None) or {}
+        for track in self._ensure_list(returned_media.get('track', [])):
+            if track.get('@type', None) == flavor and track.get('@id', None) not in existing_ids:
+                existing_tracks.append(track)
+        existing['track'] = existing_tracks
+        mpdict['mediapackage']['media'] = existing
+        return xmltodict.unparse(mpdict)
+
+    def _add_tracks(self, rec_id, ingest_progress, tracks):
+        pending = { flavor: filename for flavor, filename in tracks.items() if not ingest_progress.is_done(flavor) }
+        if len(pending) <= 1:
+            for flavor, filename in tracks.items():
+                yield from self._run_step(rec_id, ingest_progress, flavor, f"Ingesting zoom video { filename } as { flavor }",
+                    lambda mp: Call('_add_file', 'addTrack', flavor, mp, filename, "video/mp4"), self.logger.info)
+            return
+
+        self.logger.info(f"{ rec_id  }: Ingesting zoom videos { ', '.join(pending.values()) } in parallel")
+        base = ingest_progress.mediapackage
+        errors = []
+        uploads = yield Start({ flavor: Call('_add_track_timed', flavor, base, filename) for flavor, filename in pending.items() })
+        #Record each track as it finishes, so a failure in one upload doesn't lose the others
+        while True:
+            finished = yield Next(uploads)
+            if finished is None:
+                break
+            flavor, returned, error = finished
+            try:
+                if error:
+                    raise error
+                self._check_valid_mediapackage(returned)
+                ingest_progress.complete(flavor, self._merge_track(ingest_progress.mediapackage, returned, flavor))
+                yield from self._checkpoint(ingest_progress)
+                self.logger.debug(f"{ rec_id  }: Ingested { flavor }")
+            except Exception as e:
+                self.logger.error(f"{ rec_id  }: Ingesting { flavor } failed with { repr(e) }")
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+
+    def oc_upload(self, rec_id, filename, chat_file=None, acl_id=None, workflow_id=None, captions_file=None, ingest_progress=None, **kwargs):
+        """
+        Ingest a recording.  filename is either the path to a single presentation/source track, or a dict of
+        flavor to path for multi-track ingests.
+        """
+        return sequence.run(self._oc_upload(rec_id, filename, chat_file=chat_file, acl_id=acl_id, workflow_id=workflow_id, captions_file=captions_file, ingest_progress=ingest_progress, **kwargs), self)
+
+    def _oc_upload(self, rec_id, filename, chat_file=None, acl_id=None, workflow_id=None, captions_file=None, ingest_progress=None, **kwargs):
+        self._check_workflow_id(rec_id, workflow_id)
+
+        #TODO: Make this configurable, cf pyca's setup
+        wf_config = {'publishToSearch': 'true', 'flagQuality720p':'true', 'publishToApi':'true', 'publishToEngage':'true','straightToPublishing':'true','publishToOaiPmh':'true'}
+
+        tracks = filename if isinstance(filename, dict) else { self.TRACK_FLAVOR: filename }
+        if not ingest_progress:
+            ingest_progress = IngestProgress()
+
+        if len(ingest_progress.steps) == 0 and self._use_single_request(chat_file or captions_file, **kwargs):
+            #Only a request Opencast refused can safely be retried step by step.  After anything else (ie, a timeout
+            #or a 5xx) Opencast may have the mediapackage already, so the ingest fails rather than risking a duplicate.
+            try:
+                return (yield from self._oc_upload_single_request(rec_id, tracks, acl_id=acl_id, workflow_id=workflow_id, **kwargs))
+            except IngestRejected as e:
+                self.logger.warning(f"{ rec_id }: Single request ingest failed with { repr(e) }, falling back to step by step ingest")
+
+        yield from self._oc_create_mediapackage(rec_id, acl_id=acl_id, workflow_id=workflow_id, ingest_progress=ingest_progress, **kwargs)
+
+        if chat_file:
+            yield from self._run_step(rec_id, ingest_progress, self.CHAT_FLAVOR, f"Ingesting chat transcript { chat_file }",
+                lambda mp: Call('_add_file', 'addAttachment', self.CHAT_FLAVOR, mp, chat_file, "text/plain"))
+        if captions_file:
+            yield from self._run_step(rec_id, ingest_progress, self.CAPTIONS_FLAVOR, f"Ingesting closed captions { captions_file }",
+                lambda mp: Call('_add_file', 'addAttachment', self.CAPTIONS_FLAVOR, mp, captions_file, "text/vtt"))
+        yield from self._add_tracks(rec_id, ingest_progress, tracks)
+        self.logger.info(f"{ rec_id  }: Triggering processing")
+        with timing.span("oc_upload:ingest"):
+            workflow = yield Call('_post_text', f'ingest/{ workflow_id }', {'mediaPackage': ingest_progress.mediapackage})
+
+        return self._parse_workflow(rec_id, workflow)
+
     def create_series(self, title, acl_id, theme_id=None, **kwargs):
 
         fields = self._prep_metadata_fields(**kwargs)
@@ -0,0 +1,157 @@
+import cProfile
+import logging
+import os.path
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from zingest.common import get_config_ignore
+
+HEADER = "HTTP_X_ZINGEST_PROFILE"
+QUERY_PARAM = "_profile"
+CPROFILE = "cprofile"
+SAMPLE = "sample"
+MODES = [ CPROFILE, SAMPLE ]
+
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware which profiles individual requests on demand.
+
+    A request is profiled if it carries an X-Zingest-Profile header, or a _profile query parameter, set to one of:
+     - cprofile: Deterministic profile, written as a .prof file (pstats format, eg for snakeviz or flameprof)
+     - sample: Statistical profile, sampling the request's stack every interval seconds, written as a .folded file of
+       collapsed stacks (eg for flamegraph.pl or speedscope)
+    The name of the file is returned in the X-Zingest-Profile-File response header.
+
+    This is only installed if profiling is enabled in the config, see wrap(), so it costs nothing otherwise.
+    """
+
+    def __init__(self, app, path, interval=0.005):
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.path = path
+        self.interval = float(interval)
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        mode = self._requested_mode(environ)
+        if not mode:
+            return self.app(environ, start_response)
+        filename = self._filename(environ, mode)
+
+        def profiled_start_response(status, headers, exc_info=None):
+            return start_response(status, headers + [ ("X-Zingest-Profile-File", os.path.basename(filename)) ], exc_info)
+
+        if mode == CPROFILE:
+            profiler = cProfile.Profile()
+            try:
+                body = profiler.runcall(self._run, environ, profiled_start_response)
+            finally:
+                profiler.dump_stats(filename)
+        else:
+            sampler = _Sampler(threading.get_ident(), self.interval)
+            sampler.start()
+            try:
+                body = self._run(environ, profiled_start_response)
+            finally:
+                sampler.stop()
+                sampler.write(filename)
+        self.logger.info(f"Profile of { environ.get('REQUEST_METHOD') } { environ.get('PATH_INFO') } written to { filename }")
+        return body
+
+    def _run(self, environ, start_response):
+        #Consume the whole response inside the profiler, since rendering may be deferred until the body is iterated
+        iterable = self.app(environ, start_response)
+        try:
+            return [ b"".join(iterable) ]
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    def _requested_mode(self, environ):
+        mode = environ.get(HEADER, None)
+        if not mode and QUERY_PARAM in environ.get('QUERY_STRING', ""):
+            mode = parse_qs(environ['QUERY_STRING']).get(QUERY_PARAM, [ None ])[0]
+        if not mode:
+            return None
+        mode = mode.strip().lower()
+        return mode if mode in MODES else CPROFILE
+
+    def _filename(self, environ, mode):
+        path = re.sub(r'[^A-Za-z0-9_.-]+', '_', environ.get('PATH_INFO', "/")).strip('_') or "root"
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f')
+        extension = "prof" if mode == CPROFILE else "folded"
+        return os.path.join(self.path, f"{ stamp }-{ environ.get('REQUEST_METHOD', 'GET') }-{ path[:100] }.{ extension }")
+
+
+class _Sampler:
+    """
+    Samples the stack of a single thread from a background thread, and counts each distinct stack.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+
+    def _sample(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id, None)
+            if frame:
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(f"{ code.co_name } ({ os.path.basename(code.co_filename) }:{ code.co_firstlineno })")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def write(self, filename):
+        #Collapsed stack format: root;caller;callee <count>
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{ stack } { count }\n")
+
+
+def wrap(app, config):
+    """
+    Wrap a WSGI app with the profiling middleware if profiling is enabled in the [Profiling] config section, otherwise
+    return the app untouched.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        enabled = str(get_config_ignore(config, "Profiling", "enabled", True)).strip().lower() == 'true'
+    except KeyError:
+        enabled = False
+    if not enabled:
+        return app
+    try:
+        path = get_config_ignore(config, "Profiling", "path", True)
+    except KeyError:
+        path = None
+    if not path or len(path.strip()) == 0:
+        path = "profiles"
+    try:
+        interval = get_config_ignore(config, "Profiling", "interval", True)
+    except KeyError:
+        interval = None
+    if not interval or len(str(interval).strip()) == 0:
+        interval = 0.005
+    logger.warning(f"Request profiling is enabled, profiles will be written to { path.strip() }")
+    return ProfilingMiddleware(app, path.strip(), interval)
@@ -0,0 +1,297 @@
+import contextvars
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from zingest.common import get_config_ignore
+
+#The tracker for the ingest currently being processed, if any
+_current = contextvars.ContextVar('zingest_progress', default=None)
+
+
+class ProgressStore:
+    """
+    Live progress of in-flight ingests, shared between the uploader and the webhook/UI.
+
+    Each ingest is a small JSON file in a directory on local disk, replaced atomically on every write.  This means
+    that readers never see a partial update, and polling the API never touches the main database.
+
+    An ingest whose uploader died part way through would otherwise be reported as running forever, so running ingests
+    are dropped once the process which wrote them is gone, or they haven't been updated for stale_after seconds.
+    """
+
+    #Relative to the working directory, like the in-progress directory
+    DEFAULT_PATH = "ingest-status"
+    #How long to keep reporting an ingest once it has stopped
+    DEFAULT_RETENTION = 3600
+    #How long a running ingest can go without any progress before we assume its uploader is gone
+    DEFAULT_STALE_AFTER = 86400
+
+    def __init__(self, path, retention=DEFAULT_RETENTION, stale_after=DEFAULT_STALE_AFTER):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.retention = int(retention)
+        self.stale_after = int(stale_after)
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def from_config(config):
+        """
+        Build a store from the [Progress] config section.
+        """
+        try:
+            path = get_config_ignore(config, "Progress", "path", True)
+        except KeyError:
+            path = None
+        if not path or len(path.strip()) == 0:
+            path = ProgressStore.DEFAULT_PATH
+        try:
+            retention = get_config_ignore(config, "Progress", "retention", True)
+        except KeyError:
+            retention = None
+        if not retention or len(str(retention).strip()) == 0:
+            retention = ProgressStore.DEFAULT_RETENTION
+        try:
+            stale_after = get_config_ignore(config, "Progress", "stale_after", True)
+        except KeyError:
+            stale_after = None
+        if not stale_after or len(str(stale_after).strip()) == 0:
+            stale_after = ProgressStore.DEFAULT_STALE_AFTER
+        return ProgressStore(path.strip(), retention, stale_after)
+
+    def _file(self, ingest_id):
+        return os.path.join(self.path, f"{ int(ingest_id) }.json")
+
+    def write(self, ingest_id, state):
+        target = self._file(ingest_id)
+        temp = f"{ target }.{ os.getpid() }.{ threading.get_ident() }.tmp"
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp, target)
+
+    def read(self, ingest_id):
+        try:
+            with open(self._file(ingest_id)) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return None if self._abandoned(state, time.time()) else state
+
+    def _abandoned(self, state, now):
+        """
+        :return: True if state claims to be running, but whatever was running it has gone away
+        """
+        if state.get('state') != Tracker.RUNNING:
+            return False
+        if now - state.get('updated', 0) > self.stale_after:
+            return True
+        #The store is on local disk, so the writer was on this machine
+        pid = state.get('pid', None)
+        if not pid:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            #Alive, but not ours
+            pass
+        return False
+
+    def read_all(self):
+        """
+        Returns the progress of every ingest that is running or recently stopped, newest first.
+        """
+        now = time.time()
+        states = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        state = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    #Removed or replaced while we were reading it
+                    continue
+                if state.get('state') != Tracker.RUNNING and now - state.get('updated', 0) > self.retention:
+                    self.remove(entry.path)
+                    continue
+                if self._abandoned(state, now):
+                    self.logger.info(f"Removing the progress of ingest { state.get('ingest_id') }, its uploader has gone away")
+                    self.remove(entry.path)
+                    continue
+                states.append(state)
+        return sorted(states, key=lambda state: state.get('started', 0), reverse=True)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Stage:
+    """
+    Byte progress of one transfer within an ingest.
+    """
+
+    def __init__(self, tracker, name, total):
+        self.tracker = tracker
+        self.name = name
+        self.total = int(total) if total else 0
+        self.bytes = 0
+        self.started = time.time()
+        self.finished = None
+
+    def advance(self, num_bytes):
+        self.bytes += num_bytes
+        self.tracker.changed()
+
+    def set(self, num_bytes):
+        self.bytes = num_bytes
+        self.tracker.changed()
+
+    def finish(self):
+        self.finished = time.time()
+        self.tracker.changed(force=True)
+
+    def writer(self, fd):
+        """
+        Wrap a file-like object so that everything written to it counts towards this stage.
+        """
+        return _CountingWriter(fd, self)
+
+    def as_dict(self, now):
+        elapsed = (self.finished or now) - self.started
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        eta = None
+        if not self.finished and rate > 0 and self.total > 0:
+            eta = round(max(self.total - self.bytes, 0) / rate, 1)
+        return {
+            'bytes': self.bytes,
+            'total': self.total,
+            'percent': round(self.bytes / self.total * 100, 1) if self.total > 0 else None,
+            'rate': round(rate),
+            'eta': eta,
+            'done': self.finished is not None,
+        }
+
+
+class _CountingWriter:
+
+    def __init__(self, fd, stage):
+        self.fd = fd
+        self.stage = stage
+        self.name = getattr(fd, 'name', None)
+
+    def write(self, data):
+        self.stage.advance(len(data))
+        return self.fd.write(data)
+
+
+class Tracker:
+    """
+    Collects the progress of a single ingest, and writes it to the store at most once every MIN_INTERVAL seconds.
+    """
+
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    MIN_INTERVAL = 1
+
+    def __init__(self, store, ingest_id, uuid):
+        self.store = store
+        self.ingest_id = ingest_id
+        self.uuid = uuid
+        self.state = Tracker.RUNNING
+        self.status = None
+        self.started = time.time()
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.last_write = 0
+
+    def stage(self, name, total):
+        with self.lock:
+            stage = Stage(self, name, total)
+            self.stages[name] = stage
+        self.changed(force=True)
+        return stage
+
+    def finish(self, succeeded, status=None):
+        self.state = Tracker.FINISHED if succeeded else Tracker.FAILED
+        self.status = status
+        self.changed(force=True)
+
+    def changed(self, force=False):
+        now = time.time()
+        #This gets called for every chunk transferred, so check cheaply before taking the lock
+        if not force and now - self.last_write < self.MIN_INTERVAL:
+            return
+        with self.lock:
+            if not force and now - self.last_write < self.MIN_INTERVAL:
+                return
+            self.last_write = now
+            state = self.as_dict(now)
+            try:
+                self.store.write(self.ingest_id, state)
+            except OSError:
+                logging.getLogger(__name__).exception(f"Unable to write progress for ingest { self.ingest_id }")
+
+    def as_dict(self, now):
+        return {
+            'ingest_id': self.ingest_id,
+            'uuid': self.uuid,
+            'state': self.state,
+            'status': self.status,
+            'started': self.started,
+            'updated': now,
+            'pid': os.getpid(),
+            'stages': { name: stage.as_dict(now) for name, stage in self.stages.items() },
+        }
+
+
+class _NoStage:
+    #Used when nothing is being tracked, so that callers don't need to care
+
+    def advance(self, num_bytes):
+        pass
+
+    def set(self, num_bytes):
+        pass
+
+    def finish(self):
+        pass
+
+    def writer(self, fd):
+        return fd
+
+
+@contextmanager
+def track(store, ingest_id, uuid):
+    """
+    Track the progress of everything run inside this block (and any functions wrapped with timing.propagate()).
+    """
+    tracker = Tracker(store, ingest_id, uuid) if store else None
+    token = _current.set(tracker)
+    try:
+        if tracker:
+            tracker.changed(force=True)
+        yield tracker
+    finally:
+        _current.reset(token)
+
+
+def stage(name, total):
+    """
+    Start reporting progress for a named transfer of total bytes in the current ingest.
+    """
+    tracker = _current.get()
+    if not tracker:
+        return _NoStage()
+    return tracker.stage(name, total)
@@ -5,6 +5,7 @@ import time
 import pika
 
 import zingest
+from zingest import timing
 from zingest.common import get_config
 
 
@@ -32,25 +33,57 @@ class Rabbit:
 
         return rabbit_msg
 
-    def send_rabbit_msg(self, uuid, ingest_id):
-        msg = self._construct_rabbit_msg(uuid, ingest_id)
-        self.logger.debug(f"Sending message to {self.rabbit_url}")
+    def _connect(self):
         credentials = pika.PlainCredentials(self.rabbit_user, self.rabbit_pass)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(self.rabbit_url, credentials=credentials))
-        channel = connection.channel()
-        channel.queue_declare(queue="zoomhook")
-        channel.basic_publish(exchange='',
-                              routing_key="zoomhook",
-                              body=json.dumps(msg))
-        connection.close()
+        return pika.BlockingConnection(pika.ConnectionParameters(self.rabbit_url, credentials=credentials))
+
+    def send_rabbit_msg(self, uuid, ingest_id):
+        self.send_rabbit_msgs([ (uuid, ingest_id) ])
+
+    def send_rabbit_msgs(self, ingests):
+        """
+        Send a message for each of the (uuid, ingest_id) pairs in ingests, over a single connection.
+        """
+        msgs = [ self._construct_rabbit_msg(uuid, ingest_id) for uuid, ingest_id in ingests ]
+        if len(msgs) == 0:
+            return
+        self.logger.debug(f"Sending { len(msgs) } message(s) to {self.rabbit_url}")
+        with timing.span('rabbit_publish'):
+            connection = self._connect()
+            try:
+                channel = connection.channel()
+                channel.queue_declare(queue="zoomhook")
+                for msg in msgs:
+                    channel.basic_publish(exchange='',
+                                          routing_key="zoomhook",
+                                          body=json.dumps(msg))
+            finally:
+                connection.close()
         self.logger.debug("Done!")
 
+    def get_queue_depth(self):
+        return self.get_queue_counts()[0]
+
+    def get_queue_counts(self):
+        """
+        :return: The number of messages ready for delivery, and the number of consumers.  Messages which have been
+        delivered but not yet acknowledged are not counted, see start_consuming_rabbitmsg()
+        """
+        connection = self._connect()
+        try:
+            channel = connection.channel()
+            method = channel.queue_declare(queue="zoomhook", passive=True).method
+            return method.message_count, method.consumer_count
+        finally:
+            connection.close()
+
     def start_consuming_rabbitmsg(self, callback):
         self.logger.debug(f"Connecting to {self.rabbit_url} as {self.rabbit_user}")
-        credentials = pika.PlainCredentials(self.rabbit_user, self.rabbit_pass)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(self.rabbit_url, credentials=credentials))
+        connection = self._connect()
         rcv_channel = connection.channel()
         rcv_channel.queue_declare(queue="zoomhook")
+        #One at a time, otherwise messages sit unacknowledged in our buffer where nobody can tell them from lost ones
+        rcv_channel.basic_qos(prefetch_count=1)
         for method_frame, properties, body in rcv_channel.consume('zoomhook'):
             self.logger.debug(f"Message {method_frame.delivery_tag}, running callback")
             callback(method_frame, properties, body)
@@ -0,0 +1,203 @@
+import logging
+import threading
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import func, or_
+
+from zingest import db
+from zingest.common import get_config_ignore
+
+
+class Lane:
+    """
+    A class of ingests which share a schedule: the times of day (local time) during which they may start, and how many
+    of them may be released to the uploader at once.  A lane without windows is always open, and a capacity of 0 means
+    no limit.
+    """
+
+    def __init__(self, name, windows=None, capacity=0):
+        self.name = name
+        self.windows = windows if windows else []
+        self.capacity = int(capacity)
+
+    @staticmethod
+    def parse_windows(value):
+        """
+        Parse a space delimited list of HH:MM-HH:MM windows.  A window which ends before it starts runs past midnight.
+        """
+        windows = []
+        for window in str(value).split():
+            start, end = window.split("-")
+            windows.append((time.fromisoformat(start), time.fromisoformat(end)))
+        return windows
+
+    def is_open(self, when=None):
+        if len(self.windows) == 0:
+            return True
+        now = (when if when else datetime.now()).time()
+        for start, end in self.windows:
+            if start <= end and start <= now < end:
+                return True
+            if start > end and (now >= start or now < end):
+                return True
+        return False
+
+
+class IngestScheduler:
+    """
+    Decides when each ingest is sent to the uploader, via the zoomhook queue.
+
+    Every ingest is in a lane: interactive (ingests of a single recording from the UI), bulk (many recordings at once
+    from the UI) or webhook (recordings Zoom tells us about).  Each lane has its own windows and capacity (see Lane), so
+    that, for instance, bulk and webhook ingests can be held until night while interactive ingests go straight through.
+    An ingest may also have a not_before time, and isn't released before then.
+
+    An ingest whose lane is open, has no capacity limit, and which isn't deferred is sent as soon as it is created.
+    Everything else is left for run(), which releases whatever it can every interval seconds, oldest first, up to each
+    open lane's spare capacity.  A lane's capacity is the number of its ingests which have been released in the last
+    redeliver_after seconds and haven't finished.  An ingest which is still new redeliver_after seconds after it was
+    released (ie, the message was lost) is released again, once the queue is empty and no uploader is part way
+    through an ingest (and so possibly holding its message).
+    """
+
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
+    WEBHOOK = 'webhook'
+    LANES = [ INTERACTIVE, BULK, WEBHOOK ]
+
+    DEFAULT_INTERVAL = 60
+    DEFAULT_REDELIVER_AFTER = 3600
+
+    def __init__(self, rabbit, lanes=None, interval=DEFAULT_INTERVAL, redeliver_after=DEFAULT_REDELIVER_AFTER):
+        self.logger = logging.getLogger(__name__)
+        self.rabbit = rabbit
+        self.lanes = { name: Lane(name) for name in self.LANES }
+        if lanes:
+            self.lanes.update({ lane.name: lane for lane in lanes })
+        self.interval = float(interval)
+        self.redeliver_after = timedelta(seconds=float(redeliver_after))
+        self.woken = threading.Event()
+
+    @staticmethod
+    def from_config(config, rabbit):
+        """
+        Build a scheduler from the [Scheduler] config section.  Each lane is configured with <lane>_windows and
+        <lane>_capacity keys.
+        """
+        def setting(key):
+            try:
+                value = get_config_ignore(config, "Scheduler", key, True)
+            except KeyError:
+                value = None
+            return value if value and len(str(value).strip()) > 0 else None
+
+        lanes = []
+        for name in IngestScheduler.LANES:
+            windows = setting(f"{ name }_windows")
+            capacity = setting(f"{ name }_capacity")
+            lanes.append(Lane(name, Lane.parse_windows(windows) if windows else None, capacity if capacity else 0))
+        interval = setting("interval")
+        redeliver_after = setting("redeliver_after")
+        return IngestScheduler(rabbit, lanes,
+                               interval if interval else IngestScheduler.DEFAULT_INTERVAL,
+                               redeliver_after if redeliver_after else IngestScheduler.DEFAULT_REDELIVER_AFTER)
+
+    @staticmethod
+    def lane_for(params, bulk=False):
+        """
+        :return: The lane for an ingest with params, bulk is True for the many-recordings-at-once path
+        """
+        if bulk:
+            return IngestScheduler.BULK
+        is_webhook = params['is_webhook'] if 'is_webhook' in params else False
+        return IngestScheduler.WEBHOOK if str(is_webhook) in ['true', 'True'] else IngestScheduler.INTERACTIVE
+
+    def get_lane(self, name):
+        #Ingests from before lanes existed, or from a lane which is no longer configured, are never held back
+        return self.lanes.get(name, None) or Lane(name)
+
+    def is_immediate(self, lane, not_before=None):
+        """
+        :return: True if an ingest in lane, not before not_before, can be sent to the uploader as soon as it's created
+        """
+        if not_before and not_before > datetime.utcnow():
+            return False
+        lane = self.get_lane(lane)
+        return lane.capacity == 0 and lane.is_open()
+
+    def wakeup(self):
+        self.woken.set()
+
+    def run(self):
+        self.logger.info("Scheduling ingests")
+        while True:
+            try:
+                self.release()
+            except Exception:
+                self.logger.exception("Unable to release scheduled ingests, will try again")
+            self.woken.wait(self.interval)
+            self.woken.clear()
+
+    @db.with_session
+    def release(dbs, self):
+        """
+        Send every ingest which may start now to the uploader, within each lane's capacity.
+
+        :return: The number of ingests released
+        """
+        now = datetime.utcnow()
+        stale = now - self.redeliver_after
+        waiting = dbs.query(db.Ingest.ingest_id, db.Ingest.uuid, db.Ingest.lane, db.Ingest.released).filter(
+                    db.Ingest.status == db.Status.NEW,
+                    or_(db.Ingest.not_before == None, db.Ingest.not_before <= now),
+                    or_(db.Ingest.released == None, db.Ingest.released <= stale)).order_by(db.Ingest.timestamp).all()
+        if len(waiting) == 0:
+            return 0
+
+        if any(released for _, _, _, released in waiting) and not self._queue_is_empty(dbs, stale):
+            #The uploader hasn't got to them yet, rather than their messages being lost
+            waiting = [ ingest for ingest in waiting if not ingest[3] ]
+
+        in_flight = dict(dbs.query(db.Ingest.lane, func.count(db.Ingest.ingest_id)).filter(
+                    db.Ingest.status.in_([ db.Status.NEW, db.Status.IN_PROGRESS ]),
+                    db.Ingest.released > stale).group_by(db.Ingest.lane).all())
+
+        to_release = []
+        for ingest_id, uuid, lane_name, released in waiting:
+            lane = self.get_lane(lane_name)
+            if not lane.is_open():
+                continue
+            if lane.capacity > 0 and in_flight.get(lane_name, 0) >= lane.capacity:
+                continue
+            #Another uploader's scheduler may have read the same rows, only send the ones we manage to mark
+            claim = db.Ingest.released == None if released is None else db.Ingest.released == released
+            claimed = dbs.query(db.Ingest).filter(db.Ingest.ingest_id == ingest_id, db.Ingest.status == db.Status.NEW, claim) \
+                .update({ db.Ingest.released: now }, synchronize_session=False)
+            if claimed == 0:
+                continue
+            in_flight[lane_name] = in_flight.get(lane_name, 0) + 1
+            to_release.append((uuid, ingest_id))
+        if len(to_release) == 0:
+            dbs.commit()
+            return 0
+
+        #Marked before sending, and only committed once sent, so a failure to send leaves them to be tried again
+        self.rabbit.send_rabbit_msgs(to_release)
+        dbs.commit()
+        self.logger.info(f"Released { len(to_release) } ingests, { len(waiting) - len(to_release) } still waiting")
+        return len(to_release)
+
+    def _queue_is_empty(self, dbs, stale):
+        try:
+            ready, consumers = self.rabbit.get_queue_counts()
+        except Exception as e:
+            self.logger.warning(f"Unable to check the queue depth, not redelivering anything: { repr(e) }")
+            return False
+        if ready > 0:
+            return False
+        #RabbitMQ doesn't count messages delivered to a consumer and not yet acknowledged.  The uploaders only take as
+        #many messages as they run ingests at once, so while any of those are running the queue may not really be empty
+        if consumers > 0:
+            running = dbs.query(db.Ingest.ingest_id).filter(db.Ingest.status == db.Status.IN_PROGRESS, db.Ingest.released > stale).count()
+            return running == 0
+        return True
@@ -0,0 +1,174 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from zingest import timing
+
+#An ingest is written once, as generators (see Opencast._attempt()) which yield the I/O they need done and are sent
+#back its result.  Each uploader engine runs those generators with its own transport: run() with Opencast, which does
+#the I/O in threads, and run_async() with AsyncOpencast, which does it on an event loop.  So the engines only differ
+#in how bytes are moved, never in what gets ingested, in which order, or how a failure is handled.
+
+
+class Call:
+    """
+    Call the named method of the transport.  The sequence is sent its result, or has the exception it raised thrown
+    into it.
+    """
+
+    def __init__(self, method, *args, **kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+
+class Start:
+    """
+    Start a dict of Calls, which then run alongside the rest of the sequence.  The sequence is sent the running batch,
+    to wait for with Next (or gather()), or to give up on with Abandon.
+    """
+
+    def __init__(self, calls):
+        self.calls = calls
+
+
+class Next:
+    """
+    Wait for the next Call of a batch to finish.  The sequence is sent its (key, result, exception), or None once
+    every Call of the batch has finished.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+
+
+class Abandon:
+    """
+    Give up on a batch without waiting for it.  Calls which haven't started never will, and the result of every Call
+    which finishes anyway (including those already waited for) is passed to the cleanup method of the transport.
+    """
+
+    def __init__(self, batch, cleanup):
+        self.batch = batch
+        self.cleanup = cleanup
+
+
+def gather(batch):
+    """
+    Wait for every Call of a batch, and return their results by key.  Raises the first exception as soon as it happens.
+    """
+    results = {}
+    while True:
+        finished = yield Next(batch)
+        if finished is None:
+            return results
+        key, result, error = finished
+        if error:
+            raise error
+        results[key] = result
+
+
+def run(sequence, transport):
+    """
+    Run a sequence in this thread, with a thread per Call of each batch.
+    """
+    send, value = sequence.send, None
+    while True:
+        try:
+            operation = send(value)
+        except StopIteration as done:
+            return done.value
+        try:
+            send, value = sequence.send, _perform(operation, transport)
+        except BaseException as e:
+            send, value = sequence.throw, e
+
+
+async def run_async(sequence, transport):
+    """
+    Run a sequence on the current event loop, with a task per Call of each batch.  The transport's methods are
+    coroutines.
+    """
+    send, value = sequence.send, None
+    while True:
+        try:
+            operation = send(value)
+        except StopIteration as done:
+            return done.value
+        try:
+            send, value = sequence.send, await _perform_async(operation, transport)
+        except BaseException as e:
+            send, value = sequence.throw, e
+
+
+def _perform(operation, transport):
+    if isinstance(operation, Call):
+        return getattr(transport, operation.method)(*operation.args, **operation.kwargs)
+    if isinstance(operation, Start):
+        return _ThreadBatch(transport, operation.calls)
+    if isinstance(operation, Next):
+        return operation.batch.next()
+    if isinstance(operation, Abandon):
+        return operation.batch.abandon(getattr(transport, operation.cleanup))
+    raise TypeError(f"Unknown ingest operation { operation }")
+
+
+async def _perform_async(operation, transport):
+    if isinstance(operation, Call):
+        return await getattr(transport, operation.method)(*operation.args, **operation.kwargs)
+    if isinstance(operation, Start):
+        return _TaskBatch(transport, operation.calls)
+    if isinstance(operation, Next):
+        return await operation.batch.next()
+    if isinstance(operation, Abandon):
+        return await operation.batch.abandon(getattr(transport, operation.cleanup))
+    raise TypeError(f"Unknown ingest operation { operation }")
+
+
+class _ThreadBatch:
+
+    def __init__(self, transport, calls):
+        self.pool = ThreadPoolExecutor(max_workers=max(len(calls), 1))
+        self.keys = { self.pool.submit(timing.propagate(getattr(transport, call.method)), *call.args, **call.kwargs): key for key, call in calls.items() }
+        self.finished = as_completed(self.keys)
+
+    def next(self):
+        future = next(self.finished, None)
+        if future is None:
+            self.pool.shutdown()
+            return None
+        error = future.exception()
+        return self.keys[future], None if error else future.result(), error
+
+    def abandon(self, cleanup):
+        #Running calls can't be interrupted, so they are left to finish on their own
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                cleanup(future.result())
+        for future in self.keys:
+            future.add_done_callback(done)
+
+
+class _TaskBatch:
+
+    def __init__(self, transport, calls):
+        self.keys = { asyncio.ensure_future(getattr(transport, call.method)(*call.args, **call.kwargs)): key for key, call in calls.items() }
+        self.pending = set(self.keys)
+        self.done = []
+
+    async def next(self):
+        if not self.done:
+            if not self.pending:
+                return None
+            done, self.pending = await asyncio.wait(self.pending, return_when=asyncio.FIRST_COMPLETED)
+            self.done.extend(done)
+        task = self.done.pop()
+        error = task.exception()
+        return self.keys[task], None if error else task.result(), error
+
+    async def abandon(self, cleanup):
+        for task in self.keys:
+            task.cancel()
+        for result in await asyncio.gather(*self.keys, return_exceptions=True):
+            if not isinstance(result, BaseException):
+                await cleanup(result)
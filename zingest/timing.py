@@ -0,0 +1,120 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from zingest import metrics
+from zingest.common import get_config_ignore
+
+#The collector for the ingest currently being processed, if any
+_current = contextvars.ContextVar('zingest_timings', default=None)
+#Only set if the OpenTelemetry exporter has been enabled, see enable_opentelemetry()
+_tracer = None
+
+
+class Timings:
+    """
+    Collects the time spent in each named span while processing a single ingest.
+    Spans with the same name (eg, several downloads) are summed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def as_dict(self):
+        with self.lock:
+            return { name: round(seconds, 3) for name, seconds in self.durations.items() }
+
+    def server_timing(self):
+        """
+        Render the spans as a Server-Timing header value, in milliseconds.
+        """
+        with self.lock:
+            #Header tokens can't contain colons and the like, so zoom:RecordingComponentV2.get becomes zoom-RecordingComponentV2.get
+            return ", ".join([ f"{ re.sub(r'[^A-Za-z0-9_.-]', '-', name) };dur={ seconds * 1000:.3f}" for name, seconds in self.durations.items() ])
+
+
+@contextmanager
+def collect():
+    """
+    Collect the spans of everything run inside this block (and any functions wrapped with propagate()).
+    """
+    timings = Timings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+def propagate(fn):
+    """
+    Wrap fn so that spans recorded when it runs in another thread (ie, a ThreadPoolExecutor) still end up in the
+    current collector.
+    """
+    context = contextvars.copy_context()
+    def wrapped(*args, **kwargs):
+        return context.run(fn, *args, **kwargs)
+    return wrapped
+
+
+@contextmanager
+def span(name):
+    """
+    Time a block of code.  The duration goes to the current collector (if any), the stage latency histogram, and
+    OpenTelemetry if it is enabled.
+    """
+    otel_span = _tracer.start_as_current_span(name) if _tracer else None
+    if otel_span:
+        otel_span.__enter__()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe_stage(name, duration)
+        timings = _current.get()
+        if timings:
+            timings.add(name, duration)
+        if otel_span:
+            otel_span.__exit__(None, None, None)
+
+
+def enable_opentelemetry(service_name):
+    """
+    Export spans to OpenTelemetry.  The exporter is configured with the standard OTEL_EXPORTER_OTLP_* environment
+    variables.  This is optional, and requires the opentelemetry-sdk and opentelemetry-exporter-otlp packages.
+    """
+    global _tracer
+    logger = logging.getLogger(__name__)
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.error("OpenTelemetry is enabled, but the opentelemetry-sdk and/or opentelemetry-exporter-otlp packages are missing!")
+        return False
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(__name__)
+    logger.info(f"Exporting timing spans to OpenTelemetry as { service_name }")
+    return True
+
+
+def init(config, service_name):
+    try:
+        enabled = get_config_ignore(config, "Timing", "opentelemetry", True)
+    except KeyError:
+        enabled = None
+    if enabled and str(enabled).strip().lower() == 'true':
+        enable_opentelemetry(service_name)
@@ -0,0 +1,189 @@
+import fcntl
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from zingest import metrics, timing
+
+
+class TokenManager:
+    """
+    The Zoom Server-to-Server OAuth token, shared by every thread in the process and, if a store path is given, by
+    every process on the machine (ie, the webhook's gunicorn workers and the uploader).
+
+    Once a token has been fetched a background thread replaces it REFRESH_MARGIN seconds before it expires, so callers
+    of get() normally never wait for Zoom.  Only the very first call, or one after the background refresh has failed
+    for a long time, fetches a token inline.  The store is a small JSON file which is written atomically, and fetches
+    are serialised with a lock file, so only one process fetches a new token and the others pick it up from there.
+
+    If Zoom rejects a token anyway (it can be revoked early) call invalidate() with it, and the next get() will return
+    a different one.
+    """
+
+    DEFAULT_OAUTH_URI = "https://zoom.us/oauth/token"
+    #Zoom's tokens last an hour, replace them in the background this long before they expire
+    REFRESH_MARGIN = 600
+    #Never hand out a token with less than this long left on it
+    MIN_VALIDITY = 60
+    #How long to wait before trying again if a background refresh fails
+    RETRY_INTERVAL = 30
+
+    def __init__(self, client_id, client_secret, account_id, oauth_uri=DEFAULT_OAUTH_URI, path=None):
+        self.logger = logging.getLogger(__name__)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.account_id = account_id
+        self.oauth_uri = oauth_uri
+        self.path = path
+        self.lock = threading.Lock()
+        #(token, expiry timestamp), replaced as a whole so that readers never need the lock
+        self.current = (None, 0)
+        self.rejected = None
+        self.refresher = None
+        self.wakeup = threading.Event()
+        self.closed = False
+
+    def _usable(self, current, margin):
+        token, expires = current
+        return token is not None and token != self.rejected and expires - margin > time.time()
+
+    def peek(self):
+        """
+        Return the current token if it is still good, without ever blocking.  Otherwise None.
+        """
+        current = self.current
+        return current[0] if self._usable(current, self.MIN_VALIDITY) else None
+
+    def get(self):
+        token = self.peek()
+        if token:
+            return token
+        with self.lock:
+            if not self._usable(self.current, self.MIN_VALIDITY):
+                self.logger.debug("No valid Zoom token, fetching one now")
+                self._refresh(self.MIN_VALIDITY)
+            self._start_refresher()
+            return self.current[0]
+
+    def adopt(self, token, expires_in=3600):
+        """
+        Use a token which was fetched elsewhere (ie, by the zoomus client) if we don't already have one.
+        """
+        if not token:
+            return
+        with self.lock:
+            if not self._usable(self.current, self.MIN_VALIDITY):
+                self._refresh(self.MIN_VALIDITY, fetched=(token, time.time() + expires_in))
+            self._start_refresher()
+
+    def invalidate(self, token):
+        """
+        Zoom has rejected token, so stop using it.
+        """
+        if not token:
+            return
+        self.logger.info("Zoom rejected our token, it will be replaced")
+        self.rejected = token
+
+    def close(self):
+        """
+        Stop refreshing the token in the background.
+        """
+        self.closed = True
+        self.wakeup.set()
+
+    def _start_refresher(self):
+        if self.closed or (self.refresher and self.refresher.is_alive()):
+            return
+        self.refresher = threading.Thread(target=self._refresh_loop, name="zoom-token-refresh", daemon=True)
+        self.refresher.start()
+
+    def _refresh_loop(self):
+        while not self.closed:
+            _, expires = self.current
+            remaining = expires - time.time()
+            #Tokens shorter lived than the margin are replaced half way through their life instead
+            delay = remaining - self.REFRESH_MARGIN if remaining > self.REFRESH_MARGIN else remaining / 2
+            self.wakeup.wait(max(delay, 0))
+            self.wakeup.clear()
+            if self.closed:
+                return
+            try:
+                with self.lock:
+                    if not self._usable(self.current, self.REFRESH_MARGIN):
+                        self.logger.debug("Refreshing the Zoom token in the background")
+                        self._refresh(self.REFRESH_MARGIN)
+            except Exception:
+                self.logger.exception(f"Unable to refresh the Zoom token, trying again in { self.RETRY_INTERVAL } seconds")
+                self.wakeup.wait(self.RETRY_INTERVAL)
+
+    def _refresh(self, margin, fetched=None):
+        #NB: Called with self.lock held
+        with self._store_lock():
+            stored = self._read_store()
+            if stored and self._usable(stored, margin):
+                #Another process got there first
+                self.current = stored
+                return
+            if not fetched:
+                fetched = self._fetch()
+            self.current = fetched
+            self._write_store(fetched)
+
+    def _fetch(self):
+        metrics.ZOOM_TOKEN_FETCHES.inc()
+        with timing.span('zoom_token'):
+            resp = requests.post(self.oauth_uri, auth=(self.client_id, self.client_secret),
+                                 data={'grant_type': 'account_credentials', 'account_id': self.account_id}, timeout=15)
+        resp.raise_for_status()
+        token = resp.json()
+        return (token['access_token'], time.time() + int(token.get('expires_in', 3600)))
+
+    @contextmanager
+    def _store_lock(self):
+        if not self.path:
+            yield
+            return
+        with open(f"{ self.path }.lock", 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _read_store(self):
+        if not self.path or not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+            #The store might be shared with a different set of credentials, ie a test instance
+            if stored.get('client_id') != self.client_id or stored.get('account_id') != self.account_id:
+                return None
+            return (stored['access_token'], float(stored['expires']))
+        except (ValueError, KeyError, OSError) as e:
+            self.logger.warning(f"Ignoring unreadable Zoom token store { self.path }: { repr(e) }")
+            return None
+
+    def _write_store(self, current):
+        if not self.path:
+            return
+        token, expires = current
+        directory = os.path.dirname(os.path.abspath(self.path))
+        #mkstemp creates the file readable only by us, which is what we want for a credential
+        fd, temp = tempfile.mkstemp(dir=directory, prefix=".zoom-token-")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'client_id': self.client_id, 'account_id': self.account_id, 'access_token': token, 'expires': expires}, f)
+            os.replace(temp, self.path)
+        except Exception:
+            if os.path.isfile(temp):
+                os.remove(temp)
+            raise
@@ -0,0 +1,245 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import or_
+
+from zingest import db, metrics
+from zingest.common import get_config_ignore
+
+
+class WorkflowPoller:
+    """
+    Follows the Opencast workflows started by our ingests through to the end, so that failed workflows are noticed,
+    and records their final state, how long Opencast spent processing, and the end to end latency from the end of the
+    Zoom recording to publication.
+
+    Rather than asking about each workflow on every poll, each poll lists the instances which Opencast is still running
+    (a page of batch_size at a time, however many ingests are in flight).  Any of ours which are not in that list have
+    finished, and only those are then fetched individually, once, for their final state and timings.  If the listing is
+    not available (it was removed from the workflow service in Opencast 12) each in-flight workflow is fetched instead.
+
+    The poll interval adapts: it drops to min_interval when a workflow finishes or a new ingest is handed to Opencast,
+    then doubles each time a poll finds nothing new, up to max_interval.
+    """
+
+    #Opencast's workflow states, everything else is still going
+    RUNNING_STATES = [ 'INSTANTIATED', 'RUNNING', 'PAUSED', 'FAILING' ]
+    FAILED_STATES = [ 'FAILED', 'STOPPED' ]
+    #Recorded when Opencast no longer knows about the workflow, ie it was cleaned up before we saw it finish
+    MISSING = 'MISSING'
+    #Ingests handed to Opencast before their workflows were followed, which are never polled (see db.Ingest)
+    UNTRACKED = 'UNTRACKED'
+
+    DEFAULT_MIN_INTERVAL = 30
+    DEFAULT_MAX_INTERVAL = 600
+    DEFAULT_BATCH_SIZE = 100
+    #How many individual workflow requests to have in flight at once
+    FETCH_THREADS = 4
+
+    def __init__(self, opencast, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL, batch_size=DEFAULT_BATCH_SIZE):
+        self.logger = logging.getLogger(__name__)
+        self.opencast = opencast
+        self.min_interval = float(min_interval)
+        self.max_interval = max(float(max_interval), self.min_interval)
+        self.batch_size = int(batch_size)
+        self.interval = self.min_interval
+        self.last_poll = 0
+        self.woken = threading.Event()
+        #Set to False the first time the listing fails, so that we don't keep asking for it
+        self.can_list = True
+
+    @staticmethod
+    def from_config(config, opencast):
+        """
+        Build a poller from the [Workflows] config section, or return None if polling is disabled.
+        """
+        try:
+            enabled = get_config_ignore(config, "Workflows", "poll", True)
+        except KeyError:
+            enabled = None
+        if enabled and str(enabled).strip().lower() in [ 'false', 'no', 'off', '0' ]:
+            return None
+        settings = {}
+        for key, default in (("min_interval", WorkflowPoller.DEFAULT_MIN_INTERVAL), ("max_interval", WorkflowPoller.DEFAULT_MAX_INTERVAL), ("batch_size", WorkflowPoller.DEFAULT_BATCH_SIZE)):
+            try:
+                value = get_config_ignore(config, "Workflows", key, True)
+            except KeyError:
+                value = None
+            settings[key] = value if value and len(str(value).strip()) > 0 else default
+        return WorkflowPoller(opencast, **settings)
+
+    def wakeup(self):
+        """
+        Called when an ingest has been handed to Opencast, so that its workflow is checked on soon.
+        """
+        self.interval = self.min_interval
+        self.woken.set()
+
+    def run(self):
+        self.logger.info("Following Opencast workflows")
+        while True:
+            delay = self.last_poll + self.interval - time.time()
+            if delay > 0:
+                #Woken early, the interval may have changed
+                self.woken.wait(delay)
+                self.woken.clear()
+                continue
+            self.last_poll = time.time()
+            in_flight, finished = self.poll()
+            if in_flight == 0 and finished == 0:
+                self.interval = self.max_interval
+            elif finished > 0:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+            self.logger.debug(f"{ in_flight } workflows in flight, { finished } finished, next check in { self.interval }s")
+
+    @db.with_session
+    def poll(dbs, self):
+        """
+        Check on every in-flight workflow, recording any which have finished.
+
+        :return: The number of workflows still in flight, and the number which finished
+        """
+        ingests = dbs.query(db.Ingest).filter(
+                    db.Ingest.status.in_([ db.Status.FINISHED, db.Status.WARNING ]),
+                    db.Ingest.workflow_id != None,
+                    or_(db.Ingest.workflow_state == None, db.Ingest.workflow_state.in_(self.RUNNING_STATES))).all()
+        if len(ingests) == 0:
+            return 0, 0
+        by_id = { str(ingest.get_workflow_id()): ingest for ingest in ingests }
+
+        running = self.get_running(set(by_id.keys())) if self.can_list else None
+        if running is None:
+            to_fetch = list(by_id.keys())
+        else:
+            to_fetch = [ workflow_id for workflow_id in by_id.keys() if workflow_id not in running ]
+            for workflow_id, state in running.items():
+                by_id[workflow_id].set_workflow_state(state)
+
+        finished = 0
+        now = datetime.utcnow()
+        with ThreadPoolExecutor(max_workers=self.FETCH_THREADS) as pool:
+            for workflow_id, workflow in zip(to_fetch, pool.map(self.get_workflow, to_fetch)):
+                ingest = by_id[workflow_id]
+                if workflow is False:
+                    #Unable to ask, try again next time
+                    continue
+                state = workflow['state'] if workflow else self.MISSING
+                ingest.set_workflow_state(state)
+                if state not in self.RUNNING_STATES:
+                    self._finished(dbs, ingest, workflow)
+                    finished += 1
+        for ingest in ingests:
+            ingest.workflow_checked = now
+        dbs.commit()
+        return len(ingests) - finished, finished
+
+    def get_running(self, workflow_ids):
+        """
+        Page through the workflows Opencast is still running, stopping early once all of workflow_ids have been seen.
+
+        :return: A dict of the running workflows in workflow_ids to their state, or None if they can't be listed
+        """
+        states = "&".join(f"state={ state }" for state in self.RUNNING_STATES)
+        running = {}
+        page = 0
+        try:
+            while True:
+                response = self.opencast._do_get(f'{ self.opencast.url }/workflow/instances.json?{ states }&compact=true&count={ self.batch_size }&startPage={ page }')
+                if response.status_code == 404:
+                    self.logger.info("Opencast can't list workflows, fetching each workflow instead")
+                    self.can_list = False
+                    return None
+                response.raise_for_status()
+                result = response.json()['workflows']
+                workflows = self.opencast._ensure_list(result.get('workflow', []))
+                for workflow in workflows:
+                    if str(workflow['id']) in workflow_ids:
+                        running[str(workflow['id'])] = workflow['state']
+                page += 1
+                if len(running) == len(workflow_ids) or len(workflows) < self.batch_size or page * self.batch_size >= int(result.get('totalCount', 0)):
+                    return running
+        except Exception as e:
+            self.logger.warning(f"Unable to list running workflows, fetching each workflow instead: { repr(e) }")
+            return None
+
+    def get_workflow(self, workflow_id):
+        """
+        :return: The workflow instance, None if Opencast doesn't know about it, or False if we couldn't find out
+        """
+        try:
+            response = self.opencast._do_get(f'{ self.opencast.url }/workflow/instance/{ workflow_id }.json')
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+            return response.json()['workflow']
+        except Exception as e:
+            self.logger.warning(f"Unable to check on workflow { workflow_id }: { repr(e) }")
+            return False
+
+    def _finished(self, dbs, ingest, workflow):
+        uuid = ingest.get_recording_id()
+        state = ingest.get_workflow_state()
+        metrics.WORKFLOWS_FINISHED.labels(state).inc()
+        started, completed = _operation_times(workflow) if workflow else (None, None)
+        if completed:
+            ingest.workflow_completed = completed.replace(tzinfo=None)
+            if started:
+                ingest.processing_duration = int((completed - started).total_seconds())
+                metrics.WORKFLOW_DURATION.observe(ingest.processing_duration)
+            recording = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
+            recording_end = _recording_end(recording)
+            if recording_end:
+                ingest.latency = int((completed - recording_end).total_seconds())
+                metrics.END_TO_END_LATENCY.observe(ingest.latency)
+
+        message = f"{ uuid }: Opencast workflow { ingest.get_workflow_id() } finished as { state }, processing took { ingest.processing_duration }s, { ingest.latency }s after the recording ended"
+        if state in self.FAILED_STATES or state == self.MISSING:
+            exception_logger = logging.getLogger("mail") if self.opencast.enable_email else self.logger
+            exception_logger.error(message)
+        else:
+            self.logger.info(message)
+
+
+def _parse_time(value):
+    """
+    Opencast reports times either as milliseconds since the epoch or as ISO 8601 strings, depending on the version.
+    """
+    if value is None or value == "":
+        return None
+    try:
+        return datetime.fromtimestamp(int(value) / 1000, tz=timezone.utc)
+    except (TypeError, ValueError):
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _operation_times(workflow):
+    """
+    :return: When the workflow's first operation started and its last one completed, either of which may be None
+    """
+    operations = workflow.get('operations', None) or {}
+    operations = operations.get('operation', []) if isinstance(operations, dict) else operations
+    if not isinstance(operations, list):
+        operations = [ operations ]
+    started = [ _parse_time(operation.get('started', None)) for operation in operations ]
+    completed = [ _parse_time(operation.get('completed', None)) for operation in operations ]
+    started = [ value for value in started if value ]
+    completed = [ value for value in completed if value ]
+    return min(started) if started else None, max(completed) if completed else None
+
+
+def _recording_end(recording):
+    if not recording or not recording.start_time:
+        return None
+    try:
+        start = datetime.fromisoformat(recording.start_time.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if not start.tzinfo:
+        start = start.replace(tzinfo=timezone.utc)
+    return start + timedelta(minutes=recording.get_duration())
@@ -1,9 +1,11 @@
 import functools
+import json
 import logging
 from datetime import datetime, timedelta
-from random import random
+from random import uniform
 import urllib.parse
 from urllib.parse import quote
+import threading
 import time
 from requests import HTTPError
 
@@ -17,8 +19,55 @@ def refresh_token(self):
             self.config["api_account_id"])
 ZoomClient.refresh_token = refresh_token
 
-from zingest import db
-from zingest.common import BadWebhookData, NoMp4Files, get_config
+from zingest import db, metrics, timing
+from zingest.common import BadWebhookData, NoMp4Files, get_config, get_config_ignore
+from zingest.tokens import TokenManager
+
+
+#Some users are somehow putting zero width spaces into their metadata, these are removed from everything Zoom returns
+ZERO_WIDTH_SPACE = '\u200b'
+#The same, as it appears in a response which escapes non-ASCII characters
+_ZERO_WIDTH_SPACE_ESCAPED = ('\\u200b', '\\u200B')
+
+
+def clean_zero_width_spaces(thing):
+    """
+    Remove zero width spaces from an already parsed object, in place.
+    """
+    #Walk with an explicit stack rather than recursing, so deeply nested responses can't hit the recursion limit
+    stack = [ thing ]
+    while stack:
+        current = stack.pop()
+        if type(current) is dict:
+            items = current.items()
+        elif type(current) is list:
+            items = enumerate(current)
+        else:
+            continue
+        for key, value in items:
+            if type(value) is str:
+                if ZERO_WIDTH_SPACE in value:
+                    current[key] = value.replace(ZERO_WIDTH_SPACE, '')
+            elif type(value) in [dict, list]:
+                stack.append(value)
+    return thing
+
+
+def parse_json(content):
+    """
+    Parse a Zoom API response, removing any zero width spaces.  Raw zero width spaces are stripped from the response
+    before it is parsed, which is much cheaper than walking the parsed result.  Only a response which contains an
+    escaped one is walked afterwards.
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    #NB: Searching for a single character is close to free, and an all ASCII string can't contain a zero width space
+    if ZERO_WIDTH_SPACE in content:
+        content = content.replace(ZERO_WIDTH_SPACE, '')
+    parsed = json.loads(content)
+    if '\\' in content and any(escaped in content for escaped in _ZERO_WIDTH_SPACE_ESCAPED):
+        clean_zero_width_spaces(parsed)
+    return parsed
 
 
 class Zoom:
@@ -32,13 +81,36 @@ class Zoom:
         self.gdpr = get_config(config, 'Zoom', 'GDPR').lower() == 'true'
         self.logger.info(f"GDPR compliant endpoints in use: { self.gdpr }")
         self.zoom_client = None
-        self.zoom_client_exp = None
+        #The webhook fans Zoom calls out to worker threads, so the first few can race to create the client
+        self.client_lock = threading.Lock()
+        #Allow testing (and the benchmarks) to point this at a fake Zoom via undocumented keys
+        self.client_overrides = {}
+        for key in ('base_uri', 'oauth_uri'):
+            try:
+                self.client_overrides[key] = get_config_ignore(config, "TESTING", f"zoom_{ key }", True)
+            except KeyError:
+                pass
+        try:
+            token_store = get_config_ignore(config, 'Zoom', 'token_store', True)
+        except KeyError:
+            token_store = None
+        if not token_store or len(token_store.strip()) == 0:
+            token_store = None
+        self.tokens = TokenManager(self.oauth_client_id, self.oauth_client_secret, self.oauth_account_id,
+                                   oauth_uri=self.client_overrides.get('oauth_uri', zoomus.client.OAUTH_URI),
+                                   path=token_store.strip() if token_store else None)
 
     def get_bearer_access_token(self):
         #This is the internal token that Zoom uses for auth
         #This is not otherwise exposed by the underlying zoomus library :(
         return self._get_zoom_client().config.get("token")
 
+    def reject_bearer_access_token(self, token):
+        """
+        Zoom has returned a 401 for token, the next call to get_bearer_access_token() will return a different one.
+        """
+        self.tokens.invalidate(token)
+
     def _validate_object_fields(self, required_object_fields, obj):
         try:
             for field in required_object_fields:
@@ -130,13 +202,16 @@ class Zoom:
             })
         return recording_files
 
-    def get_recording_files(self, rec_id):
-        rec = self.get_recording(rec_id)
+    def get_recording_files(self, rec_id, recording=None):
+        """
+        :param recording: The recording, if we already have it (ie, from a webhook), otherwise it is fetched
+        """
+        rec = recording if recording else self.get_recording(rec_id)
         self.validate_recording_object(rec)
         return self._parse_recording_files(rec)
 
-    def create_recording_from_uuid(self, uuid):
-        data = self.get_recording(uuid)
+    def create_recording_from_uuid(self, uuid, recording=None):
+        data = recording if recording else self.get_recording(uuid)
         return self._create_recording_from_data(data)
 
     def _create_recording_from_data(self, data):
@@ -144,54 +219,55 @@ class Zoom:
         return db.create_recording(required_data)
 
     def _get_zoom_client(self):
-        #Note: There is a ZoomClient.refresh_tokens(), but this appears to be *broken* somehow.  Creating a new client works though...
-        if not self.zoom_client or datetime.utcnow() + timedelta(seconds=1) > self.zoom_client_exp:
-            self.logger.debug("Creating new zoom client")
-            # zoom client library set this interval, so we
-            self.zoom_client_exp = datetime.utcnow() + timedelta(hours=1)
-            if self.gdpr:
-                self.zoom_client = ZoomClient(self.oauth_client_id, self.oauth_client_secret, self.oauth_account_id, base_uri=zoomus.client.API_BASE_URIS[zoomus.util.API_GDPR])
-            else:
-                self.zoom_client = ZoomClient(self.oauth_client_id, self.oauth_client_secret, self.oauth_account_id)
+        #NB: The client is only created once, it gets a fresh token from the token manager before every use
+        if not self.zoom_client:
+            with self.client_lock:
+                if not self.zoom_client:
+                    self.logger.debug("Creating new zoom client")
+                    if self.gdpr:
+                        client = ZoomClient(self.oauth_client_id, self.oauth_client_secret, self.oauth_account_id, **{ 'base_uri': zoomus.client.API_BASE_URIS[zoomus.util.API_GDPR], **self.client_overrides })
+                    else:
+                        client = ZoomClient(self.oauth_client_id, self.oauth_client_secret, self.oauth_account_id, **self.client_overrides)
+                    #zoomus always fetches a token when it's created, so use that one rather than fetching another
+                    self.tokens.adopt(client.config.get("token"))
+                    #Only publish the client once it's complete, other threads don't take the lock if it's set
+                    self.zoom_client = client
+        self.zoom_client.config["token"] = self.tokens.get()
         return self.zoom_client
 
     def _cleaner(self, thing):
-        if type(thing) is not dict:
-            return
-        for key, value in thing.items():
-            if type(value) is str:
-                thing[key] = value.replace('\u200b', '')  #Some users are somehow putting zero width spaces into their metadata, let's remove them
-            elif type(value) is dict:
-                self._cleaner(value)
-            elif type(value) is list:
-                for element in value:
-                      self._cleaner(element)
-            elif type(value) in [int, bool]:
-                #Do nothing, don't need to filter this
-                pass
-            else:
-                #this shouldn't happen, but let's log it anyway
-                self.logger.debug(f'Unexpected type cleaning { thing }')
-                self.logger.debug(f'{ type(value) }')
-                pass
+        """
+        Remove zero width spaces from an already parsed object, in place.  Prefer parse_json() where there is a raw
+        response to parse.
+        """
+        clean_zero_width_spaces(thing)
 
-    def _make_zoom_request(self, function, args, attempts=5):
+    def _make_zoom_request(self, function, args, attempts=5, reauthenticate=True):
         self.logger.debug(f"Making zoom call to { function.__qualname__ } with { args }")
-        resp = function(**args)
+        with timing.span(f"zoom:{ function.__qualname__ }"):
+            resp = function(**args)
+        if resp.status_code == 401 and reauthenticate and self.zoom_client:
+            #The token was revoked or expired early, get a new one and try once more
+            #NB: The components share the client's config, so this updates the token function will use too
+            self.reject_bearer_access_token(self.zoom_client.config.get("token"))
+            self._get_zoom_client()
+            return self._make_zoom_request(function, args, attempts, reauthenticate=False)
         if 400 <= resp.status_code < 500:
             if resp.status_code == 429:
                 # we hit the Zoom API rate limit,
                 # see https://marketplace.zoom.us/docs/api-reference/rate-limits
+                metrics.ZOOM_RATE_LIMITED.inc()
                 if attempts > 0:
                     self.logger.warning(
                         f"Calling {function.__qualname__} failed due to Zoom API rate limitation. "
                         f"Retry {attempts} more times.")
-                    time.sleep(random(1, 5))
-                    return self._make_zoom_request(self, function, args, attempts=(attempts - 1))
+                    time.sleep(uniform(1, 5))
+                    return self._make_zoom_request(function, args, attempts=(attempts - 1), reauthenticate=reauthenticate)
             resp.raise_for_status()
-        resp_dict = resp.json()
-        self._cleaner(resp_dict)
-        return resp_dict
+        if len(resp.content) == 0:
+            #ie, a 204 from a DELETE
+            return {}
+        return parse_json(resp.content)
 
     def get_user_name(self, user_id_or_email):
         self.logger.debug(f"Looking up plaintext name for { user_id_or_email }")
@@ -229,14 +305,14 @@ class Zoom:
         return user['email']
 
     #We explicitly do not want to cache here since someone might want to know about their recordings *now* rather than when the cache lets them
-    def _get_user_recordings(self, user_id, from_date=None, to_date=None, page_size=None):
+    def _get_user_recordings(self, user_id, from_date=None, to_date=None, page_size=None, next_page_token=None):
         if None == from_date:
             from_date = datetime.utcnow() - timedelta(days = 7)
         if None == to_date:
             to_date = datetime.utcnow()
         if None == page_size:
             page_size = 30
-        #This defaults to 30 records / page -> appears to be 30 *meetings* per call.  We'll deal with paging later
+        #This defaults to 30 records / page -> appears to be 30 *meetings* per call.  See iter_user_recordings() for paging
         #RATELIMIT: 20/60 req/s
         params = {
             'user_id': user_id,
@@ -246,12 +322,28 @@ class Zoom:
             'trash_type': 'meeting_recordings',
             'mc': 'false'
         }
+        if next_page_token and len(next_page_token) > 0:
+            params['next_page_token'] = next_page_token
         fn = self._get_zoom_client().recording.list
         return self._make_zoom_request(fn, params)
 
+    def iter_user_recordings(self, user_id, from_date=None, to_date=None, page_size=None):
+        """
+        Yield each page of a user's recordings as it arrives, following next_page_token, so that only one page is
+        ever held at once.
+        """
+        next_page_token = None
+        while True:
+            page = self._get_user_recordings(user_id, from_date, to_date, page_size, next_page_token)
+            yield page
+            next_page_token = page.get('next_page_token', None)
+            if not next_page_token:
+                return
+
     @db.with_session
     def get_user_recordings(dbs, self, user_id, from_date=None, to_date=None, page_size=None, min_duration=0):
-        #Get the list of recordings from Zoom
+        #Get the list of recordings from Zoom.  Only the first page, the UI's page size bounds what it renders, see
+        #iter_user_recordings() for every page
         zoom_results = self._get_user_recordings(user_id, from_date, to_date, page_size)
         if 'meetings' not in zoom_results:
             self.logger.warning("Got a response from Zoom, but data was invalid")
@@ -303,21 +395,24 @@ class Zoom:
         return renderable
 
     @functools.lru_cache(maxsize=32)
+    def get_recording(self, recording_id):
+        """
+        Get a recording's details, possibly from a short lived cache.  Use fetch_recording() for anything which is stored.
+        """
+        return self.fetch_recording(recording_id)
+
     @db.with_session
-    def get_recording(dbs, self, recording_id):
+    def fetch_recording(dbs, self, recording_id):
+        """
+        Get a recording's details from Zoom, bypassing the cache so the result is as fresh as it claims to be when stored.
+        """
         try:
             if not recording_id:
                 raise ValueError('Recording ID not set or is empty.')
             #RATELIMIT: 30/80 req/s
             self.logger.debug(f"Getting recording { recording_id }")
             fn = self._get_zoom_client().recording.get
-            # If recording_id starts with / or contains //, we must **double encode** the recording_id
-            # before making an API request.
-            # See https://marketplace.zoom.us/docs/api-reference/zoom-api/cloud-recording/recordingget
-            if recording_id.startswith('/') or '//' in recording_id:
-                args = { 'meeting_id': quote(quote(recording_id, safe=''), safe='') }
-            else:
-                args = { 'meeting_id': recording_id }
+            args = { 'meeting_id': self._encode_meeting_id(recording_id) }
             return self._make_zoom_request(fn, args)
         except HTTPError as e:
             self.logger.debug(f"HTTPError fetching { recording_id }")
@@ -329,9 +424,33 @@ class Zoom:
                   dbs.commit()
             raise #Rather than returning some error token let's let the caller deal with it
 
-    def get_renderable_recording(self, recording_id):
-        #Get the recording from Zoom
-        recording = self.get_recording(recording_id)
+    def _encode_meeting_id(self, recording_id):
+        # If recording_id starts with / or contains //, we must **double encode** the recording_id
+        # before making an API request.
+        # See https://marketplace.zoom.us/docs/api-reference/zoom-api/cloud-recording/recordingget
+        if recording_id.startswith('/') or '//' in recording_id:
+            return quote(quote(recording_id, safe=''), safe='')
+        return recording_id
+
+    def trash_recording(self, recording_id):
+        """
+        Move all of a recording's files to the Zoom trash, from which they can still be recovered for 30 days.
+        """
+        if not recording_id:
+            raise ValueError('Recording ID not set or is empty.')
+        #RATELIMIT: Light, 80/s (Pro) or 100/s (Business+)
+        self.logger.debug(f"Moving recording { recording_id } to the trash")
+        fn = self._get_zoom_client().recording.delete
+        args = { 'meeting_id': self._encode_meeting_id(recording_id), 'action': 'trash' }
+        result = self._make_zoom_request(fn, args)
+        #Don't serve the recording from the cache any more
+        self.get_recording.cache_clear()
+        return result
+
+    def get_renderable_recording(self, recording_id, recording=None):
+        #Get the recording from Zoom, unless we already have it
+        if not recording:
+            recording = self.get_recording(recording_id)
         #Turn it into a database entry
         recording = db.create_recording_if_needed(recording)
         #We pass in a list of one, so we know that the returned list is of size 1